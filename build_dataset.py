@@ -1,11 +1,133 @@
-from src.sat_generator import URGenerator, SRGenerator
+from src.sat_generator import URGenerator, SRGenerator, CommunityGenerator, PowerLawGenerator, PlantedGenerator
 from src.solvers import minisat_solver
+from src.manifest import Manifest
+from src.shards import ShardWriter
+from src.dimacs import dimacs_stem
+from src.evaluators import flatten_formula
 
 import numpy as np
 from tqdm import tqdm
-
-
-def toy_dataset():
+import multiprocessing
+
+
+def compressed(filename, compression=None):
+    """Appends the extension of `compression` ('gz', 'xz' or 'bz2') to a file name.
+    The instances are then compressed while they are written by `save`."""
+    if compression is None:
+        return filename
+    if compression not in ('gz', 'xz', 'bz2'):
+        raise ValueError(f"Unknown compression '{compression}'. Use 'gz', 'xz', 'bz2' or None.")
+    return f"{filename}.{compression}"
+
+
+def open_output(dir_name, shard_dir=None):
+    "Manifest of the dataset folder, or a ShardWriter if the instances go to shards."
+    if shard_dir is not None:
+        return ShardWriter(shard_dir)
+    return Manifest(dir_name)
+
+
+def save_instances(sat_gen, instances, labels, output):
+    """Saves (n, formula, filename) instances with one `save_batch` call and adds them,
+    with their SAT labels, to the dataset manifest. A single instance (e.g. the huge
+    ones of `scaling_dataset`) is written by `save`, block by block. If `output` is a
+    ShardWriter the formulas are packed into its shards instead, named after their file names."""
+    if isinstance(output, ShardWriter):
+        for (n, formula, filename), sat in zip(instances, labels):
+            output.add_formula(dimacs_stem(filename), n, formula, sat=sat, generator=type(sat_gen).__name__)
+        return
+    if len(instances) == 1:
+        sat_gen.save(*instances[0])
+    else:
+        sat_gen.save_batch(instances)
+    output.add(output.entry(filename, n, formula, generator=sat_gen, sat=sat)
+               for (n, formula, filename), sat in zip(instances, labels))
+
+
+def build_instances(task):
+    """Worker of `build_parallel`: generates the instances of one task of a dataset grid.
+
+    The global NumPy generator is seeded from the task's own SeedSequence child, so
+    the instances only depend on the task and not on the worker that runs it. With
+    `sat_only`, uniform formulas are drawn until MiniSat finds a SAT one (rejection
+    sampling); SR tasks return their SAT and UNSAT formulas and planted formulas are
+    SAT by construction, so neither needs it. With `sat_only` set to None the formula
+    is not solved and its label is None (e.g. for huge instances).
+    Returns a list of (n, formula, filename, sat) with flat (literals, offsets) formulas.
+    """
+    sat_gen, filenames, sat_only, batch_size, seed_seq = task
+    np.random.seed(seed_seq.generate_state(4))
+
+    if isinstance(sat_gen, SRGenerator):
+        n, m, r, [formula_unsat, formula_sat] = sat_gen.generate_formula(batch_size=batch_size)
+        return [(n, flatten_formula(formula_sat), filenames[0], True),
+                (n, flatten_formula(formula_unsat), filenames[1], False)]
+
+    if isinstance(sat_gen, PlantedGenerator):
+        n, m, r, formula, model = sat_gen.generate_formula()
+        return [(n, formula, filenames[0], True)]
+
+    if sat_only is None:
+        n, m, r, formula = sat_gen.generate_formula()
+        return [(n, flatten_formula(formula), filenames[0], None)]
+
+    while True:
+        # Create a uniform random sat formula
+        n, m, r, formula = sat_gen.generate_formula()
+
+        # Using minisat_solver to check satifiability
+        assignment, is_sat = minisat_solver(n, formula)
+
+        if is_sat or not sat_only:
+            return [(n, flatten_formula(formula), filenames[0], is_sat)]
+
+
+def build_parallel(tasks, seed, output, num_workers=None, save_every=64):
+    """Runs the tasks of a dataset grid on a process pool and saves their instances.
+
+    Every task is a (sat_gen, filenames, sat_only, batch_size) tuple (see
+    `build_instances`) and gets its own child of np.random.SeedSequence(seed), so
+    the dataset is bit-for-bit the same for any number of workers. Results are
+    consumed in task order while the pool keeps working ahead, so slow rejection
+    loops overlap; progress is shown here, in the parent, which is also the only
+    process that writes to `output` (see `save_instances`).
+
+    Arguments
+    ---------
+    -tasks (list): tasks in grid order.
+    -seed (int): root seed of the dataset.
+    -output (Manifest or ShardWriter): see `open_output`.
+    -num_workers (int): processes of the pool; None for all the cores, 0 to run in this process.
+    -save_every (int): maximum number of instances per `save_instances` call.
+    """
+    seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+    jobs = [task + (seed_seq,) for task, seed_seq in zip(tasks, seeds)]
+
+    pool = None
+    if num_workers == 0:
+        results = map(build_instances, jobs)
+    else:
+        pool = multiprocessing.Pool(num_workers)
+        results = pool.imap(build_instances, jobs)
+
+    try:
+        pending, pending_gen = [], None
+        for task, instances in tqdm(zip(tasks, results), total=len(tasks)):
+            sat_gen = task[0]
+            if pending and (sat_gen is not pending_gen or len(pending) >= save_every):
+                save_instances(pending_gen, [i[:3] for i in pending], [i[3] for i in pending], output)
+                pending = []
+            pending.extend(instances)
+            pending_gen = sat_gen
+        if pending:
+            save_instances(pending_gen, [i[:3] for i in pending], [i[3] for i in pending], output)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def toy_dataset(compression=None, shard_dir=None, num_workers=None):
     """
     Builds a toy dataset with Satisfiable Random SAT Formulas.
     This function generates 5 uniform random sat instances
@@ -13,6 +135,9 @@ def toy_dataset():
         k=3
         n=[5, 10, 15]
         r=[1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0]:
+    Set `compression` to 'gz', 'xz' or 'bz2' to write compressed instances, or
+    `shard_dir` to pack them into shards (see src/shards.py) instead of .cnf files.
+    The instances are built by `num_workers` processes (see `build_parallel`).
     """
     print("Building toy_dataset")
 
@@ -24,9 +149,8 @@ def toy_dataset():
     k = 3
     num_instances = 5
 
-    np.random.seed(855104)
-
-    for n in tqdm(n_list):
+    tasks = []
+    for n in n_list:
         for r in r_list:
             m = int(np.around(n * r))
             # Instantiate a sat generator
@@ -37,28 +161,24 @@ def toy_dataset():
                                   min_m=m,
                                   max_m=m)
 
-            sat_clauses = 0
-            while sat_clauses < num_instances:
-                # Create a uniform random sat formula
-                n, m, r, formula = sat_gen.generate_formula()
-
-                # Using minisat_solver to check satifiability
-                assignment, is_sat = minisat_solver(n, formula)
-
-                if is_sat:
-                    sat_clauses += 1
+            # One task per sat instance; each one draws formulas until one is sat.
+            for i in range(1, num_instances + 1):
+                filename = compressed(sat_gen.get_filename(dir_name, data_name, i), compression)
+                tasks.append((sat_gen, [filename], True, None))
 
-                    # Saving the formula
-                    filename = sat_gen.get_filename(dir_name, data_name, sat_clauses)
-                    sat_gen.save(n, formula, filename)
+    output = open_output(dir_name, shard_dir)
+    build_parallel(tasks, seed=855104, output=output, num_workers=num_workers)
+    output.close()
 
 
-def rand_dataset():
+def rand_dataset(compression=None, shard_dir=None, num_workers=None):
     """
     This function generates the following instances:
     For k=3 and n=[10, 20, 30, ..., 100]:
         - 5 Uniform random instances with r=[1.0, 1.5, ..., 4.5]
-
+    Set `compression` to 'gz', 'xz' or 'bz2' to write compressed instances, or
+    `shard_dir` to pack them into shards (see src/shards.py) instead of .cnf files.
+    The instances are built by `num_workers` processes (see `build_parallel`).
     """
     print("Building rand_dataset")
 
@@ -70,9 +190,8 @@ def rand_dataset():
     k = 3
     num_instances = 5
 
-    np.random.seed(98702)
-
-    for n in tqdm(n_list):
+    tasks = []
+    for n in n_list:
         for r in r_list:
             m = int(np.around(n * r))
             dir_name1 = f'{dir_name}/{n:04d}/{m:04d}'
@@ -86,26 +205,31 @@ def rand_dataset():
                                 max_m=m)
 
             for i in range(1, num_instances + 1):
-                # Create a uniform random sat formula
-                n, m, r, formula = sat_gen.generate_formula()
+                filename = compressed(sat_gen.get_filename(dir_name1, data_name, i), compression)
+                tasks.append((sat_gen, [filename], False, None))
 
-                # Saving the formula
-                filename = sat_gen.get_filename(dir_name1, data_name, i)
-                sat_gen.save(n, formula, filename)
+    output = open_output(dir_name, shard_dir)
+    build_parallel(tasks, seed=98702, output=output, num_workers=num_workers)
+    output.close()
 
 
-def sat_rand_dataset():
+def sat_rand_dataset(compression=None, shard_dir=None, num_workers=None, planting='quiet'):
     """
     Builds a dataset with Satisfiable Random SAT Formulas.
-    This function generates 5 uniform random sat instances
+    This function generates 5 random sat instances with a planted solution
     for each of the following combinations of parameters:
         k=3
-        n=[20, 30, 40]
+        n=[20, 30, 40, 50, 60, 70, 80, 90, 100]
         r=[2.0, 2.5, 3.0, 3.5, 4.0, 4.5]:
+    The formulas are sat by construction (see PlantedGenerator for `planting`), so
+    MiniSat is never called, even near the phase transition.
+    Set `compression` to 'gz', 'xz' or 'bz2' to write compressed instances, or
+    `shard_dir` to pack them into shards (see src/shards.py) instead of .cnf files.
+    The instances are built by `num_workers` processes (see `build_parallel`).
     """
     print("Building sat_rand_dataset")
 
-    # Build Uniform random instances
+    # Build random instances with a planted solution
     dir_name = 'data/sat_rand'
     data_name = 'sat_rand'
     n_list = [20, 30, 40, 50, 60, 70, 80, 90, 100]
@@ -113,40 +237,32 @@ def sat_rand_dataset():
     k = 3
     num_instances = 5
 
-    np.random.seed(104873)
-
-    for n in tqdm(n_list):
+    tasks = []
+    for n in n_list:
         for r in r_list:
             m = int(np.around(n * r))
             # Instantiate a sat generator
-            sat_gen = URGenerator(min_n=n,
-                                  max_n=n,
-                                  min_k=k,
-                                  max_k=k,
-                                  min_m=m,
-                                  max_m=m)
-
-            sat_clauses = 0
-            while sat_clauses < num_instances:
-                # Create a uniform random sat formula
-                n, m, r, formula = sat_gen.generate_formula()
+            sat_gen = PlantedGenerator(n=n, m=m, k=k, planting=planting)
 
-                # Using minisat_solver to check satifiability
-                assignment, is_sat = minisat_solver(n, formula)
-
-                if is_sat:
-                    sat_clauses += 1
+            # One task per sat instance.
+            for i in range(1, num_instances + 1):
+                filename = compressed(sat_gen.get_filename(dir_name, data_name, i), compression)
+                tasks.append((sat_gen, [filename], True, None))
 
-                    # Saving the formula
-                    filename = sat_gen.get_filename(dir_name, data_name, sat_clauses)
-                    sat_gen.save(n, formula, filename)
+    output = open_output(dir_name, shard_dir)
+    build_parallel(tasks, seed=104873, output=output, num_workers=num_workers)
+    output.close()
 
 
-def sr_dataset():
+def sr_dataset(compression=None, shard_dir=None, batch_size=None, num_workers=None):
     """
     This function generates the following instances:
     For n=[20, 30, 40]:
         - 5 SR instances with k = 1 + B(0.7) + G(0.4)
+    Set `batch_size` to check that many clauses per solve (see SRGenerator.generate_formula).
+    Set `compression` to 'gz', 'xz' or 'bz2' to write compressed instances, or
+    `shard_dir` to pack them into shards (see src/shards.py) instead of .cnf files.
+    The instances are built by `num_workers` processes (see `build_parallel`).
     """
     print("Building sr_dataset")
 
@@ -158,29 +274,63 @@ def sr_dataset():
     p_geometric = 0.4
     num_instances = 5
 
-    np.random.seed(14650)
-
-    for n in tqdm(n_list):
+    tasks = []
+    for n in n_list:
         # Instantiate a sat generator
         sat_gen = SRGenerator(n=n,
                             p_bernoulli=p_bernoulli,
                             p_geometric=p_geometric)
         
         for i in range(1, num_instances + 1):
-            # Create a uniform random sat formula
-            n, m, r, [formula_unsat, formula_sat] = sat_gen.generate_formula()
+            # The sat and the unsat formula of the pair.
+            filenames = [compressed(sat_gen.get_filename(dir_name, data_name, True, i), compression),
+                         compressed(sat_gen.get_filename(dir_name, data_name, False, i), compression)]
+            tasks.append((sat_gen, filenames, False, batch_size))
 
-            # Saving the sat formula.
-            filename = sat_gen.get_filename(dir_name, data_name, True, i)
-            sat_gen.save(n, formula_sat, filename)
-            
-            # Saving the unsat formula
-            filename = sat_gen.get_filename(dir_name, data_name, False, i)
-            sat_gen.save(n, formula_unsat, filename)
+    output = open_output(dir_name, shard_dir)
+    build_parallel(tasks, seed=14650, output=output, num_workers=num_workers)
+    output.close()
+
+
+def scaling_dataset(compression=None, shard_dir=None, num_workers=None):
+    """
+    Builds a fixed-seed corpus of large structured instances to benchmark how
+    parsing, graph building, node2vec and rollouts scale with n.
+    This function generates 3 unlabeled instances of each generator:
+        - Community attachment with k=3, c=40 and Q=0.8 (see CommunityGenerator).
+        - Power-law with k=3 and beta=2.6 (see PowerLawGenerator).
+    for n=[10^4, 10^5, 10^6] and r=4.2. The instances are not solved.
+    Set `compression` to 'gz', 'xz' or 'bz2' to write compressed instances, or
+    `shard_dir` to pack them into shards (see src/shards.py) instead of .cnf files.
+    The instances are built by `num_workers` processes (see `build_parallel`).
+    """
+    print("Building scaling_dataset")
+
+    dir_name = 'data/scaling'
+    n_list = [10**4, 10**5, 10**6]
+    r = 4.2
+    k = 3
+    num_instances = 3
+
+    tasks = []
+    for n in n_list:
+        m = int(np.around(n * r))
+        generators = {'community': CommunityGenerator(n=n, m=m, k=k, c=40, Q=0.8),
+                      'powerlaw': PowerLawGenerator(n=n, m=m, k=k, beta=2.6)}
+        for data_name, sat_gen in generators.items():
+            dir_name1 = f'{dir_name}/{data_name}/{n:07d}'
+            for i in range(1, num_instances + 1):
+                filename = compressed(sat_gen.get_filename(dir_name1, data_name, i), compression)
+                tasks.append((sat_gen, [filename], None, None))
+
+    output = open_output(dir_name, shard_dir)
+    build_parallel(tasks, seed=52731, output=output, num_workers=num_workers, save_every=1)
+    output.close()
 
 
 if __name__ == '__main__':
     #toy_dataset()
     rand_dataset()
     #sat_rand_dataset()
-    #sr_dataset()
\ No newline at end of file
+    #sr_dataset()
+    #scaling_dataset()
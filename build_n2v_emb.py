@@ -1,5 +1,9 @@
 import torch
 import src.utils as utils
+import src.shards as shards
+from src.manifest import instance_paths
+from src.n2v_cache import N2VCache, embedding_key
+from src.n2v_precompute import precompute
 
 from tqdm import tqdm
 import os
@@ -7,40 +11,88 @@ from os import listdir
 from os.path import isfile, join
 
 
-data_path = 'data/rand/0050'
-n2v_dir = "n2v_emb"
-n2v_dim = 64
-
-# Creates the folder n2v_dir/n2v_dim
-node2vec_dir = os.path.join(n2v_dir, str(n2v_dim))
-os.makedirs(node2vec_dir, exist_ok=True)
-
-device = 'cuda' if torch.cuda.is_available() else 'cpu' 
-
-paths = []
-for root, dirs, files in os.walk(data_path):
-    for filename in files:
-        paths.append(os.path.join(root, filename))
-paths = sorted(paths)
-
-for dimacs_path in tqdm(paths):
-    tail = os.path.split(dimacs_path)[1]  # returns filename and extension
-    node2vec_filename = os.path.splitext(tail)[0]  # returns filename
-
-    _ = utils.node2vec(dimacs_path,
-                       device,
-                       embedding_dim=n2v_dim,
-                       walk_length=10,
-                       context_size=5,
-                       walks_per_node=5,
-                       p=1,
-                       q=1,
-                       batch_size=32,
-                       lr=0.01,
-                       num_epochs=150,
-                       save_path=node2vec_dir,
-                       file_name=node2vec_filename,
-                       num_workers=0,
-                       raytune=False,
-                       verbose=1)
-    
\ No newline at end of file
+data_path = 'data/rand/0050'  # A folder of .cnf files or a 'shard://<shard_dir>' folder of shards.
+n2v_dir = "n2v_emb"  # Folder of the embedding cache (see src/n2v_cache.py).
+n2v_cache_mb = 0  # Size cap of the cache in MB, 0 for no cap.
+union_size = 128  # Formulas trained together by utils.node2vec_batch; 1 trains them one by one.
+num_workers = 0  # Processes that train one formula each (see src/n2v_precompute.py), None for all the cores; 0 uses node2vec_batch.
+n2v_params = {'embedding_dim': 64,
+              'walk_length': 10,
+              'context_size': 5,
+              'walks_per_node': 5,
+              'p': 1,
+              'q': 1,
+              'batch_size': 32,
+              'lr': 0.01,
+              'num_epochs': 150}
+
+if __name__ == '__main__':
+    cache = N2VCache(n2v_dir, max_mb=n2v_cache_mb)
+    print(cache.report())
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu' 
+
+    # Instances from the shards, from the dataset manifest if there is one, or from walking data_path.
+    shard_writer = None
+    if shards.is_shard_ref(data_path):
+        shard_dir, _ = shards.parse_shard_ref(data_path)
+        paths = shards.ShardReader(shard_dir).refs()
+        # The embeddings are also packed into the shards.
+        shard_writer = shards.ShardWriter(shard_dir)
+    else:
+        paths = instance_paths(data_path)
+
+    # Embeddings are cached by formula fingerprint and hyperparameters (see utils.formula_fingerprint);
+    # inside the shards they are stored under the instance name.
+    fingerprints = {dimacs_path: utils.formula_fingerprint(dimacs_path) for dimacs_path in paths}
+    misses = [dimacs_path for dimacs_path in paths if not cache.contains(fingerprints[dimacs_path], n2v_params)]
+
+    # The missing ones are trained on a process pool, or `union_size` formulas at a time on
+    # the disjoint union of their graphs (see utils.node2vec_batch).
+    embeddings = {}
+    failed = set()
+    if num_workers != 0:
+        summary = precompute([(dimacs_path, n2v_params) for dimacs_path in misses], n2v_dir,
+                             num_workers=num_workers, device=device)
+        failed = set(summary['failed'])
+    else:
+        for start in tqdm(range(0, len(misses), union_size)):
+            batch = misses[start:start + union_size]
+            batch_emb = utils.node2vec_batch(batch,
+                                             device,
+                                             **n2v_params,
+                                             num_workers=0,
+                                             verbose=1,
+                                             cache=cache)
+            embeddings.update(zip(batch, batch_emb))
+
+    # Only embeddings missing from the shards, or stored with other hyperparameters, are written,
+    # since replaced embeddings are not removed from the shard files.
+    if shard_writer is not None:
+        written = 0
+        for dimacs_path in paths:
+            if dimacs_path in failed:
+                continue
+            name = shards.instance_name(dimacs_path)
+            n2v_key = embedding_key(fingerprints[dimacs_path], n2v_params)
+            if shard_writer.embedding_key(name, n2v_params['embedding_dim']) == n2v_key:
+                continue
+            emb = embeddings.get(dimacs_path)
+            if emb is None:
+                emb = cache.get(fingerprints[dimacs_path], n2v_params)
+            if emb is None:
+                # Evicted from a capped cache before it was written.
+                failed.add(dimacs_path)
+                continue
+            shard_writer.add_embedding(name, emb.cpu().numpy(), n2v_key)
+            written += 1
+        shard_writer.close()
+        print(f"{written} embeddings written to the shards of {shard_dir}.")
+
+    if failed:
+        print(f"No embeddings for {len(failed)} instances:")
+        for dimacs_path in sorted(failed):
+            print(f"\t{dimacs_path}")
+
+    print(cache.report())
+    cache.close()
@@ -1,6 +1,10 @@
 import torch
 import src.utils as utils
 from src.solvers import pg_solver
+from src.dimacs import dimacs_stem
+from src.manifest import find_manifest, instance_paths
+from src.n2v_cache import N2VCache, config_params
+from src.n2v_precompute import precompute
 
 import os
 import itertools
@@ -21,15 +25,12 @@ import time
 def paths_for_instances(num_vars=20, data_path='data/rand'):
     '''
     Returs the path for every instance in the data_path with num_vars variables.
+    If build_dataset.py wrote a manifest for data_path the instances are selected
+    by n from it; otherwise the folder data_path/<num_vars> is walked.
     '''
-    
-    data_path = os.path.abspath(os.path.join(data_path, str(f'{num_vars:04d}')))
-    paths = []
-    for root, dirs, files in os.walk(data_path):
-        for filename in files:
-            paths.append(os.path.join(root, filename))
-    paths = sorted(paths)
-    return paths
+    if find_manifest(data_path) is not None:
+        return instance_paths(data_path, n=num_vars)
+    return instance_paths(os.path.join(data_path, str(f'{num_vars:04d}')))
 
 
 def node2vec_tune(config):
@@ -39,7 +40,9 @@ def node2vec_tune(config):
     device = 'cpu'
     if config['gpu']:
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    
+
+    # The embeddings of the final run go to the cache at n2v_dir (see src/n2v_cache.py)
+    cache = None if config['n2v_dir'] is None else N2VCache(config['n2v_dir'])
     _ = utils.node2vec(dimacs_path=config['data_dir'],
                        device=device,
                        embedding_dim=config['n2v_dim'],
@@ -51,11 +54,13 @@ def node2vec_tune(config):
                        batch_size=config['n2v_batch_size'],
                        lr=config['n2v_lr'],
                        num_epochs=config['n2v_num_epochs'],
-                       save_path=config['n2v_dir'],
-                       file_name=config['n2v_filename'],
+                       save_path=None,
                        num_workers=config['n2v_workers'],
                        raytune=config['n2v_raytune'],
-                       verbose=config['n2v_verbose'])
+                       verbose=config['n2v_verbose'],
+                       cache=cache)
+    if cache is not None:
+        cache.close()
 
 
 def n2v_hypersearch(instance_dir,
@@ -91,7 +96,6 @@ def n2v_hypersearch(instance_dir,
         config['n2v_verbose'] = 0  # {0, 1, 2}
         config['n2v_raytune'] = True 
         config['n2v_dir'] = None
-        config['n2v_filename'] = None
         
         return config
     
@@ -168,13 +172,19 @@ def pg_hypersearch(instance_dir,
             n2v_config['n2v_verbose'] = 0
             n2v_config['n2v_dir'] = n2v_dir
             del n2v_config['n2v_raytune']
-            del n2v_config['n2v_filename']
+
+            # Ensure the n2v embedding of these hyperparameters is cached before running raytune.
+            with N2VCache(n2v_dir) as cache:
+                if not cache.contains(utils.formula_fingerprint(instance_dir), config_params(n2v_config)):
+                    raise Exception(f"No node2vec emb of {instance_dir} with its best hyperparameters was found in {n2v_dir}.")
     
         def define_by_run_func(trial):
             # Constants
             config = {
                 # Misc
                 "sat_stopping": False,
+                "reward_cache_mb": 64,
+                "eval_workers": 0,
                 "log_interval": 10,
                 "eval_interval": 10,
                 "eval_strategies": [128],
@@ -200,6 +210,7 @@ def pg_hypersearch(instance_dir,
                 
             if node2vec:
                 config["n2v_dir"] = n2v_config['n2v_dir']
+                config["n2v_cache_mb"] = 0  # Trials must not evict the embeddings of each other.
                 config["n2v_dim"] = n2v_config["n2v_dim"]
                 config["n2v_pretrained"] = True
                 config["n2v_walk_len"] = n2v_config["n2v_walk_len"]
@@ -344,130 +355,123 @@ def pg_hypersearch(instance_dir,
 # Running the experiment                            #
 #####################################################
 
-lista = [10, 20, 30, 40, 50, 100]
-for i in lista:
-    num_vars = i
-    data_path = 'data/rand'
-    raytune_dir="hypersearch"
-
-    n2v_dim=128
-    n2v_num_epochs=30
-    n2v_raytune_trials=35
-    n2v_grace_period=5
-    n2v_scheduler_max_t=25
-    n2v_resources_per_trial={"cpu": 10, "gpu": 0.2}  # Adjust this according to your resources
-    n2v_exp_name='node2vec'
-    n2v_dir = 'node2vec_emb'
-
-    pg_batch_size=32
-    pg_raytune_trials=50  # 34 # 50
-    #pg_grace_period=((2*n)+m)*8
-    #pg_num_samples=((2*n)+m)*128
-    #pg_scheduler_max_t=((2*n)+m)*64
-    pg_resources_per_trial={"cpu": 48, "gpu": 1}  # Adjust this according to your resources
-    #pg_resources_per_trial={"cpu": 15, "gpu": 0.3}
-    #pg_resources_per_trial={"cpu": 23, "gpu": 0.45}
-    pg_exp_name='pg_solver'
-
-    output_dir = 'outputs'
-    log_dir = 'logs'
-
-    paths = paths_for_instances(num_vars, data_path)
-    paths = sorted(paths, reverse=True)
-
-    #first_instances = []
-    #for inst in paths:
-    #    if inst[-6:-4] == '01':
-    #        first_instances.append(inst)
-    #paths = first_instances
-    #paths = ['/home/ogutierrez/Documents/Code/Learning-SAT-Solvers/data/rand/0020/0092/rand_n=0020_k=03_m=0092_i=01.cnf']
-
-
-    #####################################################
-    # First step:                                       #
-    # Run hyperparameters search for node2vec emb       #
-    #####################################################
-
-    for i, instance_dir in enumerate(paths):
-        tail = os.path.split(instance_dir)[1]
-        instance_filename = os.path.splitext(tail)[0]
-        exp_path = os.path.join(n2v_exp_name, str(n2v_dim), instance_filename)
-
-        torch.cuda.empty_cache()
-        n2v_hypersearch(instance_dir,
-                        n2v_dim=n2v_dim,
-                        n2v_num_epochs=n2v_num_epochs,
-                        exp_name=exp_path,
-                        raytune_trials=n2v_raytune_trials,
-                        raytune_dir=raytune_dir,
-                        grace_period=n2v_grace_period,
-                        scheduler_max_t=n2v_scheduler_max_t,
-                        resources_per_trial=n2v_resources_per_trial)
+if __name__ == '__main__':
+    lista = [10, 20, 30, 40, 50, 100]
+    for i in lista:
+        num_vars = i
+        data_path = 'data/rand'
+        raytune_dir="hypersearch"
+
+        n2v_dim=128
+        n2v_num_epochs=30
+        n2v_raytune_trials=35
+        n2v_grace_period=5
+        n2v_scheduler_max_t=25
+        n2v_resources_per_trial={"cpu": 10, "gpu": 0.2}  # Adjust this according to your resources
+        n2v_exp_name='node2vec'
+        n2v_dir = 'node2vec_emb'
+        n2v_precompute_workers = None  # Processes that train the best embeddings, None for all the cores (one with cuda).
+        n2v_precompute_retries = 2
+        n2v_device = 'cuda' if torch.cuda.is_available() else 'cpu'  # The best configs are searched with 'gpu': True.
+
+        pg_batch_size=32
+        pg_raytune_trials=50  # 34 # 50
+        #pg_grace_period=((2*n)+m)*8
+        #pg_num_samples=((2*n)+m)*128
+        #pg_scheduler_max_t=((2*n)+m)*64
+        pg_resources_per_trial={"cpu": 48, "gpu": 1}  # Adjust this according to your resources
+        #pg_resources_per_trial={"cpu": 15, "gpu": 0.3}
+        #pg_resources_per_trial={"cpu": 23, "gpu": 0.45}
+        pg_exp_name='pg_solver'
+
+        output_dir = 'outputs'
+        log_dir = 'logs'
+
+        paths = paths_for_instances(num_vars, data_path)
+        paths = sorted(paths, reverse=True)
+
+        #first_instances = []
+        #for inst in paths:
+        #    if inst[-6:-4] == '01':
+        #        first_instances.append(inst)
+        #paths = first_instances
+        #paths = ['/home/ogutierrez/Documents/Code/Learning-SAT-Solvers/data/rand/0020/0092/rand_n=0020_k=03_m=0092_i=01.cnf']
+
+
+        #####################################################
+        # First step:                                       #
+        # Run hyperparameters search for node2vec emb       #
+        #####################################################
+
+        for i, instance_dir in enumerate(paths):
+            instance_filename = dimacs_stem(instance_dir)
+            exp_path = os.path.join(n2v_exp_name, str(n2v_dim), instance_filename)
+
+            torch.cuda.empty_cache()
+            n2v_hypersearch(instance_dir,
+                            n2v_dim=n2v_dim,
+                            n2v_num_epochs=n2v_num_epochs,
+                            exp_name=exp_path,
+                            raytune_trials=n2v_raytune_trials,
+                            raytune_dir=raytune_dir,
+                            grace_period=n2v_grace_period,
+                            scheduler_max_t=n2v_scheduler_max_t,
+                            resources_per_trial=n2v_resources_per_trial)
             
         
-    #####################################################
-    # Second step:                                      #
-    # Build node2vec emb with the best hyperparameters  #
-    #####################################################
-
-    node2vec_dir = os.path.join(n2v_dir, str(n2v_dim))
-    os.makedirs(node2vec_dir, exist_ok=True)
-
-
-    for i, instance_dir in enumerate(paths):
-        tail = os.path.split(instance_dir)[1]
-        instance_filename = os.path.splitext(tail)[0]
-        exp_path = os.path.join(raytune_dir, n2v_exp_name, str(n2v_dim), instance_filename)
-        
-        # Load best config for this instance
-        print(f"\nLoading best node2vec config from {exp_path} ...")
-        restored_tuner = tune.Tuner.restore(path=exp_path,
-                                            trainable=node2vec_tune)
-        results = restored_tuner.get_results()
-        best_config = results.get_best_result(metric="loss", mode="min").config
+        #####################################################
+        # Second step:                                      #
+        # Build node2vec emb with the best hyperparameters  #
+        #####################################################
+
+        # The best configs of every instance are trained on a process pool; instances
+        # whose embeddings are already cached are skipped (see src/n2v_precompute.py).
+        n2v_jobs = []
+        for i, instance_dir in enumerate(paths):
+            instance_filename = dimacs_stem(instance_dir)
+            exp_path = os.path.join(raytune_dir, n2v_exp_name, str(n2v_dim), instance_filename)
         
-        best_config['n2v_verbose'] = 1
-        best_config['n2v_raytune'] = False
-        best_config['n2v_dir'] = node2vec_dir
-        best_config['n2v_filename'] = f'{instance_filename}'
+            # Load best config for this instance
+            print(f"\nLoading best node2vec config from {exp_path} ...")
+            restored_tuner = tune.Tuner.restore(path=exp_path,
+                                                trainable=node2vec_tune)
+            results = restored_tuner.get_results()
+            best_config = results.get_best_result(metric="loss", mode="min").config
+            n2v_jobs.append((instance_dir, config_params(best_config)))
 
-        torch.cuda.empty_cache()
-        node2vec_tune(best_config)
+        precompute(n2v_jobs,
+                   n2v_dir,
+                   num_workers=n2v_precompute_workers,
+                   device=n2v_device,
+                   max_retries=n2v_precompute_retries)
 
 
-    #####################################################
-    # Third step:                                       #
-    # Run hyperparameters search for pg_solver          #
-    #####################################################
+        #####################################################
+        # Third step:                                       #
+        # Run hyperparameters search for pg_solver          #
+        #####################################################
 
-    for i, instance_dir in enumerate(paths):
-        # Get instance's filename
-        tail = os.path.split(instance_dir)[1]
-        instance_filename = os.path.splitext(tail)[0]
-        
-        # Ensure the n2v embedding exists at n2v_dir/n2v_dim before running raytune.
-        node2vec_dir = os.path.join(n2v_dir, str(n2v_dim))
-        n2v_file = os.path.join(node2vec_dir, instance_filename + ".pt")
-        if not os.path.isfile(n2v_file):
-            raise Exception(f"No node2vec emb was found at {n2v_file}.")
+        for i, instance_dir in enumerate(paths):
+            # Get instance's filename
+            instance_filename = dimacs_stem(instance_dir)
         
-        # n2v experiment path + name
-        n2v_exp_path = os.path.join(n2v_exp_name, str(n2v_dim), instance_filename)
+            # n2v experiment path + name
+            n2v_exp_path = os.path.join(n2v_exp_name, str(n2v_dim), instance_filename)
          
-        # pg_solver experiment path + name
-        n, m, _ = utils.dimacs2list(instance_dir)
-        exp_path = f'{pg_exp_name}/{n:04d}/{m:04d}/{instance_filename}'
+            # pg_solver experiment path + name
+            n, m, _ = utils.dimacs2list(instance_dir)
+            exp_path = f'{pg_exp_name}/{n:04d}/{m:04d}/{instance_filename}'
         
-        # Run the hyperparameters search for this instance
-        torch.cuda.empty_cache()
-        pg_hypersearch(instance_dir,
-                    n2v_exp_name = n2v_exp_path,
-                    n2v_dir = os.path.abspath(n2v_dir),
-                    num_samples=((2*n)+m)*128,
-                    batch_size=pg_batch_size,
-                    exp_name=exp_path,
-                    raytune_trials=pg_raytune_trials,
-                    raytune_dir=raytune_dir,
-                    grace_period=((2*n)+m)*4,
-                    scheduler_max_t=((2*n)+m)*64,
-                    resources_per_trial=pg_resources_per_trial)
+            # Run the hyperparameters search for this instance
+            torch.cuda.empty_cache()
+            pg_hypersearch(instance_dir,
+                        n2v_exp_name = n2v_exp_path,
+                        n2v_dir = os.path.abspath(n2v_dir),
+                        num_samples=((2*n)+m)*128,
+                        batch_size=pg_batch_size,
+                        exp_name=exp_path,
+                        raytune_trials=pg_raytune_trials,
+                        raytune_dir=raytune_dir,
+                        grace_period=((2*n)+m)*4,
+                        scheduler_max_t=((2*n)+m)*64,
+                        resources_per_trial=pg_resources_per_trial)
@@ -16,7 +16,10 @@ class Baseline(nn.Module):
 
 class RolloutBaseline(Baseline):
     """Computes greedy rollout if 'num_rollouts' is -1 or sampled rollout
-    if 'num_rollout' > 0."""
+    if 'num_rollout' > 0.
+    
+    `formula` can be a list in CNF or a formula compiled with `build_evaluator`;
+    the latter avoids compiling the formula at every call."""
     def __init__(self, num_rollouts=-1, temperature=1, *args, **kwargs):
         super().__init__()
         if (type(num_rollouts) != int) or (num_rollouts < -1) or (num_rollouts == 0):
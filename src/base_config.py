@@ -12,7 +12,8 @@ def get_config(new_config=None):
         config = {
             # Encoder
             "node2vec": False,  # (bool).
-            "n2v_dir": "n2v_emb",  # (str).
+            "n2v_dir": "n2v_emb",  # (str). Folder of the node2vec embedding cache (see src/n2v_cache.py).
+            "n2v_cache_mb": 4096,  # (float >= 0). Size cap of the embedding cache; least recently used embeddings are evicted. 0 for no cap.
             "n2v_dim": 64,  # (int).
             "n2v_pretrained": True,  # (bool).
             "n2v_walk_len": 10,  # (int).
@@ -70,13 +71,21 @@ def get_config(new_config=None):
 
             # Misc
             "sat_stopping": True,  # (bool). Stop when num_sat is equal with the num of clauses.
+            "reward_cache_mb": 64,  # (float >= 0). Memory cap of the reward cache. 0 disables it.
+            "eval_workers": 0,  # (int >= 0). Processes sharing clause evaluation of large formulas. 0 for none.
             "log_interval": 100,  # (int).
             "eval_interval": 200,  # (int).
             "eval_strategies": [32],  # (int). 0 for greedy search, k >= 1 for k samples.
             "tensorboard_on": True,  # (bool).
             "extra_logging": False,  # (bool). Log Trainable state's weights.
             "raytune": False,  # (bool).
-            "data_dir": None,  # (str).
+            "data_dir": None,  # (str). DIMACS file or "shard://<shard_dir>#<name>" instance.
+            "stream": None,  # (dict). Generator of the instances to train on instead of data_dir, e.g. {"generator": "UR", "min_n": 50, "max_n": 50}.
+            "stream_workers": 2,  # (int >= 0). Processes generating the streamed instances. 0 generates them in the training process.
+            "stream_queue_size": 64,  # (int). Maximum number of generated instances waiting to be trained on.
+            "stream_seed": None,  # (int). Seed of the streamed instances.
+            "stream_instances": 1000,  # (int). Number of streamed instances.
+            "stream_episodes": 1,  # (int). Episodes per streamed instance.
             "verbose": 1,  # (int). {0, 1, 2}. If raytune is True, then verbose is set to 0.
 
             "log_dir": 'logs',  # (str).
@@ -93,6 +102,7 @@ def get_config(new_config=None):
         # Delete unused entries
         if not config["node2vec"]:
             del config["n2v_dir"]
+            del config["n2v_cache_mb"]
             del config["n2v_dim"]
             del config["n2v_pretrained"]
             del config["n2v_walk_len"]
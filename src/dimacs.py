@@ -0,0 +1,419 @@
+import numpy as np
+
+import bz2
+import gzip
+import hashlib
+import lzma
+import os
+import re
+import warnings
+
+
+# Supported compressions: extension -> (module, magic bytes at the start of the file).
+COMPRESSIONS = {'.gz': (gzip, b'\x1f\x8b'),
+                '.xz': (lzma, b'\xfd7zXZ\x00'),
+                '.bz2': (bz2, b'BZh')}
+
+
+def _compression(dimacs_path, mode):
+    "Returns the compression extension of a file, or None."
+    ext = os.path.splitext(dimacs_path)[1].lower()
+    if ext in COMPRESSIONS:
+        return ext
+    if 'r' in mode:
+        # Compressed files without the extension are recognized by their magic bytes.
+        with open(dimacs_path, 'rb') as f:
+            start = f.read(6)
+        for ext, (_, magic) in COMPRESSIONS.items():
+            if start.startswith(magic):
+                return ext
+    return None
+
+
+def open_dimacs(dimacs_path, mode='r'):
+    '''Opens a DIMACS file (in text mode unless `mode` contains 'b'), decompressing
+    or compressing on the fly.
+
+    Compression is detected from the extension (.gz, .xz or .bz2) and, when
+    reading, also from the magic bytes of the file.
+    '''
+    ext = _compression(dimacs_path, mode)
+    if ext is None:
+        return open(dimacs_path, mode)
+    module = COMPRESSIONS[ext][0]
+    if 'b' not in mode:
+        mode = mode.replace('t', '') + 't'
+    return module.open(dimacs_path, mode)
+
+
+def dimacs_stem(dimacs_path):
+    '''File name of an instance without directories, compression and .cnf extensions;
+    e.g.: 'data/rand_i=01.cnf.gz' -> 'rand_i=01'.'''
+    stem = os.path.split(dimacs_path)[1]
+    root, ext = os.path.splitext(stem)
+    if ext.lower() in COMPRESSIONS:
+        stem = root
+    return os.path.splitext(stem)[0]
+
+
+# Comment ('c') and problem ('p') lines, removed before tokenizing the clauses.
+_COMMENT_OR_HEADER = re.compile(r'^[ \t]*[cp].*$', flags=re.MULTILINE)
+_HEADER = re.compile(r'^[ \t]*p[ \t]+cnf[ \t]+(\d+)[ \t]+(\d+)', flags=re.MULTILINE)
+# The '%' line that ends the formula in the SATLIB files (and in the files written by sat_generator.py).
+_END = re.compile(r'^[ \t]*%', flags=re.MULTILINE)
+
+
+def _tokenize(body):
+    "Converts whitespace-separated integers into an int64 array in bulk."
+    if not body.strip():
+        # np.fromstring reads a blank string as [0].
+        return np.zeros(0, dtype=np.int64)
+    with warnings.catch_warnings():
+        # np.fromstring only warns when it cannot read the whole string.
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            return np.fromstring(body, dtype=np.int64, sep=' ')
+        except DeprecationWarning:
+            # Slower path, raises a ValueError that points to the bad token.
+            return np.array(body.split(), dtype=np.int64)
+
+
+def parse_dimacs(dimacs):
+    '''Parses the text of a DIMACS file into a flat literal array plus clause offsets.
+
+    Comments, blank lines, the '%' terminator and clauses that span several
+    lines are supported. A last clause without its terminating 0 is kept.
+
+        Args:
+            dimacs (str): content of the DIMACS file.
+        Returns:
+            n (int): Number of variables in the formula (from the 'p cnf' line).
+            m (int): Number of clauses in the formula (from the 'p cnf' line).
+            literals (ndarray): int32 array with the literals of every clause, one after another.
+            offsets (ndarray): int64 array with shape [num_clauses+1]. Clause c is literals[offsets[c]:offsets[c+1]].
+    '''
+    end = _END.search(dimacs)
+    if end is not None:
+        dimacs = dimacs[:end.start()]
+
+    header = _HEADER.search(dimacs)
+    if header is None:
+        raise ValueError("No 'p cnf <n> <m>' line was found.")
+    n, m = int(header.group(1)), int(header.group(2))
+
+    tokens = _tokenize(_COMMENT_OR_HEADER.sub('', dimacs))
+    zeros = np.flatnonzero(tokens == 0)
+    literals = tokens[tokens != 0].astype(np.int32)
+
+    # The i-th 0 closes a clause that ends at position zeros[i] - i of the literal array.
+    ends = zeros - np.arange(len(zeros))
+    if len(literals) > (ends[-1] if len(ends) > 0 else 0):
+        ends = np.append(ends, len(literals))
+    offsets = np.zeros(len(ends) + 1, dtype=np.int64)
+    offsets[1:] = ends
+    return n, m, literals, offsets
+
+
+def _mix64(x):
+    "splitmix64 finalizer: spreads the bits of uint64 values (wraps around on overflow)."
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return x ^ (x >> np.uint64(31))
+
+
+def clause_hashes(literals, offsets):
+    '''64-bit hash of every clause of a flat formula, as the set of its literals (the order
+    and the repetitions of the literals do not matter). Returns a uint64 array with shape [m].'''
+    literals = np.asarray(literals, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    num_clauses = len(offsets) - 1
+    clause_idx = np.repeat(np.arange(num_clauses), np.diff(offsets))
+
+    # Sort the literals of every clause and drop the repeated ones, using a single
+    # (clause, literal) sort key.
+    shift = int(np.abs(literals).max()) if len(literals) > 0 else 0
+    keys = np.sort(clause_idx * (2 * shift + 1) + (literals + shift))
+    keys = keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) > 0 else keys
+    clause_idx, literals = np.divmod(keys, 2 * shift + 1)
+    literals -= shift
+
+    # A clause hash is a mix of the sum of the hashes of its literals (order-independent).
+    with np.errstate(over='ignore'):
+        lit_hashes = _mix64(literals.astype(np.uint64) + np.uint64(0x9e3779b97f4a7c15))
+    sums = np.zeros(num_clauses, dtype=np.uint64)
+    if len(keys) > 0:
+        # The literals are grouped by clause; empty clauses keep a sum of 0.
+        starts = np.flatnonzero(np.r_[True, clause_idx[1:] != clause_idx[:-1]])
+        sums[clause_idx[starts]] = np.add.reduceat(lit_hashes, starts)
+    sizes = np.bincount(clause_idx, minlength=num_clauses).astype(np.uint64)
+    return _mix64(sums ^ _mix64(sizes))
+
+
+def combine_clause_hashes(n, hashes):
+    "Fingerprint of a formula from the `clause_hashes` of all its clauses, in any order."
+    hashes = np.sort(np.asarray(hashes, dtype=np.uint64))
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.array([n, len(hashes)], dtype='<i8').tobytes())
+    digest.update(hashes.astype('<u8').tobytes())
+    return digest.hexdigest()
+
+
+def fingerprint(n, literals, offsets):
+    '''Canonical identity of a formula: the same for formulas that only differ in the
+    order of their clauses, the order of the literals of a clause or repeated literals
+    inside a clause. Repeated clauses count, as they change the number of satisfied clauses.
+
+    Every clause is hashed as the set of its literals (see `clause_hashes`) and the
+    sorted clause hashes are hashed together with n. Returns a 32-character hex string.
+    '''
+    return combine_clause_hashes(n, clause_hashes(literals, offsets))
+
+
+def dimacs2flat(dimacs_path):
+    '''Reads a cnf file (optionally compressed, see `open_dimacs`) and returns the CNF
+    formula as a flat literal array plus clause offsets. See `parse_dimacs`.'''
+    with open_dimacs(dimacs_path, 'r') as f:
+        dimacs = f.read()
+    return parse_dimacs(dimacs)
+
+
+def _split_clauses(tokens):
+    """Splits a token array at its zeros. Returns the literals and offsets of the
+    complete clauses, plus the tokens of the last, still unterminated, clause."""
+    zeros = np.flatnonzero(tokens == 0)
+    if len(zeros) == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64), tokens
+    rest = tokens[zeros[-1] + 1:]
+    complete = tokens[:zeros[-1] + 1]
+    literals = complete[complete != 0].astype(np.int32)
+    offsets = np.zeros(len(zeros) + 1, dtype=np.int64)
+    offsets[1:] = zeros - np.arange(len(zeros))
+    return literals, offsets, rest
+
+
+def iter_dimacs(dimacs_path, block_size=100000, buffer_size=1 << 20):
+    '''Reads a cnf file incrementally and yields its clauses in blocks.
+    Compressed files are decompressed while they are read (see `open_dimacs`).
+
+    The file is read through a fixed-size buffer and tokenized in bulk, so the peak
+    memory depends on `buffer_size` and `block_size`, not on the size of the formula.
+
+        Args:
+            dimacs_path (str): path to the DIMACS file.
+            block_size (int): maximum number of clauses per block.
+            buffer_size (int): number of characters read from the file at a time.
+        Yields:
+            literals (ndarray): int32 literals of the clauses of the block.
+            offsets (ndarray): int64 clause offsets of the block, starting at 0.
+
+    Use `dimacs_header` to get the number of variables and clauses.
+    '''
+    n = m = None
+    pending = np.zeros(0, dtype=np.int64)  # Tokens of a clause that continues in the next chunk.
+    block_literals, block_offsets, num_block_clauses = [], [], 0
+
+    def flush():
+        literals = np.concatenate(block_literals) if block_literals else np.zeros(0, dtype=np.int32)
+        offsets = np.zeros(num_block_clauses + 1, dtype=np.int64)
+        start, base = 1, 0
+        for block in block_offsets:
+            offsets[start:start + len(block) - 1] = block[1:] + base
+            start += len(block) - 1
+            base += block[-1]
+        return literals, offsets
+
+    with open_dimacs(dimacs_path, 'r') as f:
+        tail = ''
+        finished = False
+        while not finished:
+            chunk = f.read(buffer_size)
+            finished = (chunk == '')
+            text = tail + chunk
+            if not finished:
+                # Only complete lines are parsed; the rest waits for the next chunk.
+                cut = text.rfind('\n') + 1
+                text, tail = text[:cut], text[cut:]
+                if not text:
+                    continue
+
+            end = _END.search(text)
+            if end is not None:
+                text = text[:end.start()]
+                finished = True
+            if n is None:
+                header = _HEADER.search(text)
+                if header is not None:
+                    n, m = int(header.group(1)), int(header.group(2))
+
+            tokens = np.concatenate([pending, _tokenize(_COMMENT_OR_HEADER.sub('', text))])
+            if finished and len(tokens) > 0 and tokens[-1] != 0:
+                # A last clause without its terminating 0 is kept.
+                tokens = np.append(tokens, 0)
+            literals, offsets, pending = _split_clauses(tokens)
+            if n is None and len(literals) > 0:
+                raise ValueError("No 'p cnf <n> <m>' line was found before the clauses.")
+
+            # Emit full blocks of `block_size` clauses.
+            start = 0
+            num_clauses = len(offsets) - 1
+            while start < num_clauses:
+                take = min(block_size - num_block_clauses, num_clauses - start)
+                piece = offsets[start:start + take + 1]
+                block_literals.append(literals[piece[0]:piece[-1]])
+                block_offsets.append(piece - piece[0])
+                num_block_clauses += take
+                start += take
+                if num_block_clauses == block_size:
+                    yield flush()
+                    block_literals, block_offsets, num_block_clauses = [], [], 0
+
+    if n is None:
+        raise ValueError("No 'p cnf <n> <m>' line was found.")
+    if num_block_clauses > 0:
+        yield flush()
+
+
+def dimacs_header(dimacs_path):
+    '''Returns the number of variables and clauses of the 'p cnf' line of a cnf file,
+    reading only up to that line.'''
+    with open_dimacs(dimacs_path, 'r') as f:
+        for line in f:
+            header = _HEADER.match(line)
+            if header is not None:
+                return int(header.group(1)), int(header.group(2))
+    raise ValueError("No 'p cnf <n> <m>' line was found.")
+
+
+def concat_blocks(blocks):
+    '''Concatenates (literals, offsets) blocks into a single flat formula.'''
+    literals, offsets, base = [], [np.zeros(1, dtype=np.int64)], 0
+    for block_literals, block_offsets in blocks:
+        literals.append(block_literals)
+        offsets.append(block_offsets[1:] + base)
+        base += block_offsets[-1]
+    literals = np.concatenate(literals) if literals else np.zeros(0, dtype=np.int32)
+    return literals, np.concatenate(offsets)
+
+
+def var_counts(blocks, num_variables):
+    '''Counts the number of times each variable appears in a formula given as
+    (literals, offsets) blocks. Returns an int64 array with shape [num_variables].'''
+    counts = np.zeros(num_variables, dtype=np.int64)
+    for literals, _ in blocks:
+        # -1 because DIMACS format starts indexing variables from 1.
+        counts += np.bincount(np.abs(literals) - 1, minlength=num_variables)[:num_variables]
+    return counts
+
+
+def flat2list(literals, offsets):
+    '''List-of-lists view of a flat formula, e.g.: [[1, -2], [2, 3, -1]].'''
+    literals = literals.tolist()
+    bounds = offsets.tolist()
+    return [literals[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _format_rows(literals, offsets):
+    """Formats a flat formula as DIMACS text without any Python loop over the literals.
+
+    Every literal and every clause terminator gets a row of a uint8 matrix:
+    [sign, digits..., ' '] for literals (zero bytes for the missing sign and
+    leading zeros) and '0\\n' for terminators. Removing the zero bytes leaves the
+    text. Returns the text and the end (in bytes) of every clause."""
+    literals = np.asarray(literals, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    num_clauses, num_literals = len(offsets) - 1, len(literals)
+    values = np.abs(literals)
+    width = len(str(int(values.max()))) if num_literals > 0 else 1
+
+    # The literals of clause c are shifted by c rows to leave room for the terminators.
+    positions = np.arange(num_literals) + np.repeat(np.arange(num_clauses), np.diff(offsets))
+    terminators = offsets[1:] + np.arange(num_clauses)
+    rows = np.zeros((num_literals + num_clauses, width + 2), dtype=np.uint8)
+
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    digits = (values[:, None] // powers) % 10
+    significant = values[:, None] >= powers
+    significant[:, -1] = True  # Keep the last digit of 0.
+    rows[positions, 0] = np.where(literals < 0, ord('-'), 0)
+    rows[positions, 1:-1] = np.where(significant, digits + ord('0'), 0)
+    rows[positions, -1] = ord(' ')
+    rows[terminators, 0] = ord('0')
+    rows[terminators, 1] = ord('\n')
+
+    kept = rows != 0
+    clause_ends = np.cumsum(kept.sum(axis=1))[terminators] if num_clauses > 0 else np.zeros(0, dtype=np.int64)
+    return rows[kept].tobytes(), clause_ends
+
+
+def format_clauses(literals, offsets):
+    '''Formats the clauses of a flat formula as DIMACS text, e.g.: b'1 -2 0\\n2 3 -1 0\\n'.
+    The output is the same as writing f"{literal} " for each literal and "0\\n" after each clause.'''
+    return _format_rows(literals, offsets)[0]
+
+
+def write_dimacs(dimacs_path, n, literals, offsets, m=None, block_size=100000):
+    '''Writes a flat formula to a DIMACS file, ending with the '%' line of the SATLIB
+    files. The clauses are formatted in blocks of `block_size` clauses and written
+    with one call per block. The file is compressed as `open_dimacs` does.
+
+        Args:
+            dimacs_path (str): path of the file.
+            n (int): number of variables.
+            literals (ndarray): literals of every clause, one after another.
+            offsets (ndarray): clause offsets with shape [num_clauses+1].
+            m (int): number of clauses of the 'p cnf' line; by default, len(offsets)-1.
+    '''
+    num_clauses = len(offsets) - 1
+    m = num_clauses if m is None else m
+    with open_dimacs(dimacs_path, 'wb') as f:
+        f.write(f"p cnf {n} {m}\n".encode())
+        for start in range(0, num_clauses, block_size):
+            block = np.asarray(offsets[start:min(start + block_size, num_clauses) + 1])
+            f.write(format_clauses(literals[block[0]:block[-1]], block - block[0]))
+        f.write(b"%")
+
+
+def write_dimacs_batch(instances, block_size=100000):
+    '''Writes many flat formulas at once. Small formulas are grouped up to `block_size`
+    clauses and all the clauses of a group are formatted in a single pass (see
+    `format_clauses`), then split into one write per file. Formulas with more than
+    `block_size` clauses are written by `write_dimacs`, block by block, so the memory
+    used never grows beyond a block.
+
+        Args:
+            instances (list): (dimacs_path, n, literals, offsets) tuples.
+    '''
+    group, group_clauses = [], 0
+    for dimacs_path, n, literals, offsets in instances:
+        num_clauses = len(offsets) - 1
+        if num_clauses > block_size:
+            write_dimacs(dimacs_path, n, literals, offsets, block_size=block_size)
+            continue
+        if group and (group_clauses + num_clauses > block_size):
+            _write_group(group)
+            group, group_clauses = [], 0
+        group.append((dimacs_path, n, literals, offsets))
+        group_clauses += num_clauses
+    if group:
+        _write_group(group)
+
+
+def _write_group(instances):
+    "Writes (dimacs_path, n, literals, offsets) formulas formatting all their clauses in a single pass."
+    literals = np.concatenate([np.asarray(lits, dtype=np.int64) for _, _, lits, _ in instances])
+    offsets, base = [np.zeros(1, dtype=np.int64)], 0
+    for _, _, lits, offs in instances:
+        offsets.append(np.asarray(offs[1:], dtype=np.int64) + base)
+        base += len(lits)
+    text, clause_ends = _format_rows(literals, np.concatenate(offsets))
+
+    start, first_clause = 0, 0
+    for dimacs_path, n, _, offs in instances:
+        num_clauses = len(offs) - 1
+        end = clause_ends[first_clause + num_clauses - 1] if num_clauses > 0 else start
+        with open_dimacs(dimacs_path, 'wb') as f:
+            f.write(f"p cnf {n} {num_clauses}\n".encode())
+            f.write(text[start:end])
+            f.write(b"%")
+        start, first_clause = end, first_clause + num_clauses
@@ -0,0 +1,510 @@
+import torch
+import numpy as np
+
+from collections import OrderedDict
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+
+
+def flatten_formula(formula):
+    """Flattens a CNF formula into a literal array plus clause offsets.
+
+    Arguments
+    ---------
+    -formula (list or tuple): A SAT formula in CNF; e.g.: [[1, -2], [2, 3, -1]],
+                or an already flat (literals, offsets) tuple.
+
+    Returns
+    -------
+    -literals (ndarray): int64 array with the literals of every clause, one after another.
+    -offsets (ndarray): int64 array with shape [m+1]. Clause c is literals[offsets[c]:offsets[c+1]].
+    """
+    if isinstance(formula, tuple):
+        literals, offsets = formula
+        return np.asarray(literals, dtype=np.int64), np.asarray(offsets, dtype=np.int64)
+    lengths = np.fromiter((len(clause) for clause in formula), dtype=np.int64, count=len(formula))
+    offsets = np.zeros(len(formula) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    literals = np.fromiter((literal for clause in formula for literal in clause), dtype=np.int64, count=offsets[-1])
+    return literals, offsets
+
+
+class BaseEvaluator():
+    """The base class for all clause evaluators.
+
+    An evaluator compiles a CNF formula once and then evaluates batches of
+    assignments, given as tensors with shape [batch_size, num_variables].
+    """
+    def __init__(self, formula, num_variables=None):
+        self.literals, self.offsets = flatten_formula(formula)
+        if num_variables is None:
+            num_variables = int(np.abs(self.literals).max()) if len(self.literals) > 0 else 0
+        self.num_variables = num_variables
+        self.num_clauses = len(self.offsets) - 1
+        self.num_literals = len(self.literals)
+
+    def clause_sat(self, assignment):
+        "Returns a bool tensor with shape [batch_size, num_clauses]."
+        raise NotImplementedError
+
+    def num_sat(self, assignment):
+        '''Counts the number of clauses that every assignment in the batch satisfies.
+        Returns a float tensor with shape [batch_size].
+        '''
+        return self.clause_sat(assignment).sum(dim=-1).to(dtype=float)
+
+    def unsat_clauses(self, assignment):
+        '''Evaluates every clause for every assignment of the batch in one pass.
+
+        Returns
+        -------
+        -clause_sat (tensor): Bool tensor with shape [batch_size, num_clauses].
+        -unsat_idx (tensor): Indices of the unsatisfied clauses of every assignment,
+                    concatenated in batch order; shape [total_num_unsat].
+        -unsat_offsets (tensor): Shape [batch_size+1]. The unsatisfied clauses of
+                    assignment b are unsat_idx[unsat_offsets[b]:unsat_offsets[b+1]].
+        '''
+        clause_sat = self.clause_sat(assignment)
+        unsat = ~clause_sat
+        unsat_idx = unsat.nonzero()[:, 1]
+        unsat_offsets = torch.zeros(clause_sat.shape[0] + 1, dtype=torch.int64, device=clause_sat.device)
+        torch.cumsum(unsat.sum(dim=-1), dim=0, out=unsat_offsets[1:])
+        return clause_sat, unsat_idx, unsat_offsets
+
+    def _check(self, assignment):
+        if not torch.is_tensor(assignment):
+            assignment = torch.as_tensor(np.asarray(assignment))
+        if assignment.dim() == 1:
+            assignment = assignment.unsqueeze(0)
+        if assignment.shape[-1] != self.num_variables:
+            raise ValueError(f"'assignment' must be a tensor with shape [batch_size, {self.num_variables}], got {tuple(assignment.shape)}.")
+        return assignment.bool()
+
+
+class PaddedEvaluator(BaseEvaluator):
+    """Evaluates clauses from padded [num_clauses, max_clause_len] literal-index
+    and sign tensors, so that a whole batch is evaluated with a single gather/any/sum.
+
+    Short clauses are padded by repeating their first literal, which leaves their
+    value unchanged and avoids a padding mask.
+    """
+    def __init__(self, formula, num_variables=None):
+        super().__init__(formula, num_variables)
+        lengths = np.diff(self.offsets)
+        max_len = int(lengths.max()) if self.num_clauses > 0 else 0
+
+        # Position of every padded slot inside the flat literal array.
+        slot = np.arange(max_len)[None, :]
+        idx = self.offsets[:-1, None] + np.where(slot < lengths[:, None], slot, 0)
+        # Empty clauses point past the end of the array; clamp them, nonempty masks them out.
+        idx = np.minimum(idx, max(self.num_literals - 1, 0))
+        padded = self.literals[idx] if self.num_literals > 0 else np.ones_like(idx)
+
+        self.var_idx = torch.from_numpy(np.abs(padded) - 1)  # -1 because DIMACS format starts indexing variables from 1.
+        # ::var_idx:: [num_clauses, max_clause_len]
+        self.sign = torch.from_numpy(padded > 0)
+        # ::sign:: [num_clauses, max_clause_len]
+        self.nonempty = torch.from_numpy(lengths > 0)
+        # ::nonempty:: [num_clauses]
+        self._device_cache = {}
+
+    def _tensors(self, device):
+        device = torch.device(device)
+        if device not in self._device_cache:
+            self._device_cache[device] = (self.var_idx.to(device), self.sign.to(device), self.nonempty.to(device))
+        return self._device_cache[device]
+
+    def clause_sat(self, assignment):
+        assignment = self._check(assignment)
+        var_idx, sign, nonempty = self._tensors(assignment.device)
+        values = assignment[:, var_idx]
+        # ::values:: [batch_size, num_clauses, max_clause_len]
+        return (values == sign).any(dim=-1) & nonempty
+        # ::clause_sat:: [batch_size, num_clauses]
+
+
+class CSREvaluator(BaseEvaluator):
+    """Evaluates clauses from the flat literal array plus clause offsets (CSR).
+
+    Every literal is evaluated once and the per-clause number of true literals is
+    obtained with a segment reduction, so the cost is proportional to the true
+    number of literals even when a few clauses are very long (e.g.: SR instances).
+    """
+    def __init__(self, formula, num_variables=None):
+        super().__init__(formula, num_variables)
+        self.var_idx = torch.from_numpy(np.abs(self.literals) - 1)  # -1 because DIMACS format starts indexing variables from 1.
+        # ::var_idx:: [num_literals]
+        self.sign = torch.from_numpy(self.literals > 0)
+        # ::sign:: [num_literals]
+        self.clause_idx = torch.from_numpy(np.repeat(np.arange(self.num_clauses), np.diff(self.offsets)))
+        # ::clause_idx:: [num_literals]
+        self._device_cache = {}
+
+    def _tensors(self, device):
+        device = torch.device(device)
+        if device not in self._device_cache:
+            self._device_cache[device] = (self.var_idx.to(device), self.sign.to(device), self.clause_idx.to(device))
+        return self._device_cache[device]
+
+    def true_counts(self, assignment):
+        """Returns the number of true literals of every clause as an int32 tensor
+        with shape [batch_size, num_clauses]."""
+        assignment = self._check(assignment)
+        var_idx, sign, clause_idx = self._tensors(assignment.device)
+        lit_true = (assignment[:, var_idx] == sign).to(dtype=torch.int32)
+        # ::lit_true:: [batch_size, num_literals]
+        counts = torch.zeros(assignment.shape[0], self.num_clauses, dtype=torch.int32, device=assignment.device)
+        return counts.index_add_(1, clause_idx, lit_true)
+        # ::counts:: [batch_size, num_clauses]
+
+    def clause_sat(self, assignment):
+        return self.true_counts(assignment) > 0
+        # ::clause_sat:: [batch_size, num_clauses]
+
+
+class BitPackedEvaluator(BaseEvaluator):
+    """Evaluates large batches with assignments packed 64 per uint64 word along the
+    batch axis.
+
+    Each literal becomes a packed column (negated if the literal is negative) and
+    each clause is the bitwise OR of its literals' columns, so a single word
+    operation evaluates 64 assignments at once. Batches smaller than `min_batch`
+    or assignments that live on an accelerator are sent to `fallback`.
+    """
+    def __init__(self, formula, num_variables=None, fallback=None, min_batch=32):
+        super().__init__(formula, num_variables)
+        self.var_idx = np.abs(self.literals) - 1  # -1 because DIMACS format starts indexing variables from 1.
+        self.negative = self.literals < 0
+        lengths = np.diff(self.offsets)
+        self.nonempty = lengths > 0
+        self.starts = self.offsets[:-1]
+        self.fallback = fallback
+        self.min_batch = min_batch
+
+    def _use_fallback(self, assignment):
+        if self.fallback is None:
+            return False
+        on_cpu = (not torch.is_tensor(assignment)) or (assignment.device.type == 'cpu')
+        return (not on_cpu) or (len(assignment) < self.min_batch)
+
+    def pack(self, assignment):
+        """Packs a [batch_size, num_variables] assignment into a uint64 array
+        with shape [num_variables, ceil(batch_size/64)]."""
+        values = self._check(assignment).cpu().numpy()
+        packed = np.packbits(values.T, axis=1, bitorder='little')
+        num_words = -(-values.shape[0] // 64)
+        packed = np.pad(packed, ((0, 0), (0, num_words * 8 - packed.shape[1])))
+        return np.ascontiguousarray(packed).view(np.uint64)
+
+    def packed_clause_sat(self, assignment):
+        """Returns a uint64 array with shape [num_clauses, ceil(batch_size/64)]
+        whose bit b of clause c is set if assignment b satisfies clause c."""
+        packed = self.pack(assignment)
+        if self.num_clauses == 0:
+            return np.zeros((0, packed.shape[1]), dtype=np.uint64)
+        # An extra all-zero row keeps every start index valid for np.bitwise_or.reduceat,
+        # empty clauses are masked out afterwards.
+        columns = np.zeros((self.num_literals + 1, packed.shape[1]), dtype=np.uint64)
+        columns[:-1] = packed[self.var_idx]
+        columns[:-1][self.negative] = ~columns[:-1][self.negative]
+        # ::columns:: [num_literals+1, num_words]
+        words = np.bitwise_or.reduceat(columns, self.starts, axis=0)
+        words[~self.nonempty] = 0
+        return words
+
+    def clause_sat(self, assignment):
+        if self._use_fallback(assignment):
+            return self.fallback.clause_sat(assignment)
+        batch_size = len(assignment)
+        words = self.packed_clause_sat(assignment)
+        bits = np.unpackbits(words.view(np.uint8), axis=1, count=batch_size, bitorder='little')
+        # ::bits:: [num_clauses, batch_size]
+        sat = torch.from_numpy(bits.T.astype(bool))
+        if torch.is_tensor(assignment):
+            sat = sat.to(assignment.device)
+        return sat
+        # ::clause_sat:: [batch_size, num_clauses]
+
+    def num_sat(self, assignment):
+        if self._use_fallback(assignment):
+            return self.fallback.num_sat(assignment)
+        batch_size = len(assignment)
+        planes = _vertical_count(self.packed_clause_sat(assignment))
+        # ::planes:: [num_count_bits, num_words]. Bit b of plane k is bit k of the num_sat of assignment b.
+        bits = np.unpackbits(planes.view(np.uint8), axis=1, count=batch_size, bitorder='little')
+        weights = np.left_shift(1, np.arange(len(planes), dtype=np.int64))
+        num_sat = torch.from_numpy((weights @ bits).astype(np.float64))
+        if torch.is_tensor(assignment):
+            num_sat = num_sat.to(assignment.device)
+        return num_sat
+        # ::num_sat:: [batch_size]
+
+
+class CachedEvaluator(BaseEvaluator):
+    """Wraps an evaluator with an LRU cache of assignment -> num_sat.
+
+    Every batch is deduplicated first, and only the assignments that are neither
+    repeated inside the batch nor cached from a previous call are evaluated.
+    Assignments are keyed by their bit-packed bytes. `hits` counts the samples
+    whose reward was not recomputed and `misses` the ones that were evaluated.
+
+    Arguments
+    ---------
+    -evaluator (BaseEvaluator): The evaluator used on cache misses.
+    -max_mb (float): Approximate memory cap of the cache, in MiB.
+    """
+    # Approximate memory used by an entry on top of its packed key (dict slot, bytes and float objects).
+    ENTRY_OVERHEAD = 160
+
+    def __init__(self, evaluator, max_mb=64):
+        self.evaluator = evaluator
+        self.num_variables = evaluator.num_variables
+        self.num_clauses = evaluator.num_clauses
+        self.num_literals = evaluator.num_literals
+        entry_bytes = -(-self.num_variables // 8) + self.ENTRY_OVERHEAD
+        self.max_entries = max(int(max_mb * 2**20) // entry_bytes, 0)
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clause_sat(self, assignment):
+        return self.evaluator.clause_sat(assignment)
+
+    def num_sat(self, assignment):
+        assignment = self._check(assignment)
+        unique, inverse = torch.unique(assignment.to(dtype=torch.uint8), dim=0, return_inverse=True)
+        keys = np.packbits(unique.cpu().numpy(), axis=1)
+
+        values = np.empty(len(unique), dtype=np.float64)
+        missing = []
+        for i, key in enumerate(keys):
+            key = key.tobytes()
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                values[i] = self.cache[key]
+            else:
+                missing.append(i)
+
+        if missing:
+            missing = torch.tensor(missing, device=unique.device)
+            values[missing.cpu().numpy()] = self.evaluator.num_sat(unique[missing]).cpu().numpy()
+            if self.max_entries > 0:
+                for i in missing.tolist():
+                    self.cache[keys[i].tobytes()] = values[i]
+                while len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+
+        self.misses += len(missing)
+        self.hits += assignment.shape[0] - len(missing)
+        return torch.from_numpy(values).to(assignment.device)[inverse]
+        # ::num_sat:: [batch_size]
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+# Shared-memory blocks attached by the current worker process, by name.
+_worker_arrays = {}
+
+
+def _attach(name, dtype, shape):
+    "Returns a numpy view of a shared-memory block, attaching it only once per process."
+    if name not in _worker_arrays:
+        shm = shared_memory.SharedMemory(name=name)
+        _worker_arrays[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return _worker_arrays[name][1]
+
+
+def _detach(keep):
+    "Closes the blocks attached by this worker that are not in `keep`."
+    for name in [name for name in _worker_arrays if name not in keep]:
+        shm, _ = _worker_arrays.pop(name)
+        shm.close()
+
+
+def _chunk_clause_sat(formula_specs, assignment_spec, start, end):
+    """Evaluates clauses [start, end) of the shared formula for the shared assignment.
+    Returns a bool array with shape [batch_size, end-start]."""
+    _detach(keep={spec[0] for spec in formula_specs} | {assignment_spec[0]})
+    var_idx, sign, offsets = (_attach(*spec) for spec in formula_specs)
+    assignment = _attach(*assignment_spec)
+    lo, hi = offsets[start], offsets[end]
+    lit_true = np.zeros((assignment.shape[0], hi - lo + 1), dtype=bool)
+    lit_true[:, :-1] = assignment[:, var_idx[lo:hi]] == sign[lo:hi]
+    # The extra False column keeps every start index valid for reduceat.
+    sat = np.logical_or.reduceat(lit_true, offsets[start:end] - lo, axis=1)
+    sat[:, offsets[start:end] == offsets[start + 1:end + 1]] = False
+    return sat
+
+
+def _chunk_num_sat(formula_specs, assignment_spec, start, end):
+    "Partial num_sat of clauses [start, end), with shape [batch_size]."
+    return _chunk_clause_sat(formula_specs, assignment_spec, start, end).sum(axis=1)
+
+
+class SharedMemoryEvaluator(BaseEvaluator):
+    """Splits clause evaluation across a persistent pool of worker processes.
+
+    The compiled formula (literal variables, signs and clause offsets) is placed
+    once in shared memory, so workers do not hold their own copy. Each call
+    writes the assignment batch to another shared block, every worker evaluates
+    a range of clauses, and the per-chunk num_sat partial sums are reduced in
+    the main process. Meant for formulas with hundreds of thousands of clauses;
+    call close() (or use it as a context manager) to stop the workers.
+
+    Arguments
+    ---------
+    -num_workers (int): Number of worker processes. Default: os.cpu_count().
+    -chunks_per_worker (int): Clause ranges per worker, to balance the load.
+    """
+    def __init__(self, formula, num_variables=None, num_workers=None, chunks_per_worker=4):
+        super().__init__(formula, num_variables)
+        self._blocks = []
+        self.formula_specs = [self._share(np.abs(self.literals).astype(np.int64) - 1),  # -1 because DIMACS format starts indexing variables from 1.
+                              self._share(self.literals > 0),
+                              self._share(self.offsets)]
+        self.assignment_spec = None
+
+        num_workers = num_workers or os.cpu_count()
+        num_chunks = max(min(num_workers * chunks_per_worker, self.num_clauses), 1)
+        bounds = np.linspace(0, self.num_clauses, num_chunks + 1).astype(np.int64)
+        self.ranges = [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+        self.pool = multiprocessing.Pool(num_workers)
+
+    def _share(self, array):
+        "Copies an array into a new shared-memory block and returns its (name, dtype, shape) spec."
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        self._blocks.append(shm)
+        return (shm.name, array.dtype.str, array.shape)
+
+    def _put_assignment(self, assignment):
+        values = self._check(assignment).cpu().numpy()
+        if self.assignment_spec is not None:
+            # Reuse the block while the batch shape does not change.
+            if self.assignment_spec[2] == values.shape:
+                np.ndarray(values.shape, dtype=values.dtype, buffer=self._blocks[-1].buf)[...] = values
+                return
+            old = self._blocks.pop()
+            old.close()
+            old.unlink()
+        self.assignment_spec = self._share(values)
+
+    def _map(self, func, assignment):
+        self._put_assignment(assignment)
+        args = [(self.formula_specs, self.assignment_spec, start, end) for start, end in self.ranges]
+        return self.pool.starmap(func, args)
+
+    def clause_sat(self, assignment):
+        chunks = self._map(_chunk_clause_sat, assignment)
+        sat = np.concatenate(chunks, axis=1) if chunks else np.zeros((len(assignment), 0), dtype=bool)
+        sat = torch.from_numpy(sat)
+        return sat.to(assignment.device) if torch.is_tensor(assignment) else sat
+        # ::clause_sat:: [batch_size, num_clauses]
+
+    def num_sat(self, assignment):
+        partial = self._map(_chunk_num_sat, assignment)
+        num_sat = torch.from_numpy(np.sum(partial, axis=0, dtype=np.float64) if partial else np.zeros(len(assignment)))
+        return num_sat.to(assignment.device) if torch.is_tensor(assignment) else num_sat
+        # ::num_sat:: [batch_size]
+
+    def close(self):
+        "Stops the workers and releases the shared memory."
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def _vertical_count(words):
+    """Bit-sliced column counts of an uint64 array with shape [num_rows, num_words].
+
+    Returns planes with shape [num_bits, num_words], where bit b of planes[k] is bit k
+    of the number of rows whose bit b is set. Rows are summed pairwise with bitwise
+    ripple-carry adders, so 64 counts are added per word operation.
+    """
+    planes = words[None]
+    # ::planes:: [num_bits, num_rows, num_words]
+    if planes.shape[1] == 0:
+        return np.zeros((1, words.shape[1]), dtype=np.uint64)
+    while planes.shape[1] > 1:
+        if planes.shape[1] % 2:
+            planes = np.concatenate([planes, np.zeros_like(planes[:, :1])], axis=1)
+        a, b = planes[:, 0::2], planes[:, 1::2]
+        total = np.empty((len(planes) + 1, *a.shape[1:]), dtype=np.uint64)
+        carry = np.zeros_like(a[0])
+        for k in range(len(planes)):
+            partial = a[k] ^ b[k]
+            total[k] = partial ^ carry
+            carry = (a[k] & b[k]) | (partial & carry)
+        total[-1] = carry
+        planes = total
+    return planes[:, 0]
+
+
+# The padded layout is used while it stores at most this many slots per real literal.
+PADDED_MAX_OVERHEAD = 1.5
+
+# CPU batches of at least this many assignments are evaluated bit-packed.
+BITPACKED_MIN_BATCH = 32
+
+
+def choose_layout(formula):
+    """Returns 'padded' if the clause lengths are homogeneous enough for the padded
+    layout to be cheap, else 'csr'."""
+    if isinstance(formula, tuple):
+        lengths = np.diff(formula[1])
+    else:
+        lengths = np.fromiter((len(clause) for clause in formula), dtype=np.int64, count=len(formula))
+    num_literals = lengths.sum()
+    if num_literals == 0:
+        return 'padded'
+    padded_size = len(lengths) * lengths.max()
+    return 'padded' if padded_size <= PADDED_MAX_OVERHEAD * num_literals else 'csr'
+
+
+def build_evaluator(formula, num_variables=None, layout='auto', bitpacked_min_batch=BITPACKED_MIN_BATCH):
+    """Compiles a CNF formula into an evaluator.
+
+    Arguments
+    ---------
+    -formula (list or tuple): A SAT formula in CNF, or flat (literals, offsets) arrays
+                such as the ones returned by `dimacs.dimacs2flat` or `dimacs.concat_blocks`.
+    -num_variables (int): Number of variables. If None, it is inferred from the formula.
+    -layout (str): {'auto', 'padded', 'csr', 'bitpacked'}. 'auto' picks padded or csr
+                from the clause-length distribution (see `choose_layout`) and
+                evaluates CPU batches of at least `bitpacked_min_batch` assignments
+                bit-packed. Set `bitpacked_min_batch` to None to disable it.
+    """
+    if layout == 'auto':
+        evaluator = build_evaluator(formula, num_variables, layout=choose_layout(formula))
+        if bitpacked_min_batch is None:
+            return evaluator
+        return BitPackedEvaluator(formula, evaluator.num_variables, fallback=evaluator, min_batch=bitpacked_min_batch)
+    elif layout == 'padded':
+        return PaddedEvaluator(formula, num_variables)
+    elif layout == 'csr':
+        return CSREvaluator(formula, num_variables)
+    elif layout == 'bitpacked':
+        return BitPackedEvaluator(formula, num_variables)
+    else:
+        raise ValueError(f"{layout} is not a valid layout, try with 'auto', 'padded', 'csr' or 'bitpacked'.")
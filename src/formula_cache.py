@@ -0,0 +1,208 @@
+import numpy as np
+
+import hashlib
+import os
+import tempfile
+
+from src.dimacs import iter_dimacs, dimacs_header, dimacs2flat, clause_hashes, combine_clause_hashes, fingerprint
+
+
+# Binary formula format
+# ---------------------
+# [0, HEADER_SIZE)        header (see HEADER below).
+# [HEADER_SIZE, ...)      int32 literals of every clause, one after another.
+# [aligned to 8 bytes)    int64 clause offsets with shape [num_clauses+1].
+#
+# The header stores the size and mtime of the source file: a cache whose source
+# has changed is rebuilt the next time it is read. It also stores the canonical
+# fingerprint of the formula (see `dimacs.fingerprint`), computed while parsing.
+CACHE_EXT = '.fbin'
+MAGIC = b'SATFBIN2'
+HEADER = np.dtype([('magic', 'S8'),
+                   ('n', '<i8'),
+                   ('m', '<i8'),
+                   ('num_clauses', '<i8'),
+                   ('num_literals', '<i8'),
+                   ('source_mtime_ns', '<i8'),
+                   ('source_size', '<i8'),
+                   ('hash', 'u1', (16,)),
+                   ('fingerprint', 'u1', (16,))])
+HEADER_SIZE = 128
+
+
+def is_cache_file(path):
+    "True for the binary files written by this module; used to skip them when listing instances."
+    return path.endswith(CACHE_EXT)
+
+
+def cache_path(dimacs_path, cache_dir=None):
+    '''Path of the binary cache of a DIMACS file: next to it ('x.cnf' -> 'x.cnf.fbin') or,
+    if `cache_dir` is given, inside that folder with a name derived from the absolute path.'''
+    if cache_dir is None:
+        return dimacs_path + CACHE_EXT
+    abs_path = os.path.abspath(dimacs_path)
+    key = hashlib.blake2b(abs_path.encode(), digest_size=16).hexdigest()
+    return os.path.join(cache_dir, f"{os.path.basename(abs_path)}.{key}{CACHE_EXT}")
+
+
+def content_hash(literals, offsets):
+    "Hash of a flat formula; the same one that is stored in the header of its binary cache."
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.ascontiguousarray(literals, dtype='<i4').tobytes())
+    h.update(np.ascontiguousarray(offsets, dtype='<i8').tobytes())
+    return h.hexdigest()
+
+
+def _offsets_start(num_literals):
+    return HEADER_SIZE + (4 * num_literals + 7) // 8 * 8
+
+
+def _write(dimacs_path, blocks, n, m, cache_dir):
+    '''Writes (literals, offsets) blocks to the cache of `dimacs_path` block by block.
+    The file is written under a temporary name and renamed, so concurrent readers
+    (e.g. Ray Tune trials) never see a partial cache.'''
+    stat = os.stat(dimacs_path)
+    path = cache_path(dimacs_path, cache_dir)
+    folder = os.path.dirname(path) or '.'
+    os.makedirs(folder, exist_ok=True)
+
+    digest = hashlib.blake2b(digest_size=16)
+    hashes = []
+    offsets = [np.zeros(1, dtype=np.int64)]
+    num_literals = 0
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=CACHE_EXT + '.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(bytes(HEADER_SIZE))
+            for literals, block_offsets in blocks:
+                literals = np.ascontiguousarray(literals, dtype='<i4')
+                f.write(literals.tobytes())
+                digest.update(literals.tobytes())
+                hashes.append(clause_hashes(literals, block_offsets))
+                offsets.append(np.asarray(block_offsets[1:], dtype='<i8') + num_literals)
+                num_literals += len(literals)
+            offsets = np.concatenate(offsets)
+            digest.update(offsets.tobytes())
+            f.write(bytes(_offsets_start(num_literals) - HEADER_SIZE - 4 * num_literals))
+            f.write(offsets.tobytes())
+
+            header = np.zeros(1, dtype=HEADER)
+            header['magic'] = MAGIC
+            header['n'], header['m'] = n, m
+            header['num_clauses'] = len(offsets) - 1
+            header['num_literals'] = num_literals
+            header['source_mtime_ns'] = stat.st_mtime_ns
+            header['source_size'] = stat.st_size
+            header['hash'] = np.frombuffer(digest.digest(), dtype=np.uint8)
+            hashes = np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+            header['fingerprint'] = np.frombuffer(bytes.fromhex(combine_clause_hashes(n, hashes)), dtype=np.uint8)
+            f.seek(0)
+            f.write(header.tobytes())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def build_cache(dimacs_path, cache_dir=None, block_size=100000):
+    '''Parses a DIMACS file (in blocks, see `dimacs.iter_dimacs`) and writes its binary cache.
+    Returns the path of the cache.'''
+    n, m = dimacs_header(dimacs_path)
+    return _write(dimacs_path, iter_dimacs(dimacs_path, block_size=block_size), n, m, cache_dir)
+
+
+def save_cache(dimacs_path, n, m, literals, offsets, cache_dir=None):
+    '''Writes the binary cache of a DIMACS file from a formula that is already in memory,
+    e.g. right after a generator saved it. Returns the path of the cache.'''
+    return _write(dimacs_path, [(literals, offsets)], n, m, cache_dir)
+
+
+def read_header(path):
+    "Reads the header of a binary cache, or returns None if the file is not a valid cache."
+    try:
+        with open(path, 'rb') as f:
+            header = np.frombuffer(f.read(HEADER.itemsize), dtype=HEADER)
+    except OSError:
+        return None
+    if len(header) != 1 or header['magic'][0] != MAGIC:
+        return None
+    return header[0]
+
+
+def open_cache(dimacs_path, cache_dir=None):
+    '''Opens the binary cache of a DIMACS file with `np.memmap` (no copies, no parsing).
+
+        Returns:
+            n (int): Number of variables in the formula.
+            m (int): Number of clauses in the 'p cnf' line.
+            literals (ndarray): read-only int32 array with the literals of every clause.
+            offsets (ndarray): read-only int64 array with shape [num_clauses+1].
+            content_hash (str): hash of the literals and offsets.
+            fingerprint (str): canonical fingerprint of the formula (see `dimacs.fingerprint`).
+        or None if there is no cache or the DIMACS file changed after it was written.
+    '''
+    path = cache_path(dimacs_path, cache_dir)
+    header = read_header(path)
+    if header is None:
+        return None
+    stat = os.stat(dimacs_path)
+    if header['source_mtime_ns'] != stat.st_mtime_ns or header['source_size'] != stat.st_size:
+        return None
+
+    num_literals, num_clauses = int(header['num_literals']), int(header['num_clauses'])
+    if num_literals > 0:
+        literals = np.memmap(path, dtype='<i4', mode='r', offset=HEADER_SIZE, shape=(num_literals,))
+    else:
+        # np.memmap cannot map zero bytes.
+        literals = np.zeros(0, dtype=np.int32)
+    offsets = np.memmap(path, dtype='<i8', mode='r', offset=_offsets_start(num_literals), shape=(num_clauses + 1,))
+    return (int(header['n']), int(header['m']), literals, offsets,
+            bytes(header['hash']).hex(), bytes(header['fingerprint']).hex())
+
+
+def _open_or_build(dimacs_path, cache_dir=None):
+    "`open_cache`, building the cache first if needed; None if it cannot be written."
+    cached = open_cache(dimacs_path, cache_dir)
+    if cached is None:
+        try:
+            build_cache(dimacs_path, cache_dir)
+        except OSError:
+            return None
+        # None if the source changed while the cache was being written.
+        cached = open_cache(dimacs_path, cache_dir)
+    return cached
+
+
+def load_flat(dimacs_path, cache_dir=None):
+    '''Reads a DIMACS file through its binary cache, building the cache first if it is
+    missing or stale. If the cache cannot be written (e.g. a read-only data folder)
+    the file is parsed directly.
+
+        Returns:
+            n, m, literals, offsets as in `dimacs.dimacs2flat`.
+    '''
+    cached = _open_or_build(dimacs_path, cache_dir)
+    if cached is None:
+        return dimacs2flat(dimacs_path)
+    return cached[:4]
+
+
+def load_fingerprint(dimacs_path, cache_dir=None):
+    '''Canonical fingerprint of a DIMACS file (see `dimacs.fingerprint`), read from the
+    header of its binary cache, so it is only computed when the file is parsed.'''
+    cached = _open_or_build(dimacs_path, cache_dir)
+    if cached is None:
+        n, _, literals, offsets = dimacs2flat(dimacs_path)
+        return fingerprint(n, literals, offsets)
+    return cached[5]
+
+
+def iter_flat(literals, offsets, block_size=100000):
+    '''Yields (literals, offsets) blocks of at most `block_size` clauses from a flat formula,
+    with the same layout as `dimacs.iter_dimacs`. Blocks of a memmap are views.'''
+    num_clauses = len(offsets) - 1
+    for start in range(0, num_clauses, block_size):
+        block = np.asarray(offsets[start:min(start + block_size, num_clauses) + 1])
+        yield literals[block[0]:block[-1]], block - block[0]
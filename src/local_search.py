@@ -0,0 +1,165 @@
+import torch
+import numpy as np
+
+from src.evaluators import flatten_formula
+
+
+def _padded_groups(keys, values, num_keys, fill):
+    """Groups `values` by `keys` into a [num_keys, max_group_size] table padded with `fill`, plus a mask."""
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    sizes = np.bincount(keys, minlength=num_keys)
+    starts = np.zeros(num_keys, dtype=np.int64)
+    np.cumsum(sizes[:-1], out=starts[1:])
+    slot = np.arange(len(keys)) - starts[keys]
+    table = np.full((num_keys, max(int(sizes.max()), 1)), fill, dtype=np.int64)
+    mask = np.zeros(table.shape, dtype=bool)
+    table[keys, slot] = values
+    mask[keys, slot] = True
+    return torch.from_numpy(table), torch.from_numpy(mask)
+
+
+class FlipGains():
+    """Tracks the make and break counts of every variable for a batch of assignments.
+
+    make[b, v] is the number of clauses that become satisfied if variable v is
+    flipped in assignment b, and break[b, v] the number of clauses that become
+    unsatisfied. The gain of a flip is make - break. The number of true literals
+    of every clause is kept, so after a flip only the clauses that contain the
+    flipped variable are re-scored instead of the whole formula.
+
+    Clauses are assumed to contain each variable at most once, as the formulas
+    produced by the generators in src/sat_generator.py.
+
+    Example
+    -------
+        gains = FlipGains(formula, num_variables)
+        gains.reset(assignment)  # [batch_size, num_variables]
+        best = (gains.make - gains.breaks).argmax(dim=-1)
+        gains.flip(best)
+    """
+    def __init__(self, formula, num_variables=None):
+        literals, offsets = flatten_formula(formula)
+        if num_variables is None:
+            num_variables = int(np.abs(literals).max()) if len(literals) > 0 else 0
+        self.num_variables = num_variables
+        self.num_clauses = len(offsets) - 1
+
+        var_idx = np.abs(literals) - 1  # -1 because DIMACS format starts indexing variables from 1.
+        clause_idx = np.repeat(np.arange(self.num_clauses), np.diff(offsets))
+        positions = np.arange(len(literals))
+
+        # Literal positions of every clause and occurrence lists of every variable.
+        # Padding points to a sentinel literal (position num_literals) that belongs to a
+        # sentinel clause and variable (the extra last rows), so masked slots never write
+        # over real entries.
+        sentinel = len(literals)
+        self.clause_lits, self.clause_lits_mask = _padded_groups(clause_idx, positions, self.num_clauses + 1, sentinel)
+        # ::clause_lits:: [num_clauses+1, max_clause_len]
+        self.var_lits, self.var_lits_mask = _padded_groups(var_idx, positions, num_variables + 1, sentinel)
+        # ::var_lits:: [num_variables+1, max_occurrences]
+
+        self.var_idx = torch.from_numpy(np.append(var_idx, num_variables))
+        # ::var_idx:: [num_literals+1]
+        self.sign = torch.from_numpy(np.append(literals > 0, True))
+        # ::sign:: [num_literals+1]
+        self.clause_idx = torch.from_numpy(np.append(clause_idx, self.num_clauses))
+        # ::clause_idx:: [num_literals+1]
+
+        self.assignment = None
+
+    def _to(self, device):
+        for name in ('var_idx', 'sign', 'clause_idx', 'clause_lits', 'clause_lits_mask', 'var_lits', 'var_lits_mask'):
+            setattr(self, name, getattr(self, name).to(device))
+
+    def reset(self, assignment):
+        """Computes true-literal counts, make and break from scratch in one pass over the formula.
+        `assignment` is a tensor with shape [batch_size, num_variables]."""
+        self._to(assignment.device)
+        batch_size = assignment.shape[0]
+        # The last column of every buffer belongs to the sentinel variable, literal or clause.
+        self._assignment = torch.ones(batch_size, self.num_variables + 1, dtype=torch.bool, device=assignment.device)
+        self._assignment[:, :-1] = assignment.bool()
+
+        self.lit_true = self._assignment[:, self.var_idx] == self.sign
+        # ::lit_true:: [batch_size, num_literals+1]
+        self._counts = torch.zeros(batch_size, self.num_clauses + 1, dtype=torch.int32, device=assignment.device)
+        self._counts.index_add_(1, self.clause_idx, self.lit_true.to(dtype=torch.int32))
+        # ::counts:: [batch_size, num_clauses+1]
+
+        lit_counts = self._counts[:, self.clause_idx]
+        # ::lit_counts:: [batch_size, num_literals+1]
+        self._make = torch.zeros(batch_size, self.num_variables + 1, dtype=torch.int32, device=assignment.device)
+        self._make.index_add_(1, self.var_idx, (lit_counts == 0).to(dtype=torch.int32))
+        self._breaks = torch.zeros(batch_size, self.num_variables + 1, dtype=torch.int32, device=assignment.device)
+        self._breaks.index_add_(1, self.var_idx, ((lit_counts == 1) & self.lit_true).to(dtype=torch.int32))
+        # ::make:: [batch_size, num_variables+1]
+        # ::breaks:: [batch_size, num_variables+1]
+        self.assignment = self._assignment[:, :-1]
+
+    @property
+    def counts(self):
+        "Number of true literals of every clause, with shape [batch_size, num_clauses]."
+        return self._counts[:, :-1]
+
+    @property
+    def make(self):
+        "Make counts, with shape [batch_size, num_variables]."
+        return self._make[:, :-1]
+
+    @property
+    def breaks(self):
+        "Break counts, with shape [batch_size, num_variables]."
+        return self._breaks[:, :-1]
+
+    @property
+    def gains(self):
+        "make - break, with shape [batch_size, num_variables]."
+        return self.make - self.breaks
+
+    @property
+    def num_sat(self):
+        "Number of satisfied clauses of every assignment, with shape [batch_size]."
+        return (self.counts > 0).sum(dim=-1)
+
+    def _score(self, positions, mask, sign):
+        """Adds (sign=1) or removes (sign=-1) the make/break contributions of the
+        literals at `positions` ([batch_size, k] with padding `mask`)."""
+        counts = self._counts.gather(1, self.clause_idx[positions])
+        lit_true = self.lit_true.gather(1, positions)
+        variables = self.var_idx[positions]
+        make = ((counts == 0) & mask).to(dtype=torch.int32) * sign
+        breaks = ((counts == 1) & lit_true & mask).to(dtype=torch.int32) * sign
+        self._make.scatter_add_(1, variables, make)
+        self._breaks.scatter_add_(1, variables, breaks)
+
+    def flip(self, variables):
+        """Flips variables[b] in assignment b and updates counts, make and break incrementally.
+        `variables` is a long tensor with shape [batch_size]; use -1 to leave an assignment unchanged."""
+        if self.assignment is None:
+            raise RuntimeError("Call reset() before flip().")
+        variables = variables.to(self._assignment.device)
+        active = variables >= 0
+        # Inactive rows flip the sentinel variable, which has no literals.
+        variables = torch.where(active, variables, self.num_variables)
+        rows = torch.arange(len(variables), device=self._assignment.device)
+
+        # Literals of the flipped variables and all the literals of the clauses they touch.
+        occ = self.var_lits[variables]
+        occ_mask = self.var_lits_mask[variables] & active.unsqueeze(-1)
+        # ::occ:: [batch_size, max_occurrences]
+        touched = self.clause_lits[self.clause_idx[occ]]
+        touched_mask = self.clause_lits_mask[self.clause_idx[occ]] & occ_mask.unsqueeze(-1)
+        touched, touched_mask = touched.flatten(1), touched_mask.flatten(1)
+        # ::touched:: [batch_size, max_occurrences*max_clause_len]
+
+        self._score(touched, touched_mask, -1)
+
+        # Flip the variable and its literals, then update the true-literal counts.
+        self._assignment[rows, variables] ^= active
+        new_true = ~self.lit_true.gather(1, occ) & occ_mask
+        self.lit_true.scatter_(1, occ, new_true)
+        delta = (2 * new_true.to(dtype=torch.int32) - 1) * occ_mask
+        self._counts.scatter_add_(1, self.clause_idx[occ], delta)
+
+        self._score(touched, touched_mask, 1)
@@ -0,0 +1,193 @@
+import numpy as np
+
+import json
+import os
+import sqlite3
+
+from src.evaluators import flatten_formula
+from src.dimacs import fingerprint
+from src.formula_cache import content_hash, is_cache_file
+
+
+# Every dataset folder built by build_dataset.py has a manifest with one row per instance.
+# Paths are stored relative to the folder of the manifest, so datasets can be moved.
+MANIFEST_NAME = 'manifest.sqlite'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS instances (
+    path TEXT PRIMARY KEY,
+    generator TEXT,
+    params TEXT,
+    n INTEGER,
+    m INTEGER,
+    r REAL,
+    min_k INTEGER,
+    max_k INTEGER,
+    sat INTEGER,
+    content_hash TEXT,
+    size INTEGER,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS instances_n_m ON instances (n, m);
+'''
+COLUMNS = ('path', 'generator', 'params', 'n', 'm', 'r', 'min_k', 'max_k', 'sat', 'content_hash', 'size', 'fingerprint')
+
+
+def _is_manifest_file(filename):
+    "The manifest and the journal files that SQLite writes next to it."
+    return filename.startswith(MANIFEST_NAME)
+
+
+class Manifest():
+    """SQLite index of the instances of a dataset folder.
+
+    Example
+    -------
+        with Manifest('data/rand') as manifest:
+            paths = manifest.paths(n=50, min_r=4.0, sat=True)
+    """
+    def __init__(self, data_dir):
+        self.data_dir = os.path.abspath(data_dir)
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(self.data_dir, MANIFEST_NAME))
+        self.connection.executescript(_SCHEMA)
+        # Manifests written before the fingerprint column existed.
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(instances)")]
+        if 'fingerprint' not in columns:
+            self.connection.execute("ALTER TABLE instances ADD COLUMN fingerprint TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS instances_fingerprint ON instances (fingerprint)")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _relpath(self, path):
+        return os.path.relpath(os.path.abspath(path), self.data_dir)
+
+    def entry(self, filename, n, formula, generator=None, sat=None):
+        """Builds the row of an instance that was already written to `filename`.
+
+        Arguments
+        ---------
+        -filename (str): path of the DIMACS file.
+        -n (int): number of variables.
+        -formula (list or tuple): the formula, as a list or as a flat (literals, offsets) tuple.
+        -generator (BaseCNFGenerator): generator of the instance; its class name and
+                    parameters are stored.
+        -sat (bool): SAT label, or None if it is unknown.
+        """
+        literals, offsets = flatten_formula(formula)
+        lengths = np.diff(offsets)
+        m = len(lengths)
+        params = None if generator is None else json.dumps(vars(generator), sort_keys=True, default=str)
+        return {'path': self._relpath(filename),
+                'generator': None if generator is None else type(generator).__name__,
+                'params': params,
+                'n': int(n),
+                'm': m,
+                'r': m / float(n),
+                'min_k': int(lengths.min()) if m > 0 else 0,
+                'max_k': int(lengths.max()) if m > 0 else 0,
+                'sat': None if sat is None else int(bool(sat)),
+                'content_hash': content_hash(literals, offsets),
+                'size': os.path.getsize(filename),
+                'fingerprint': fingerprint(n, literals, offsets)}
+
+    def add(self, entries):
+        "Inserts (or replaces) the rows built by `entry` in a single transaction."
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO instances ({', '.join(COLUMNS)}) "
+                f"VALUES ({', '.join(':' + c for c in COLUMNS)})",
+                list(entries))
+
+    def select(self, n=None, m=None, min_r=None, max_r=None, k=None, sat=None, generator=None, prefix=None,
+               fingerprint=None):
+        """Returns the rows that match all the given filters as dicts sorted by path,
+        with absolute paths. `n` and `m` can be an int or a list of ints, `prefix`
+        keeps the instances inside a subfolder of the dataset (e.g. '0050')."""
+        where, args = [], []
+        for column, value in (('n', n), ('m', m)):
+            if value is None:
+                continue
+            values = list(value) if isinstance(value, (list, tuple, range)) else [value]
+            where.append(f"{column} IN ({', '.join('?' * len(values))})")
+            args.extend(int(v) for v in values)
+        if min_r is not None:
+            where.append("r >= ?")
+            args.append(min_r)
+        if max_r is not None:
+            where.append("r <= ?")
+            args.append(max_r)
+        if k is not None:
+            where.append("min_k = ? AND max_k = ?")
+            args.extend([k, k])
+        if sat is not None:
+            where.append("sat = ?")
+            args.append(int(bool(sat)))
+        if generator is not None:
+            where.append("generator = ?")
+            args.append(generator)
+        if fingerprint is not None:
+            where.append("fingerprint = ?")
+            args.append(fingerprint)
+        if prefix is not None:
+            prefix = os.path.normpath(prefix) + os.sep
+            where.append("substr(path, 1, ?) = ?")
+            args.extend([len(prefix), prefix])
+
+        query = f"SELECT {', '.join(COLUMNS)} FROM instances"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY path"
+        rows = [dict(zip(COLUMNS, row)) for row in self.connection.execute(query, args)]
+        for row in rows:
+            row['path'] = os.path.join(self.data_dir, row['path'])
+            if row['sat'] is not None:
+                row['sat'] = bool(row['sat'])
+        return rows
+
+    def paths(self, **filters):
+        "Absolute paths of the instances that match `filters` (see `select`), sorted."
+        return [row['path'] for row in self.select(**filters)]
+
+
+def find_manifest(path):
+    "Folder of the manifest that indexes `path` (the folder itself or a parent), or None."
+    folder = os.path.abspath(path)
+    while True:
+        if os.path.isfile(os.path.join(folder, MANIFEST_NAME)):
+            return folder
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return None
+        folder = parent
+
+
+def instance_paths(data_path, **filters):
+    '''Sorted absolute paths of the instances inside `data_path`.
+
+    If a manifest indexes `data_path`, the paths come from a query (see
+    `Manifest.select` for `filters`); otherwise the folder is walked, which
+    does not support filters.
+    '''
+    data_path = os.path.abspath(data_path)
+    manifest_dir = find_manifest(data_path)
+    if manifest_dir is not None:
+        prefix = os.path.relpath(data_path, manifest_dir)
+        with Manifest(manifest_dir) as manifest:
+            return manifest.paths(prefix=None if prefix == '.' else prefix, **filters)
+
+    if filters:
+        raise ValueError(f"No {MANIFEST_NAME} was found for '{data_path}'; filters need a manifest.")
+    paths = []
+    for root, dirs, files in os.walk(data_path):
+        for filename in files:
+            if not is_cache_file(filename) and not _is_manifest_file(filename):
+                paths.append(os.path.join(root, filename))
+    return sorted(paths)
@@ -0,0 +1,197 @@
+import torch
+
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+
+# node2vec embedding cache
+# ------------------------
+# Embeddings are stored as <key>.pt inside the cache folder, where the key hashes the
+# fingerprint of the formula (see `dimacs.fingerprint`) together with every node2vec
+# hyperparameter that changes the result, so embeddings trained with other settings are
+# never reused. An SQLite index (index.sqlite) keeps the size and the last use of every
+# embedding; once the cache grows over `max_mb` the least recently used ones are evicted.
+# Files are written under a temporary name and renamed, and SQLite serializes the index
+# updates, so concurrent Ray Tune trials can fill the same cache.
+INDEX_NAME = 'index.sqlite'
+
+# utils.node2vec argument -> config key.
+CONFIG_KEYS = {'embedding_dim': 'n2v_dim',
+               'walk_length': 'n2v_walk_len',
+               'context_size': 'n2v_context_size',
+               'walks_per_node': 'n2v_walks_per_node',
+               'p': 'n2v_p',
+               'q': 'n2v_q',
+               'batch_size': 'n2v_batch_size',
+               'lr': 'n2v_lr',
+               'num_epochs': 'n2v_num_epochs'}
+FLOAT_PARAMS = ('p', 'q', 'lr')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS embeddings (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT,
+    params TEXT,
+    size INTEGER,
+    created REAL,
+    last_used REAL
+);
+CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER
+);
+'''
+
+
+def config_params(config):
+    "node2vec hyperparameters of a config (see base_config.py), named as the arguments of `utils.node2vec`."
+    return {name: config[key] for name, key in CONFIG_KEYS.items()}
+
+
+def _normalize(params):
+    "Same types for the same values, so e.g. p=1 and p=1.0 give the same key."
+    missing = set(CONFIG_KEYS) - set(params)
+    if missing:
+        raise ValueError(f"Missing node2vec hyperparameters: {', '.join(sorted(missing))}.")
+    return {name: float(params[name]) if name in FLOAT_PARAMS else int(params[name]) for name in CONFIG_KEYS}
+
+
+def embedding_key(fingerprint, params):
+    "Key of the embeddings of a formula trained with the hyperparameters `params`."
+    data = json.dumps([fingerprint, _normalize(params)], sort_keys=True)
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+class N2VCache():
+    """Cache of node2vec embeddings keyed by formula and hyperparameters.
+
+    Example
+    -------
+        cache = N2VCache('n2v_emb', max_mb=4096)
+        emb = cache.get(utils.formula_fingerprint(path), params, device)
+        if emb is None:
+            emb = utils.node2vec(path, device, **params, cache=cache)
+    """
+    def __init__(self, cache_dir, max_mb=0):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024**2)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Concurrent writers wait for the lock instead of failing.
+        self.connection = sqlite3.connect(os.path.join(cache_dir, INDEX_NAME), timeout=60)
+        with self.connection:
+            self.connection.executescript(_SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".pt")
+
+    def _count(self, name):
+        self.connection.execute("INSERT INTO stats (name, value) VALUES (?, 1) "
+                                "ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+    def contains(self, fingerprint, params):
+        key = embedding_key(fingerprint, params)
+        row = self.connection.execute("SELECT key FROM embeddings WHERE key = ?", (key,)).fetchone()
+        return row is not None and os.path.isfile(self._path(key))
+
+    def get(self, fingerprint, params, device='cpu'):
+        "The [2n+m, embedding_dim] embeddings of a formula, or None if they are not cached."
+        key = embedding_key(fingerprint, params)
+        embeddings = None
+        if self.connection.execute("SELECT key FROM embeddings WHERE key = ?", (key,)).fetchone() is not None:
+            try:
+                embeddings = torch.load(self._path(key), map_location=device)
+            except FileNotFoundError:
+                # Evicted by another process after the lookup.
+                embeddings = None
+
+        with self.connection:
+            if embeddings is None:
+                self.misses += 1
+                self._count('misses')
+            else:
+                self.hits += 1
+                self._count('hits')
+                self.connection.execute("UPDATE embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+        return embeddings
+
+    def put(self, fingerprint, params, embeddings):
+        "Stores the embeddings of a formula and evicts the least recently used ones if needed."
+        key = embedding_key(fingerprint, params)
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.pt.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                torch.save(embeddings.detach().cpu(), f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        now = time.time()
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO embeddings (key, fingerprint, params, size, created, last_used) "
+                                    "VALUES (?, ?, ?, ?, ?, ?)",
+                                    (key, fingerprint, json.dumps(_normalize(params), sort_keys=True),
+                                     os.path.getsize(path), now, now))
+            self._evict(keep=key)
+        return path
+
+    def _evict(self, keep):
+        "Deletes least recently used embeddings, but not `keep`, until the cache fits in max_bytes."
+        if self.max_bytes <= 0:
+            return
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.connection.execute("SELECT key, size FROM embeddings WHERE key != ? ORDER BY last_used", (keep,))
+        evicted = []
+        for key, size in rows.fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append(key)
+            total -= size
+        for key in evicted:
+            self.connection.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                # Already evicted by another process sharing the cache.
+                pass
+
+    def stats(self):
+        "Number of embeddings, total size in bytes and the hits and misses of every process so far."
+        count, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM embeddings").fetchone()
+        stats = dict(self.connection.execute("SELECT name, value FROM stats").fetchall())
+        return {'embeddings': count,
+                'bytes': size,
+                'hits': stats.get('hits', 0),
+                'misses': stats.get('misses', 0)}
+
+    def report(self):
+        "One line summary of `stats`."
+        stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / lookups if lookups > 0 else 0
+        cap = f" of {self.max_bytes / 1024**2:.1f} MB" if self.max_bytes > 0 else ""
+        return (f"Node2Vec cache {self.cache_dir}: {stats['embeddings']} embeddings, "
+                f"{stats['bytes'] / 1024**2:.1f} MB{cap}; hits: {stats['hits']}, misses: {stats['misses']} "
+                f"(hit rate: {hit_rate:.2f}).")
@@ -0,0 +1,141 @@
+import torch
+
+import multiprocessing
+import os
+import traceback
+from tqdm import tqdm
+
+import src.utils as utils
+from src.n2v_cache import N2VCache, embedding_key
+
+
+# Parallel node2vec precomputation
+# --------------------------------
+# `precompute` trains the embeddings of many (dimacs_path, params) jobs on a process
+# pool and stores them in an N2VCache (see src/n2v_cache.py). Every worker runs one
+# formula at a time with torch limited to its share of the cores, so the workers do
+# not oversubscribe the CPU and the throughput grows with the number of processes.
+# Jobs whose embeddings are already cached are skipped, so an interrupted run is
+# resumed by calling `precompute` again with the same jobs; failed jobs are retried.
+
+_cache = None
+_device = None
+
+
+def _init_worker(cache_dir, device, num_threads):
+    "Pool initializer: pins the torch threads and opens the cache of this process."
+    global _cache, _device
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    _cache = N2VCache(cache_dir)
+    _device = device
+
+
+def _train(job):
+    "Trains and caches the embeddings of a job; returns (job, None) or (job, traceback)."
+    dimacs_path, params = job
+    try:
+        # Another run may have cached it in the meantime.
+        if not _cache.contains(utils.formula_fingerprint(dimacs_path), params):
+            utils.node2vec(dimacs_path,
+                           _device,
+                           **params,
+                           save_path=None,
+                           num_workers=0,
+                           raytune=False,
+                           verbose=0,
+                           cache=_cache)
+        return job, None
+    except Exception:
+        return job, traceback.format_exc()
+
+
+def precompute(jobs, cache_dir, num_workers=None, device='cpu', max_retries=2, verbose=1):
+    """Trains the node2vec embeddings of `jobs` that are not in the cache at `cache_dir`.
+
+    Arguments
+    ---------
+    -jobs (list): (dimacs_path, params) pairs, where params are the node2vec
+        hyperparameters named as the arguments of `utils.node2vec` (see
+        `n2v_cache.config_params`). Repeated embeddings are trained once.
+    -cache_dir (str): folder of the N2VCache.
+    -num_workers (int): processes of the pool; None for all the cores (a single process
+        with 'cuda'), 0 to run in this process.
+    -device (str): device of the workers. With 'cuda' a single worker runs in this process
+        and larger pools are started with 'spawn', since CUDA cannot be used in forked
+        processes; the calling script then needs an `if __name__ == '__main__':` guard.
+    -max_retries (int): times a failed job is run again.
+    -verbose (int): {0, 1}. 1 shows the progress and the summary.
+
+    Returns
+    -------
+    -summary (dict): number of 'cached' and 'trained' jobs, and the traceback of the
+        last attempt of every 'failed' dimacs_path. Repeated jobs are in neither count.
+    """
+    global _cache
+    if (type(max_retries) != int) or (max_retries < 0):
+        raise ValueError(f"`max_retries` must be an integer equal or greater than 0, got {max_retries}.")
+
+    pending, keys, cached = [], set(), 0
+    with N2VCache(cache_dir) as cache:
+        for dimacs_path, params in jobs:
+            try:
+                fingerprint = utils.formula_fingerprint(dimacs_path)
+            except Exception:
+                # Unreadable formulas fail in the workers and are reported with the rest.
+                pending.append((dimacs_path, dict(params)))
+                continue
+            key = embedding_key(fingerprint, params)
+            if key in keys:
+                continue
+            keys.add(key)
+            if cache.contains(fingerprint, params):
+                cached += 1
+                continue
+            pending.append((dimacs_path, dict(params)))
+    summary = {'cached': cached, 'trained': 0, 'failed': {}}
+
+    cuda = str(device).startswith('cuda')
+    if num_workers is None:
+        num_workers = 1 if cuda else os.cpu_count()
+    num_workers = min(num_workers, len(pending))
+
+    pool = None
+    if (num_workers == 0) or (cuda and num_workers == 1):
+        # A single cuda worker runs in this process instead of a 'spawn' pool.
+        _init_worker(cache_dir, device, None)
+        run = lambda pending: map(_train, pending)
+    else:
+        num_threads = max(1, os.cpu_count() // num_workers)
+        context = multiprocessing.get_context('spawn' if cuda else None)
+        pool = context.Pool(num_workers, initializer=_init_worker, initargs=(cache_dir, device, num_threads))
+        run = lambda pending: pool.imap_unordered(_train, pending)
+
+    try:
+        for attempt in range(max_retries + 1):
+            if not pending:
+                break
+            failed = []
+            desc = "node2vec" if attempt == 0 else f"node2vec (retry {attempt})"
+            for job, error in tqdm(run(pending), total=len(pending), desc=desc, disable=verbose == 0):
+                if error is None:
+                    summary['trained'] += 1
+                    summary['failed'].pop(job[0], None)
+                else:
+                    failed.append(job)
+                    summary['failed'][job[0]] = error
+            pending = failed
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        elif _cache is not None:
+            _cache.close()
+            _cache = None
+
+    if verbose == 1:
+        print(f"node2vec precompute: {summary['trained']} trained, {summary['cached']} already cached, "
+              f"{len(summary['failed'])} failed.")
+        for dimacs_path, error in summary['failed'].items():
+            print(f"\nFailed '{dimacs_path}':\n{error}")
+    return summary
@@ -1,9 +1,70 @@
 import src.utils as utils
+from src.dimacs import write_dimacs, write_dimacs_batch, flat2list
+from src.evaluators import flatten_formula
+from src.formula_cache import save_cache
 import PyMiniSolvers.minisolvers as minisolvers
 import numpy as np
+import math
 import os
 
 
+def sample_distinct(rng, num_rows, n, k):
+    """Draws `k` distinct integers of [0, n) for each of `num_rows` rows, in random
+    order. Returns an int64 array with shape [num_rows, k]."""
+    if 4 * k >= n:
+        # Dense case: the k smallest of n uniform keys, sorted by key so that
+        # every prefix of a row is also a uniform sample.
+        keys = rng.random((num_rows, n))
+        idx = np.argpartition(keys, k - 1, axis=1)[:, :k] if k < n else np.tile(np.arange(n), (num_rows, 1))
+        order = np.argsort(np.take_along_axis(keys, idx, axis=1), axis=1)
+        return np.take_along_axis(idx, order, axis=1)
+
+    # Sparse case (k << n): draw with replacement and redraw the rows with repetitions.
+    return _redraw_repeated(rng.integers(0, n, size=(num_rows, k)), lambda size: rng.integers(0, n, size=size))
+
+
+def _redraw_repeated(variables, draw):
+    "Redraws, with `draw(size)`, the rows of `variables` that repeat a value until none does."
+    redraw = np.arange(len(variables))
+    while len(redraw) > 0:
+        rows = np.sort(variables[redraw], axis=1)
+        redraw = redraw[(rows[:, 1:] == rows[:, :-1]).any(axis=1)]
+        variables[redraw] = draw((len(redraw), variables.shape[1]))
+    return variables
+
+
+def _as_generator(rng):
+    """np.random.Generator from a generator or a seed. None seeds it from the global
+    NumPy state, so `np.random.seed` still makes the draws reproducible."""
+    if isinstance(rng, np.random.Generator):
+        return rng
+    if rng is None:
+        rng = np.random.randint(2**32, dtype=np.uint64)
+    return np.random.default_rng(rng)
+
+
+def _flat_clauses(variables, rng):
+    "Flat (literals, offsets) formula with the 0-indexed `variables` [m, k] negated at random."
+    m, k = variables.shape
+    signs = rng.integers(0, 2, size=(m, k)) * 2 - 1
+    literals = ((variables + 1) * signs).ravel()
+    return literals, np.arange(0, m * k + 1, k, dtype=np.int64)
+
+
+def _quiet_weight(k):
+    """Weight q of every true literal of a clause for which the literals of a planted
+    formula agree with the hidden assignment exactly half of the time, i.e. the root in
+    (0, 1) of 2q(1+q)^(k-1) = (1+q)^k - 1; (sqrt(5)-1)/2 for k=3."""
+    lo, hi = 0.0, 1.0
+    for _ in range(60):
+        q = (lo + hi) / 2
+        if 2*q*(1 + q)**(k - 1) < (1 + q)**k - 1:
+            lo = q
+        else:
+            hi = q
+    return (lo + hi) / 2
+
+
 class BaseCNFGenerator():
     """The base class for all CNF generators."""
 
@@ -19,18 +80,37 @@ class BaseCNFGenerator():
         "Generates the file name of an instance."
         raise NotImplementedError
     
-    def save(self, n, formula, filename):
+    def save(self, n, formula, filename, cache=True, cache_dir=None):
+        """Writes the formula (a list of clauses or a flat (literals, offsets) tuple)
+        in DIMACS format. The file is compressed if `filename` ends with .gz, .xz
+        or .bz2. If `cache` is True the binary
+        cache of the file (see src/formula_cache.py) is written too, so the
+        instance is never parsed when it is loaded."""
         # create folders
         path = os.path.dirname(filename)
         os.makedirs(path, exist_ok=True)
 
-        with open(filename, 'w') as f:
-            f.write(f"p cnf {n} {len(formula)}\n")
-            for clause in formula:
-                for literal in clause:
-                    f.write(f"{literal} ")
-                f.write("0\n")
-            f.write(f"%")
+        # The clauses are formatted in bulk (see dimacs.write_dimacs).
+        literals, offsets = flatten_formula(formula)
+        write_dimacs(filename, n, literals, offsets)
+
+        if cache:
+            save_cache(filename, n, len(offsets) - 1, literals, offsets, cache_dir)
+
+    def save_batch(self, instances, cache=True, cache_dir=None, block_size=100000):
+        """Writes many formulas with one call, formatting the clauses of small formulas
+        together (see dimacs.write_dimacs_batch for `block_size`). `instances` is a list
+        of (n, formula, filename) tuples; the files are the same as the ones written by `save`."""
+        flat = []
+        for n, formula, filename in instances:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            literals, offsets = flatten_formula(formula)
+            flat.append((filename, n, literals, offsets))
+        write_dimacs_batch(flat, block_size=block_size)
+
+        if cache:
+            for filename, n, literals, offsets in flat:
+                save_cache(filename, n, len(offsets) - 1, literals, offsets, cache_dir)
 
 
 class URGenerator(BaseCNFGenerator):
@@ -60,6 +140,55 @@ class URGenerator(BaseCNFGenerator):
         r = m/float(n)
         
         return n, m, r, formula
+
+    def generate_batch(self, num_formulas, rng=None, flat=True):
+        """Generates many formulas with the distribution of `generate_formula` using
+        a handful of vectorized draws: the variables of all the clauses at once (see
+        `sample_distinct`) and all the signs in a single call.
+
+        Arguments
+        ---------
+        -num_formulas (int): number of formulas.
+        -rng (np.random.Generator or int): random generator, or a seed for one. None
+                    seeds it from the global NumPy state (see `_as_generator`).
+        -flat (bool): if True each formula is a flat (literals, offsets) tuple (see
+                    `evaluators.flatten_formula`), else a list of clauses.
+
+        Returns
+        -------
+        A list with a (n, m, r, formula) tuple per formula, as `generate_formula`.
+        The random stream differs from `generate_formula`, which is left unchanged.
+        """
+        rng = _as_generator(rng)
+        ns = rng.integers(self.min_n, self.max_n + 1, size=num_formulas)
+        ms = rng.integers(self.min_m, self.max_m + 1, size=num_formulas)
+
+        formulas = [None] * num_formulas
+        # Formulas with the same n are generated together.
+        for n in np.unique(ns):
+            n = int(n)
+            which = np.flatnonzero(ns == n)
+            num_clauses = int(ms[which].sum())
+            max_k = min(self.max_k, n)
+            k = rng.integers(self.min_k, max_k + 1, size=num_clauses)
+
+            variables = sample_distinct(rng, num_clauses, n, max_k)
+            signs = rng.integers(0, 2, size=(num_clauses, max_k)) * 2 - 1
+            # ::variables:: [num_clauses, max_k]
+            literals = ((variables + 1) * signs)[np.arange(max_k) < k[:, None]]
+            offsets = np.zeros(num_clauses + 1, dtype=np.int64)
+            np.cumsum(k, out=offsets[1:])
+
+            first_clause = 0
+            for i in which:
+                m = int(ms[i])
+                clause_offsets = offsets[first_clause:first_clause + m + 1]
+                formula = (literals[clause_offsets[0]:clause_offsets[-1]], clause_offsets - clause_offsets[0])
+                if not flat:
+                    formula = flat2list(*formula)
+                formulas[i] = (n, m, m / float(n), formula)
+                first_clause += m
+        return formulas
     
 
     def get_filename(self, dir_name, data_name, i):
@@ -105,20 +234,76 @@ class SRGenerator(BaseCNFGenerator):
         vars = np.random.choice(self.n, size=k, replace=False)
         return [v + 1 if np.random.rand() < 0.5 else -(v + 1) for v in vars]
     
-    def generate_formula(self):
+    def generate_clause(self):
+        "Generates a clause with k = 1 + B(p_b) + G(p_g) literals (at most n)."
+        k = 1 + np.random.binomial(n=1, p=self.p_b) + np.random.geometric(self.p_g)
+        if k > self.n:
+            k = self.n
+        return self.generate_k_clause(k)
+
+    def _unsat_prefix(self, batch_size):
+        """Adds random clauses until the formula becomes UNSAT, checking `batch_size`
+        clauses per solve instead of one.
+
+        Every clause of a batch is added as (clause OR -s) with a fresh selector
+        variable s, so the solver can enable any prefix of the batch through the
+        assumptions s = True. If the whole batch is SAT its selectors are fixed to
+        True; otherwise a binary search over the prefixes finds the first clause
+        that makes the formula UNSAT and the clauses after it are discarded.
+        Clauses are i.i.d., so the result is the same as adding them one by one.
+        Returns the clauses up to, and including, that clause."""
         S = minisolvers.MinisatSolver()
         for _ in range(self.n):
             S.new_var()
+        num_vars = self.n
 
         formula_unsat = []
-        
-        while S.solve():
-            k = 1 + np.random.binomial(n=1, p=self.p_b) + np.random.geometric(self.p_g)
-            if k > self.n:
-                k = self.n
-            clause = self.generate_k_clause(k)
-            formula_unsat.append(clause)
-            S.add_clause(clause)
+        while True:
+            batch = [self.generate_clause() for _ in range(batch_size)]
+            selectors = []
+            for clause in batch:
+                S.new_var()
+                num_vars += 1
+                selectors.append(num_vars)
+                S.add_clause(list(clause) + [-num_vars])
+
+            if S.solve(assumptions=selectors):
+                for selector in selectors:
+                    S.add_clause([selector])
+                formula_unsat.extend(batch)
+                continue
+
+            # batch[:hi+1] is UNSAT and batch[:lo] is SAT.
+            lo, hi = 0, batch_size - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if S.solve(assumptions=selectors[:mid + 1]):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            formula_unsat.extend(batch[:lo + 1])
+            return formula_unsat
+
+    def generate_formula(self, batch_size=None):
+        """Generates a pair of formulas of SR(n) that differ in one literal, the
+        first one UNSAT and the second one SAT.
+        With `batch_size`, clauses are checked in batches (see `_unsat_prefix`); the
+        distribution is the same, but not the random stream, so seeded datasets
+        built without it change."""
+        if batch_size is not None:
+            formula_unsat = self._unsat_prefix(batch_size)
+            clause = formula_unsat[-1]
+        else:
+            S = minisolvers.MinisatSolver()
+            for _ in range(self.n):
+                S.new_var()
+
+            formula_unsat = []
+            
+            while S.solve():
+                clause = self.generate_clause()
+                formula_unsat.append(clause)
+                S.add_clause(clause)
 
         formula_sat = formula_unsat.copy()
         clause_sat = clause.copy()
@@ -153,4 +338,181 @@ class SRGenerator(BaseCNFGenerator):
         
         return filename
 
-    
\ No newline at end of file
+
+class CommunityGenerator(BaseCNFGenerator):
+    """Implements the community attachment model of industrial-like CNFs.
+    Giraldez-Cru, J., Levy, J. A Modularity-Based Random SAT Instances Generator. 2015.
+    https://www.ijcai.org/Proceedings/15/Papers/281.pdf
+
+    The variables are split into `c` communities of (almost) the same size. With
+    probability P = Q + 1/c all the variables of a clause come from one community,
+    otherwise from `k` different communities, which gives a modularity close to Q.
+    Formulas are drawn with a handful of vectorized draws, so n = 10^6 takes seconds.
+    """
+    def __init__(self, n=10000, m=42000, k=3, c=40, Q=0.8):
+        if (c < k) or (n // c < k):
+            raise ValueError(f"`c` and the size of the communities (n//c) must be at least k={k}, got c={c} and n//c={n // c}.")
+        if not (0 <= Q <= 1 - 1/c):
+            raise ValueError(f"`Q` must be a number such that 0 <= Q <= 1 - 1/c, got {Q}.")
+        self.n = n  # Number of variables
+        self.m = m  # Number of clauses
+        self.k = k  # Clause size
+        self.c = c  # Number of communities
+        self.Q = Q  # Modularity
+
+    def generate_formula(self, rng=None):
+        """Returns n, m, r and a flat (literals, offsets) formula (see `evaluators.flatten_formula`).
+        `rng` is a np.random.Generator or a seed; by default it is seeded from np.random."""
+        rng = _as_generator(rng)
+        n, m, k, c = self.n, self.m, self.k, self.c
+        bounds = np.linspace(0, n, c + 1).astype(np.int64)
+        starts, sizes = bounds[:-1], np.diff(bounds)
+
+        intra = rng.random(m) < self.Q + 1/c
+        variables = np.empty((m, k), dtype=np.int64)
+        # ::variables:: [m, k]
+
+        # Intra-community clauses: k distinct variables of one community.
+        communities = rng.integers(0, c, size=np.count_nonzero(intra))
+        rows = np.flatnonzero(intra)
+        for size in np.unique(sizes[communities]):
+            which = sizes[communities] == size
+            positions = sample_distinct(rng, np.count_nonzero(which), int(size), k)
+            variables[rows[which]] = starts[communities[which], None] + positions
+
+        # Inter-community clauses: one variable of each of k distinct communities.
+        rows = np.flatnonzero(~intra)
+        communities = sample_distinct(rng, len(rows), c, k)
+        positions = np.floor(rng.random(communities.shape) * sizes[communities]).astype(np.int64)
+        variables[rows] = starts[communities] + positions
+
+        return n, m, m/float(n), _flat_clauses(variables, rng)
+
+    def get_filename(self, dir_name, data_name, i):
+        """
+        dir_name : Name of the directory.
+        data_name : Name of the dataset.
+        i : Number of the instance.
+        """
+        filename = dir_name + "/" + data_name + f"_n={self.n:07d}_k={self.k:02d}_m={self.m:07d}_c={self.c:04d}_Q={self.Q:.2f}" + f"_i={i:02d}" + ".cnf"
+        return filename
+
+
+class PowerLawGenerator(BaseCNFGenerator):
+    """Implements the scale-free random CNF model: the number of occurrences of the
+    variables follows a power-law distribution with exponent `beta`.
+    Ansotegui, C., Bonet, M. L., Levy, J. On the Structure of Industrial SAT Instances. 2009.
+    https://doi.org/10.1007/978-3-642-04244-7_13
+
+    Variable i (1-indexed) is drawn with probability proportional to i^(-1/(beta-1)),
+    without repetitions inside a clause. Formulas are drawn with a handful of vectorized
+    draws, so n = 10^6 takes seconds.
+    """
+    def __init__(self, n=10000, m=42000, k=3, beta=2.6):
+        if beta <= 2:
+            raise ValueError(f"`beta` must be greater than 2, got {beta}.")
+        if n < k:
+            raise ValueError(f"`n` must be at least k={k}, got {n}.")
+        self.n = n  # Number of variables
+        self.m = m  # Number of clauses
+        self.k = k  # Clause size
+        self.beta = beta  # Power-law exponent
+
+    def generate_formula(self, rng=None):
+        """Returns n, m, r and a flat (literals, offsets) formula (see `evaluators.flatten_formula`).
+        `rng` is a np.random.Generator or a seed; by default it is seeded from np.random."""
+        rng = _as_generator(rng)
+        n, m, k = self.n, self.m, self.k
+        cdf = np.cumsum(np.arange(1, n + 1, dtype=np.float64) ** (-1/(self.beta - 1)))
+        cdf /= cdf[-1]
+
+        def draw(size):
+            # Inverse transform sampling. Sorted uniforms make the search cache friendly
+            # (several times faster for large n); shuffling gives back i.i.d. draws.
+            variables = np.searchsorted(cdf, np.sort(rng.random(size), axis=None), side='right')
+            rng.shuffle(variables)
+            return np.minimum(variables, n - 1).reshape(size)
+
+        variables = _redraw_repeated(draw((m, k)), draw)
+        # ::variables:: [m, k]
+        return n, m, m/float(n), _flat_clauses(variables, rng)
+
+    def get_filename(self, dir_name, data_name, i):
+        """
+        dir_name : Name of the directory.
+        data_name : Name of the dataset.
+        i : Number of the instance.
+        """
+        filename = dir_name + "/" + data_name + f"_n={self.n:07d}_k={self.k:02d}_m={self.m:07d}_b={self.beta:.2f}" + f"_i={i:02d}" + ".cnf"
+        return filename
+
+
+class PlantedGenerator(BaseCNFGenerator):
+    """Implements random k-CNFs with a planted solution: a hidden assignment is drawn and
+    only clauses it satisfies are sampled, so every formula is SAT without calling a solver.
+    Jia, H., Moore, C., Strain, D. Generating Hard Satisfiable Formulas by Hiding Solutions
+    Deceptively. 2005. https://arxiv.org/abs/cs/0503044
+
+    A clause is drawn as k distinct variables plus its number t >= 1 of literals that are
+    true under the hidden assignment, with probability proportional to C(k, t) w(t):
+        - 'naive': w(t) = 1, uniform over the clauses the assignment satisfies. The literals
+          lean towards the hidden assignment, so majority votes give most of it away.
+        - 'quiet': w(t) = q^t with q from `_quiet_weight` (q-hidden formulas), so every
+          literal agrees with the hidden assignment half of the time. Requires k >= 3.
+        - 'balanced': t < k as well, so the complement of the hidden assignment satisfies
+          the formula too and the literals are balanced (2-hidden formulas). Requires k >= 2.
+    Formulas are drawn with a handful of vectorized draws, so n = 10^6 takes seconds.
+    """
+    PLANTINGS = ('naive', 'quiet', 'balanced')
+
+    def __init__(self, n=20, m=80, k=3, planting='quiet'):
+        if planting not in self.PLANTINGS:
+            raise ValueError(f"{planting} is not a valid planting, try with {', '.join(repr(p) for p in self.PLANTINGS)}.")
+        min_k = {'naive': 1, 'quiet': 3, 'balanced': 2}[planting]
+        if (k < min_k) or (n < k):
+            raise ValueError(f"`k` must be at least {min_k} for '{planting}' planting and at most n={n}, got {k}.")
+        self.n = n  # Number of variables
+        self.m = m  # Number of clauses
+        self.k = k  # Clause size
+        self.planting = planting
+
+    def true_literals_probs(self):
+        "Probability of every number t = 0, ..., k of true literals of a clause under the hidden assignment."
+        t = np.arange(self.k + 1)
+        weights = np.array([math.comb(self.k, i) for i in t], dtype=np.float64)
+        weights[0] = 0
+        if self.planting == 'quiet':
+            weights *= _quiet_weight(self.k) ** t
+        elif self.planting == 'balanced':
+            weights[-1] = 0
+        return weights / weights.sum()
+
+    def generate_formula(self, rng=None):
+        """Returns n, m, r, a flat (literals, offsets) formula (see `evaluators.flatten_formula`)
+        and the hidden assignment, an int8 array of 1s and 0s with shape [n] that satisfies it.
+        `rng` is a np.random.Generator or a seed; by default it is seeded from np.random."""
+        rng = _as_generator(rng)
+        n, m, k = self.n, self.m, self.k
+        model = rng.integers(0, 2, size=n, dtype=np.int8)
+
+        variables = sample_distinct(rng, m, n, k)
+        # ::variables:: [m, k]
+        num_true = rng.choice(k + 1, size=m, p=self.true_literals_probs())
+        # The num_true literals with the smallest random keys are the true ones.
+        ranks = np.argsort(np.argsort(rng.random((m, k)), axis=1), axis=1)
+        true = ranks < num_true[:, None]
+        # ::true:: [m, k]
+        # A literal is true if its sign agrees with the value of its variable.
+        positive = true == (model[variables] == 1)
+        literals = ((variables + 1) * np.where(positive, 1, -1)).ravel()
+        offsets = np.arange(0, m * k + 1, k, dtype=np.int64)
+        return n, m, m/float(n), (literals, offsets), model
+
+    def get_filename(self, dir_name, data_name, i):
+        """
+        dir_name : Name of the directory.
+        data_name : Name of the dataset.
+        i : Number of the instance.
+        """
+        filename = dir_name + "/" + data_name + f"_n={self.n:04d}_k={self.k:02d}_m={self.m:04d}_p={self.planting}" + f"_i={i:02d}" + ".cnf"
+        return filename
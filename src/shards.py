@@ -0,0 +1,258 @@
+import numpy as np
+
+import json
+import os
+
+from src.dimacs import dimacs_stem, fingerprint
+from src.evaluators import flatten_formula
+
+
+# Sharded instance containers
+# ---------------------------
+# A shard folder packs many formulas (and optionally their node2vec embeddings) into a
+# few large files plus an index:
+#   index.json              name -> location of the arrays of every instance.
+#   formulas-00000.bin      int32 literals and int64 clause offsets of many instances.
+#   n2v<dim>-00000.bin      float32 node2vec embeddings with shape [2n+m, dim].
+# Embeddings are stored with the `n2v_cache.embedding_key` of the formula and the
+# node2vec hyperparameters that trained them, so they are only used with those.
+# Every array starts at a multiple of 8 bytes, so it can be viewed in place from a
+# memory map of its file. A new file is started when one reaches `max_shard_bytes`.
+#
+# Instances are referenced as 'shard://<shard_dir>#<name or position>', e.g.
+# 'shard://data/rand_shards#rand_n=0050_k=03_m=0200_i=01' or 'shard://data/rand_shards#7'.
+SHARD_SCHEME = 'shard://'
+INDEX_NAME = 'index.json'
+
+
+def is_shard_ref(path):
+    return isinstance(path, str) and path.startswith(SHARD_SCHEME)
+
+
+def parse_shard_ref(ref):
+    "Splits 'shard://<shard_dir>#<key>' into (shard_dir, key); key is None for the whole folder."
+    if not is_shard_ref(ref):
+        raise ValueError(f"'{ref}' is not a shard reference ({SHARD_SCHEME}<shard_dir>#<name>).")
+    shard_dir, _, key = ref[len(SHARD_SCHEME):].partition('#')
+    return shard_dir, (key or None)
+
+
+def shard_ref(shard_dir, key):
+    return f"{SHARD_SCHEME}{shard_dir}#{key}"
+
+
+def _empty_index():
+    return {'names': [], 'formulas': {}, 'embeddings': {}}
+
+
+def _read_index(shard_dir):
+    path = os.path.join(shard_dir, INDEX_NAME)
+    if not os.path.isfile(path):
+        return _empty_index()
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+class ShardWriter():
+    """Appends formulas and embeddings to a shard folder (created if needed).
+
+    The index is written by `flush` and `close`, so readers only see complete instances.
+
+    Example
+    -------
+        with ShardWriter('data/rand_shards') as shards:
+            shards.add_formula('rand_i=01', n, formula, sat=True)
+    """
+    def __init__(self, shard_dir, max_shard_bytes=1 << 30):
+        self.shard_dir = shard_dir
+        self.max_shard_bytes = max_shard_bytes
+        os.makedirs(shard_dir, exist_ok=True)
+        self.index = _read_index(shard_dir)
+        self._files = {}  # prefix -> [file name, open file]
+
+    def _append(self, prefix, arrays):
+        """Appends arrays to the current file with the given prefix, starting a new file
+        when it is full. Returns the file name and the byte offset of every array."""
+        current = self._files.get(prefix)
+        if current is None or current[1].tell() >= self.max_shard_bytes:
+            if current is not None:
+                current[1].close()
+            number = 0
+            while os.path.exists(os.path.join(self.shard_dir, f"{prefix}-{number:05d}.bin")):
+                number += 1
+            if number > 0:
+                # Keep appending to the last file of a previous writer while it has room.
+                last = os.path.join(self.shard_dir, f"{prefix}-{number - 1:05d}.bin")
+                if os.path.getsize(last) < self.max_shard_bytes:
+                    number -= 1
+            name = f"{prefix}-{number:05d}.bin"
+            current = self._files[prefix] = [name, open(os.path.join(self.shard_dir, name), 'ab')]
+
+        f = current[1]
+        starts = []
+        for array in arrays:
+            f.write(bytes(-f.tell() % 8))
+            starts.append(f.tell())
+            f.write(array.tobytes())
+        return current[0], starts
+
+    def add_formula(self, name, n, formula, m=None, **metadata):
+        """Adds a formula (list, or flat (literals, offsets) tuple) with its number of
+        variables. `metadata` (e.g. sat=True) must be JSON serializable."""
+        if name in self.index['formulas']:
+            raise ValueError(f"The instance '{name}' is already in {self.shard_dir}.")
+        literals, offsets = flatten_formula(formula)
+        literals = np.ascontiguousarray(literals, dtype='<i4')
+        offsets = np.ascontiguousarray(offsets, dtype='<i8')
+        file_name, (literals_start, offsets_start) = self._append('formulas', [literals, offsets])
+        self.index['formulas'][name] = {'file': file_name,
+                                        'n': int(n),
+                                        'm': int(len(offsets) - 1 if m is None else m),
+                                        'literals': [literals_start, len(literals)],
+                                        'offsets': [offsets_start, len(offsets)],
+                                        'fingerprint': fingerprint(n, literals, offsets),
+                                        **metadata}
+        self.index['names'].append(name)
+
+    def add_embedding(self, name, embedding, n2v_key):
+        """Adds (or replaces) the node2vec embedding, with shape [2n+m, dim], of an instance.
+        `n2v_key` is the `n2v_cache.embedding_key` of its formula and hyperparameters.
+        Replaced embeddings are not removed from the shard files."""
+        embedding = np.ascontiguousarray(embedding, dtype='<f4')
+        dim = str(embedding.shape[1])
+        file_name, (start,) = self._append(f"n2v{dim}", [embedding])
+        self.index['embeddings'].setdefault(dim, {})[name] = {'file': file_name,
+                                                             'offset': start,
+                                                             'shape': list(embedding.shape),
+                                                             'n2v_key': n2v_key}
+
+    def embedding_key(self, name, dim):
+        "The `n2v_key` of the stored embedding of dimension `dim` of an instance, or None."
+        return self.index['embeddings'].get(str(dim), {}).get(name, {}).get('n2v_key')
+
+    def flush(self):
+        "Writes the data and the index; the index is replaced atomically."
+        for _, f in self._files.values():
+            f.flush()
+        path = os.path.join(self.shard_dir, INDEX_NAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        self.flush()
+        for _, f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardReader():
+    """Random access to the instances of a shard folder by name or by position.
+    Arrays are read-only views of memory maps of the shard files (no copies)."""
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.index = _read_index(shard_dir)
+        self.names = self.index['names']
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def name(self, key):
+        "Name of an instance given its name or its position (an int or a numeric string)."
+        if isinstance(key, (int, np.integer)) or (isinstance(key, str) and key.isdigit() and key not in self.index['formulas']):
+            return self.names[int(key)]
+        if key not in self.index['formulas']:
+            raise KeyError(f"No instance '{key}' in {self.shard_dir}.")
+        return key
+
+    def _map(self, file_name):
+        if file_name not in self._maps:
+            self._maps[file_name] = np.memmap(os.path.join(self.shard_dir, file_name), dtype=np.uint8, mode='r')
+        return self._maps[file_name]
+
+    def _view(self, file_name, start, count, dtype):
+        dtype = np.dtype(dtype)
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return self._map(file_name)[start:start + count * dtype.itemsize].view(dtype)
+
+    def metadata(self, key):
+        return self.index['formulas'][self.name(key)]
+
+    def flat(self, key):
+        "Returns n, m, literals and offsets of an instance, as `dimacs.dimacs2flat`."
+        entry = self.metadata(key)
+        literals = self._view(entry['file'], *entry['literals'], '<i4')
+        offsets = self._view(entry['file'], *entry['offsets'], '<i8')
+        return entry['n'], entry['m'], literals, offsets
+
+    def fingerprint(self, key):
+        "Canonical fingerprint of an instance (see `dimacs.fingerprint`)."
+        entry = self.metadata(key)
+        if 'fingerprint' not in entry:
+            # Shards written before fingerprints were stored in the index.
+            n, _, literals, offsets = self.flat(key)
+            entry['fingerprint'] = fingerprint(n, literals, offsets)
+        return entry['fingerprint']
+
+    def embedding(self, key, dim, n2v_key):
+        """Returns the [2n+m, dim] node2vec embedding of an instance, or None if none was
+        stored with the `n2v_cache.embedding_key` `n2v_key`."""
+        entry = self.index['embeddings'].get(str(dim), {}).get(self.name(key))
+        # Embeddings of other hyperparameters, or written before the keys were stored.
+        if entry is None or entry.get('n2v_key') != n2v_key:
+            return None
+        rows, cols = entry['shape']
+        return self._view(entry['file'], entry['offset'], rows * cols, '<f4').reshape(rows, cols)
+
+    def refs(self):
+        "shard:// references of all the instances, in insertion order."
+        return [shard_ref(self.shard_dir, name) for name in self.names]
+
+
+_readers = {}
+
+
+def open_shards(shard_dir):
+    "Returns a ShardReader of a folder, reused until the index changes."
+    path = os.path.join(shard_dir, INDEX_NAME)
+    version = os.stat(path).st_mtime_ns if os.path.isfile(path) else None
+    key = os.path.abspath(shard_dir)
+    if key not in _readers or _readers[key][0] != version:
+        _readers[key] = (version, ShardReader(shard_dir))
+    return _readers[key][1]
+
+
+def load_flat(ref):
+    "n, m, literals and offsets of the instance of a 'shard://<shard_dir>#<key>' reference."
+    shard_dir, key = parse_shard_ref(ref)
+    if key is None:
+        raise ValueError(f"'{ref}' does not name an instance; use {SHARD_SCHEME}<shard_dir>#<name>.")
+    return open_shards(shard_dir).flat(key)
+
+
+def load_fingerprint(ref):
+    "Canonical fingerprint of the instance of a shard reference."
+    shard_dir, key = parse_shard_ref(ref)
+    return open_shards(shard_dir).fingerprint(key)
+
+
+def load_embedding(ref, dim, n2v_key):
+    "The node2vec embedding of dimension `dim` and `n2v_cache.embedding_key` `n2v_key` of a shard reference, or None."
+    shard_dir, key = parse_shard_ref(ref)
+    return open_shards(shard_dir).embedding(key, dim, n2v_key)
+
+
+def instance_name(path):
+    "Name of an instance given a DIMACS path or a shard reference, e.g. to name its embedding file."
+    if is_shard_ref(path):
+        shard_dir, key = parse_shard_ref(path)
+        return open_shards(shard_dir).name(key)
+    return dimacs_stem(path)
@@ -12,9 +12,14 @@ from src.architecture.baselines import RolloutBaseline, EMABaseline, ZeroBaselin
 from src.initializers.var_initializer import BasicVar, Node2VecVar
 from src.initializers.context_initializer import EmptyContext, Node2VecContext
 
-from src.train import train
+from src.train import train, train_stream
 import src.utils as utils
+import src.shards as shards
+import src.streaming as streaming
+from src.dimacs import fingerprint
+from src.evaluators import flatten_formula
 from src.base_config import get_config
+from src.n2v_cache import N2VCache, config_params, embedding_key
 
 from ray import air, tune
 from ray.tune.schedulers import ASHAScheduler
@@ -24,7 +29,9 @@ from PyMiniSolvers import minisolvers
 
 import os
 import json
+import itertools
 import pprint as pp
+from collections import OrderedDict
 
 #from GPUtil import showUtilization as gpu_usage
 
@@ -38,19 +45,25 @@ def random_solver(n, formula):
     return assignment, num_sat
 
 
+# Solutions found by minisat_solver, keyed by formula fingerprint (see dimacs.fingerprint).
+_solution_cache = OrderedDict()
+SOLUTION_CACHE_SIZE = 1024
+
+
 # Runs the minisat solver
-def minisat_solver(n, formula):
-    S = minisolvers.MinisatSolver()
-    for i in range(n):
-        S.new_var()
-    for clause in formula:
-        S.add_clause(clause)
-    assignment = None
-    is_sat = S.solve()
-    if is_sat:
-        assignment = list(S.get_model())
-        #is_sat, num_sat, eval_formula = utils.num_sat_clauses(formula, assignment)
-    return assignment, is_sat
+def minisat_solver(n, formula, cache=False):
+    # The solver is shared with utils.assignment_eval through the checker cache, keyed by
+    # formula identity. With cache=True solutions are also kept by formula fingerprint, which
+    # costs a canonical hash per call and only pays off when equal formulas are solved again.
+    if not cache:
+        return utils.get_checker(formula, n).solve()
+    key = fingerprint(n, *flatten_formula(formula))
+    if key not in _solution_cache:
+        _solution_cache[key] = utils.get_checker(formula, n).solve()
+        if len(_solution_cache) > SOLUTION_CACHE_SIZE:
+            _solution_cache.popitem(last=False)
+    _solution_cache.move_to_end(key)
+    return _solution_cache[key]
 
 
 # Runs the policy gradient maxsat solver
@@ -87,24 +100,42 @@ def pg_solver(config):
         print(f'\nRunning on {device}.')
     
     # Data
-    if config['data_dir'] is None:
-        raise ValueError("`config[data_dir]` can not be None.") 
-    n, m, formula = utils.dimacs2list(dimacs_path = config['data_dir'])
+    stream = None
+    if config['stream'] is not None:
+        # Generated instances instead of a file (see src/streaming.py)
+        if config['node2vec']:
+            raise ValueError("Streamed instances have no node2vec embeddings, set `config['node2vec']` to False.")
+        sat_gen = streaming.build_generator(config['stream'])
+        if streaming.num_variables(sat_gen) is None:
+            raise ValueError("The streamed instances must have a fixed number of variables (e.g. min_n == max_n).")
+        stream = streaming.InstanceStream(sat_gen,
+                                          num_workers=config['stream_workers'],
+                                          queue_size=config['stream_queue_size'],
+                                          seed=config['stream_seed'])
+        n, m, formula = next(stream)
+        if config['verbose'] > 0:
+            print(f"\nStreaming instances of: {config['stream']}.")
+    else:
+        if config['data_dir'] is None:
+            raise ValueError("`config[data_dir]` can not be None.") 
+        n, m, formula = utils.dimacs2list(dimacs_path = config['data_dir'])
+        if config['verbose'] > 0:
+            print(f"\nFormula loaded from: {config['data_dir']}.")
     num_variables = n
-    if config['verbose'] > 0:
-        print(f"\nFormula loaded from: {config['data_dir']}.")
     
     # Permutation of the variables
-    if config['vars_permutation'] == "fixed":
-        vars_permutation = utils.FixedVarsPermutation(num_variables, formula, importance=False)
-    elif config['vars_permutation'] == "importance":
-        vars_permutation = utils.FixedVarsPermutation(num_variables, formula, importance=True)
-    elif config['vars_permutation'] == "batch":
-        vars_permutation = utils.RandomVarsPermutation(num_variables, random_batch=False)
-    elif config['vars_permutation'] == "random":
-        vars_permutation = utils.RandomVarsPermutation(num_variables, random_batch=True)
-    else:
-        raise ValueError(f"{config['vars_permutation']} is not a valid value, try with 'fixed', 'importance', 'batch' or 'random'.")
+    def build_vars_permutation(num_variables, formula):
+        if config['vars_permutation'] == "fixed":
+            return utils.FixedVarsPermutation(num_variables, formula, importance=False)
+        elif config['vars_permutation'] == "importance":
+            return utils.FixedVarsPermutation(num_variables, formula, importance=True)
+        elif config['vars_permutation'] == "batch":
+            return utils.RandomVarsPermutation(num_variables, random_batch=False)
+        elif config['vars_permutation'] == "random":
+            return utils.RandomVarsPermutation(num_variables, random_batch=True)
+        else:
+            raise ValueError(f"{config['vars_permutation']} is not a valid value, try with 'fixed', 'importance', 'batch' or 'random'.")
+    vars_permutation = build_vars_permutation(num_variables, formula)
     
     # ###########################################################################
     # print("\nBefore load node2vec:", torch.cuda.memory_allocated(device))
@@ -117,49 +148,55 @@ def pg_solver(config):
         n2v_emb = None
 
     elif config['node2vec'] == True:
-        # Creates the folder n2v_dir/n2v_dim
-        node2vec_dir = os.path.join(config['n2v_dir'], str(config['n2v_dim']))
-        os.makedirs(node2vec_dir, exist_ok=True)
+        # Embeddings are cached by formula fingerprint and node2vec hyperparameters (see src/n2v_cache.py)
+        # The cache is closed however the lookup ends, e.g. on the raytune exception below.
+        with N2VCache(config['n2v_dir'], max_mb=config['n2v_cache_mb']) as n2v_cache:
+            if config['verbose'] > 0:
+                print(f"\n{n2v_cache.report()}")
+            n2v_params = config_params(config)
+            formula_fingerprint = utils.formula_fingerprint(config['data_dir'])
 
-        # Creates a filename with the same name of the dimacs file but with extention .pt
-        tail = os.path.split(config['data_dir'])[1]  # returns filename and extension
-        node2vec_filename = os.path.splitext(tail)[0]  # returns filename
-        
-        node2vec_file = os.path.join(node2vec_dir, node2vec_filename + ".pt")
+            # Tries to load pretrained embeddings, first from the shards of a shard:// instance,
+            # which are only used if they were trained with these hyperparameters
+            # If raytune is set to True, pretrained embeddings must exist
+            n2v_emb = None
+            if config['n2v_pretrained'] and shards.is_shard_ref(config['data_dir']):
+                emb = shards.load_embedding(config['data_dir'], config['n2v_dim'],
+                                            embedding_key(formula_fingerprint, n2v_params))
+                if emb is not None:
+                    n2v_emb = torch.tensor(emb, device=device)
+                    if config['verbose'] > 0:
+                        print(f"\nNode2Vec embeddings of size {config['n2v_dim']} loaded from: {config['data_dir']}.")
+            if config['n2v_pretrained'] and n2v_emb is None:
+                n2v_emb = n2v_cache.get(formula_fingerprint, n2v_params, device=device)
+                if n2v_emb is not None:
+                    if config['verbose'] > 0:
+                        print(f"\nNode2Vec embeddings of size {config['n2v_dim']} loaded from: {config['n2v_dir']}.")
+                else:
+                    if config["raytune"]:
+                        raise Exception(f"No node2vec emb of size {config['n2v_dim']} with these hyperparameters was found in {config['n2v_dir']}.")
+                    if config['verbose'] > 0:
+                        print(f"\nNo Node2Vec embeddings of size {config['n2v_dim']} with these hyperparameters have been created yet.")
 
-        # Tries to load pretrained embeddings
-        # If raytune is set to True, pretrained embeddings must exist
-        n2v_emb = None
-        if config['n2v_pretrained']:
-            if os.path.isfile(node2vec_file):
-                n2v_emb = torch.load(node2vec_file, map_location=device)
-                if config['verbose'] > 0:
-                    print(f"\nNode2Vec embeddings of size {config['n2v_dim']} loaded from: {node2vec_file}.")
-            else:
-                if config["raytune"]:
-                    raise Exception(f"No node2vec emb of size {config['n2v_dim']} was found at {node2vec_file}.")
-                if config['verbose'] > 0:
-                    print(f"\nNo Node2Vec embeddings of size {config['n2v_dim']} have been created yet.")
-
-        # Runs node2vec algorithm if not pretrained or not found (raytune must be False)
-        if (n2v_emb is None) and not config["raytune"]:
-            n2v_emb = utils.node2vec(dimacs_path=config['data_dir'],
-                                     device=device,
-                                     embedding_dim=config['n2v_dim'],
-                                     walk_length=config['n2v_walk_len'],
-                                     context_size=config['n2v_context_size'],
-                                     walks_per_node=config['n2v_walks_per_node'],
-                                     p=config['n2v_p'],
-                                     q=config['n2v_q'],
-                                     batch_size=config['n2v_batch_size'],
-                                     lr=config['n2v_lr'],
-                                     num_epochs=config['n2v_num_epochs'],
-                                     save_path=node2vec_dir,
-                                     file_name=node2vec_filename,
-                                     num_workers=config['n2v_workers'],
-                                     raytune=False,
-                                     verbose=config['n2v_verbose'])
-            print(f"\nThe {config['n2v_dim']}-dim Node2Vec embeddings of this instance has been created.")
+            # Runs node2vec algorithm if not pretrained or not found (raytune must be False)
+            if (n2v_emb is None) and not config["raytune"]:
+                n2v_emb = utils.node2vec(dimacs_path=config['data_dir'],
+                                         device=device,
+                                         embedding_dim=config['n2v_dim'],
+                                         walk_length=config['n2v_walk_len'],
+                                         context_size=config['n2v_context_size'],
+                                         walks_per_node=config['n2v_walks_per_node'],
+                                         p=config['n2v_p'],
+                                         q=config['n2v_q'],
+                                         batch_size=config['n2v_batch_size'],
+                                         lr=config['n2v_lr'],
+                                         num_epochs=config['n2v_num_epochs'],
+                                         save_path=None,
+                                         num_workers=config['n2v_workers'],
+                                         raytune=False,
+                                         verbose=config['n2v_verbose'],
+                                         cache=n2v_cache)
+                print(f"\nThe {config['n2v_dim']}-dim Node2Vec embeddings of this instance has been created.")
 
     else:
         raise ValueError(f"{config['node2vec']} is not a valid value, try with True or False.")
@@ -276,6 +313,34 @@ def pg_solver(config):
     # print("\tCached:", round(torch.cuda.memory_reserved(device)/1024**3,1), "GB")
     # gpu_usage() 
     # ###########################################################################
+    if stream is not None:
+        try:
+            summary = train_stream(stream=itertools.chain([(n, m, formula)], stream),
+                                   policy_network=policy_network,
+                                   optimizer=optimizer,
+                                   device=device,
+                                   baseline=baseline,
+                                   dec_var_initializer=initialize_dec_var,
+                                   dec_context_initializer=initialize_dec_context,
+                                   vars_permutation=build_vars_permutation,
+                                   num_instances=config['stream_instances'],
+                                   episodes_per_instance=config['stream_episodes'],
+                                   batch_size=config['batch_size'],
+                                   logit_clipping=config['logit_clipping'],
+                                   entropy_estimator=config['entropy_estimator'],
+                                   beta_entropy=config['beta_entropy'],
+                                   clip_grad=config['clip_grad'],
+                                   accumulation_episodes=config['accumulation_episodes'],
+                                   log_interval=config['log_interval'],
+                                   writer=writer,
+                                   save_dir=config['save_dir'],
+                                   verbose=config['verbose'])
+        finally:
+            stream.close()
+        if config['tensorboard_on']:
+            writer.close()
+        return summary
+
     active_search = train(formula=formula,
                           num_variables=num_variables,
                           policy_network=policy_network,
@@ -300,6 +365,8 @@ def pg_solver(config):
                           run_name = f"{config['run_name']}-{config['run_id']}",
                           save_dir = config['save_dir'],
                           sat_stopping=config['sat_stopping'],
+                          reward_cache_mb=config['reward_cache_mb'],
+                          eval_workers=config['eval_workers'],
                           verbose = config['verbose'],
                           checkpoint_dir=config['checkpoint_dir'])
 
@@ -0,0 +1,143 @@
+import numpy as np
+
+import multiprocessing
+import queue
+
+from src.evaluators import flatten_formula
+from src.sat_generator import URGenerator, SRGenerator
+
+
+# Streams of generated instances
+# ------------------------------
+# An InstanceStream wraps a generator as an infinite iterator of (n, m, formula)
+# instances with flat (literals, offsets) formulas. The formulas are generated by
+# worker processes into a bounded queue, so generation overlaps with training and
+# nothing is written to disk. Every worker draws from its own child of
+# np.random.SeedSequence(seed).
+GENERATORS = {'UR': URGenerator, 'SR': SRGenerator}
+
+
+def build_generator(params):
+    """Builds a generator from a dict such as {'generator': 'UR', 'min_n': 50, 'max_n': 50},
+    where every key but 'generator' is an argument of the generator class."""
+    params = dict(params)
+    name = params.pop('generator', 'UR')
+    if name not in GENERATORS:
+        raise ValueError(f"{name} is not a valid generator, try with {', '.join(repr(g) for g in GENERATORS)}.")
+    return GENERATORS[name](**params)
+
+
+def num_variables(sat_gen):
+    "Number of variables of every instance of a generator, or None if it varies."
+    if isinstance(sat_gen, SRGenerator):
+        return sat_gen.n
+    if isinstance(sat_gen, URGenerator) and sat_gen.min_n == sat_gen.max_n:
+        return sat_gen.min_n
+    return None
+
+
+def iter_instances(sat_gen, seed_seq, chunk_size=16, batch_size=None):
+    """Infinite iterator of (n, m, formula) instances of a generator, with flat formulas.
+
+    URGenerator instances are drawn `chunk_size` at a time with `generate_batch`
+    from a generator seeded by `seed_seq`; SR pairs are yielded as the SAT formula
+    followed by the UNSAT one (see `SRGenerator.generate_formula` for `batch_size`).
+    """
+    if isinstance(sat_gen, URGenerator):
+        rng = np.random.default_rng(seed_seq)
+        while True:
+            for n, m, r, formula in sat_gen.generate_batch(chunk_size, rng=rng):
+                yield n, m, formula
+
+    np.random.seed(seed_seq.generate_state(4))
+    while True:
+        if isinstance(sat_gen, SRGenerator):
+            n, m, r, [formula_unsat, formula_sat] = sat_gen.generate_formula(batch_size=batch_size)
+            yield n, m, flatten_formula(formula_sat)
+            yield n, m, flatten_formula(formula_unsat)
+        else:
+            n, m, r, formula = sat_gen.generate_formula()
+            yield n, m, flatten_formula(formula)
+
+
+def _worker(sat_gen, seed_seq, chunk_size, batch_size, instances, stop):
+    "Puts instances into the queue until `stop` is set; a full queue blocks the worker."
+    for instance in iter_instances(sat_gen, seed_seq, chunk_size, batch_size):
+        while True:
+            if stop.is_set():
+                return
+            try:
+                instances.put(instance, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+
+
+class InstanceStream():
+    """Infinite iterator of generated (n, m, formula) instances, with flat formulas.
+
+    With `num_workers` > 0 the instances come from worker processes through a queue
+    of at most `queue_size` instances, in the order they are ready; with
+    `num_workers` = 0 they are generated in this process, which gives the same
+    sequence for the same `seed`.
+
+    Example
+    -------
+        with InstanceStream(URGenerator(min_n=50, max_n=50), num_workers=4, seed=0) as stream:
+            for n, m, formula in itertools.islice(stream, 1000):
+                ...
+    """
+    def __init__(self, sat_gen, num_workers=2, queue_size=64, seed=None, chunk_size=16, batch_size=None):
+        if (type(num_workers) != int) or (num_workers < 0):
+            raise ValueError(f"`num_workers` must be an integer equal or greater than 0, got {num_workers}.")
+        self.sat_gen = sat_gen
+        self.num_workers = num_workers
+        seeds = np.random.SeedSequence(seed).spawn(max(num_workers, 1))
+
+        self._workers = []
+        if num_workers == 0:
+            self._local = iter_instances(sat_gen, seeds[0], chunk_size, batch_size)
+            return
+        self._queue = multiprocessing.Queue(maxsize=queue_size)
+        self._stop = multiprocessing.Event()
+        for seed_seq in seeds:
+            worker = multiprocessing.Process(target=_worker,
+                                             args=(sat_gen, seed_seq, chunk_size, batch_size, self._queue, self._stop),
+                                             daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.num_workers == 0:
+            return next(self._local)
+        while True:
+            try:
+                return self._queue.get(timeout=1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in self._workers):
+                    raise RuntimeError("All the generator workers of the stream have stopped.")
+
+    def close(self):
+        "Stops the workers; instances still in the queue are discarded."
+        if not self._workers:
+            return
+        self._stop.set()
+        # Workers blocked on a full queue only exit once it is drained.
+        for worker in self._workers:
+            while worker.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+                worker.join(timeout=0.1)
+        self._queue.close()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -7,6 +7,7 @@ import torch.distributions as distributions
 from src.initializers.state_initializer import TrainableState
 import src.utils as utils
 from src.utils import sampling_assignment
+from src.evaluators import build_evaluator, CachedEvaluator, SharedMemoryEvaluator
 
 import numpy as np
 from ray import tune
@@ -285,6 +286,8 @@ def train(formula,
           run_name = None, 
           save_dir = 'outputs',
           sat_stopping= False,  # {True, False}. Stop when num_sat is equal with the num of clauses.
+          reward_cache_mb=64,  # (float >= 0). Memory cap of the assignment -> num_sat cache. 0 disables it.
+          eval_workers=0,  # (int >= 0). Worker processes for clause evaluation. 0 evaluates in this process.
           verbose=1,
           checkpoint_dir='checkpoints'):
     """ Train a parametric policy following Policy Gradient Theorem
@@ -293,6 +296,10 @@ def train(formula,
     ----------
         log_interval: int. Log info every `log_interval` episodes. Default: 100.
         eval_interval: int. Run evaluation every `eval_interval` episodes. Default: 100.
+        reward_cache_mb: float. Memory cap, in MiB, of the LRU cache of rewards shared by
+            the rollouts, the baseline and the evaluation across episodes. Default: 64.
+        eval_workers: int. If greater than 0, clauses are evaluated by a pool of `eval_workers`
+            processes that share the compiled formula (for very large formulas). Default: 0.
 
     RETURNS
     --------
@@ -335,6 +342,15 @@ def train(formula,
     policy_network.train()
     optimizer.zero_grad()
 
+    # Compile the formula once; every reward below is a single batched evaluation.
+    if eval_workers > 0:
+        shared_evaluator = SharedMemoryEvaluator(formula, num_variables, num_workers=eval_workers)
+        evaluator = shared_evaluator
+    else:
+        evaluator = build_evaluator(formula, num_variables)
+    if reward_cache_mb > 0:
+        evaluator = CachedEvaluator(evaluator, max_mb=reward_cache_mb)
+
     # Active search solution
     active_search = {'episode': 0,
                      'samples': 0,
@@ -347,295 +363,305 @@ def train(formula,
     
     # TODO num_samples must be divisible by batch_size
     num_episodes = int(np.ceil(num_samples / batch_size))
-    for episode in tqdm(range(1, num_episodes + 1), disable=not progress_bar, ascii=True):
+    # The worker pool and shared memory of the evaluator are released however training ends.
+    try:
+        for episode in tqdm(range(1, num_episodes + 1), disable=not progress_bar, ascii=True):
 
-        current_samples = episode * batch_size
+            current_samples = episode * batch_size
         
-        # ###########################################################################
-        # a = torch.cuda.memory_allocated(device)
-        # ###########################################################################
-        buffer = run_episode(num_variables=num_variables,
-                             policy_network=policy_network,
-                             device=device,
-                             vars_permutation=vars_permutation,
-                             strategy='sampled',
-                             batch_size=batch_size,
-                             logit_clipping=logit_clipping,  # (int >= 0)
-                             logit_temp=1,  # (float >= 1) 
-                             extra_logging=extra_logging)   
+            # ###########################################################################
+            # a = torch.cuda.memory_allocated(device)
+            # ###########################################################################
+            buffer = run_episode(num_variables=num_variables,
+                                 policy_network=policy_network,
+                                 device=device,
+                                 vars_permutation=vars_permutation,
+                                 strategy='sampled',
+                                 batch_size=batch_size,
+                                 logit_clipping=logit_clipping,  # (int >= 0)
+                                 logit_temp=1,  # (float >= 1) 
+                                 extra_logging=extra_logging)   
         
-        # ###########################################################################
-        # b = torch.cuda.memory_allocated(device)
-        # ###########################################################################
-        # ###########################################################################
-        # print("\n4. Mem consumen by forward pass:", round((b-a)/1024**3, 1), "GB")
-        # print("\tAfter run an episode (forward pass):", torch.cuda.memory_allocated(device))
-        # print("\tAllocated:", round(torch.cuda.memory_allocated(device)/1024**3, 1), "GB")
-        # print("\tCached:", round(torch.cuda.memory_reserved(device)/1024**3, 1), "GB")
-        # gpu_usage()  
-        # ###########################################################################
-        policy_network.eval()
-        with torch.no_grad():
-            # Compute num of sat clauses
-            #num_sat = utils.num_sat_clauses_tensor(formula, buffer.action.detach().cpu().numpy()).detach()
-            num_sat = utils.num_sat_clauses_tensor(formula, buffer.action.detach()).detach()
-            # num_sat: [batch_size]
-
-            # Compute baseline
-            baseline_val = baseline(formula=formula,
-                                    num_variables=num_variables,
-                                    policy_network=policy_network,
-                                    device=device,
-                                    vars_permutation=vars_permutation,
-                                    logit_clipping=logit_clipping,
-                                    num_sat=num_sat).detach()
-
             # ###########################################################################
-            # print("5. After baseline:", torch.cuda.memory_allocated(device))
-            # print("\tAllocated:", round(torch.cuda.memory_allocated(device)/1024**3,1), "GB")
-            # print("\tCached:", round(torch.cuda.memory_reserved(device)/1024**3,1), "GB")
+            # b = torch.cuda.memory_allocated(device)
+            # ###########################################################################
+            # ###########################################################################
+            # print("\n4. Mem consumen by forward pass:", round((b-a)/1024**3, 1), "GB")
+            # print("\tAfter run an episode (forward pass):", torch.cuda.memory_allocated(device))
+            # print("\tAllocated:", round(torch.cuda.memory_allocated(device)/1024**3, 1), "GB")
+            # print("\tCached:", round(torch.cuda.memory_reserved(device)/1024**3, 1), "GB")
             # gpu_usage()  
             # ###########################################################################
-        policy_network.train()
+            policy_network.eval()
+            with torch.no_grad():
+                # Compute num of sat clauses
+                #num_sat = utils.num_sat_clauses_tensor(formula, buffer.action.detach().cpu().numpy()).detach()
+                num_sat = utils.num_sat_clauses_tensor(evaluator, buffer.action.detach()).detach()
+                # num_sat: [batch_size]
+
+                # Compute baseline
+                baseline_val = baseline(formula=evaluator,
+                                        num_variables=num_variables,
+                                        policy_network=policy_network,
+                                        device=device,
+                                        vars_permutation=vars_permutation,
+                                        logit_clipping=logit_clipping,
+                                        num_sat=num_sat).detach()
+
+                # ###########################################################################
+                # print("5. After baseline:", torch.cuda.memory_allocated(device))
+                # print("\tAllocated:", round(torch.cuda.memory_allocated(device)/1024**3,1), "GB")
+                # print("\tCached:", round(torch.cuda.memory_reserved(device)/1024**3,1), "GB")
+                # gpu_usage()  
+                # ###########################################################################
+            policy_network.train()
 
-        # Update entropy weight
-        #w_entropy = entropy_decay.update_w()
-        #w_entropy = 0
+            # Update entropy weight
+            #w_entropy = entropy_decay.update_w()
+            #w_entropy = 0
 
-        # Entropy
-        if entropy_estimator == "crude":
-            H = - buffer.action_log_prob_sum
-            # H: [batch_size]
+            # Entropy
+            if entropy_estimator == "crude":
+                H = - buffer.action_log_prob_sum
+                # H: [batch_size]
             
-            #log_prob_a = buffer.action_log_prob
-            # log_prob_a: [batch_size, seq_len=num_variables]
-            #H = - log_prob_a.sum(dim=-1)
-            # H: [batch_size]
+                #log_prob_a = buffer.action_log_prob
+                # log_prob_a: [batch_size, seq_len=num_variables]
+                #H = - log_prob_a.sum(dim=-1)
+                # H: [batch_size]
+
+            elif entropy_estimator == "smooth":
+                probs = buffer.action_probs
+                # probs: [batch_size, seq_len=num_variables, feature_size={1,2}]
+                if probs.shape[-1] == 1:
+                    probs = torch.cat([probs, 1-probs], dim=-1)
+                # probs: [batch_size, seq_len=num_variables, feature_size=2]
+                log_probs = torch.log(probs)
+                # log_probs: [batch_size, seq_len=num_variables, feature_size=2]
+                H = -torch.mul(probs, log_probs).sum(-1).sum(-1)
+                # H: [batch_size]
+            else:
+                raise ValueError(f"{entropy_estimator} is not a valid entropy estimator, try with 'crude' or'smooth'.")
+
+            # Loss (mean over batch)
+            log_prob = buffer.action_log_prob_sum
+            # log_prob: [batch_size]
+            #print("Devices:")
+            #print(num_sat.get_device(), baseline_val.get_device(), log_prob.get_device(), H.get_device())
+            pg_loss = ((num_sat.to(device) - baseline_val.to(device)) * log_prob + (beta_entropy * H)).mean()
+            # Normalize loss for gradient accumulation
+            loss = pg_loss / accumulation_episodes
+
+            # Gradient accumulation
+            loss.backward()
 
-        elif entropy_estimator == "smooth":
-            probs = buffer.action_probs
-            # probs: [batch_size, seq_len=num_variables, feature_size={1,2}]
-            if probs.shape[-1] == 1:
-                probs = torch.cat([probs, 1-probs], dim=-1)
-            # probs: [batch_size, seq_len=num_variables, feature_size=2]
-            log_probs = torch.log(probs)
-            # log_probs: [batch_size, seq_len=num_variables, feature_size=2]
-            H = -torch.mul(probs, log_probs).sum(-1).sum(-1)
-            # H: [batch_size]
-        else:
-            raise ValueError(f"{entropy_estimator} is not a valid entropy estimator, try with 'crude' or'smooth'.")
-
-        # Loss (mean over batch)
-        log_prob = buffer.action_log_prob_sum
-        # log_prob: [batch_size]
-        #print("Devices:")
-        #print(num_sat.get_device(), baseline_val.get_device(), log_prob.get_device(), H.get_device())
-        pg_loss = ((num_sat.to(device) - baseline_val.to(device)) * log_prob + (beta_entropy * H)).mean()
-        # Normalize loss for gradient accumulation
-        loss = pg_loss / accumulation_episodes
-
-        # Gradient accumulation
-        loss.backward()
-
-        # ###########################################################################
-        # print("6. After backward pass:", torch.cuda.memory_allocated(device))
-        # print("\tAllocated:", round(torch.cuda.memory_allocated(device)/1024**3,1), "GB")
-        # print("\tCached:", round(torch.cuda.memory_reserved(device)/1024**3,1), "GB")
-        # gpu_usage()  
-        # ###########################################################################
-        # Perform optimization step after accumulating gradients
-        if (episode % accumulation_episodes) == 0:
-            if clip_grad > 0:
-                nn.utils.clip_grad_norm_(policy_network.parameters(), clip_grad) 
-            optimizer.step()
             # ###########################################################################
-            # print("7. After optimizer step:", torch.cuda.memory_allocated(device))
+            # print("6. After backward pass:", torch.cuda.memory_allocated(device))
             # print("\tAllocated:", round(torch.cuda.memory_allocated(device)/1024**3,1), "GB")
             # print("\tCached:", round(torch.cuda.memory_reserved(device)/1024**3,1), "GB")
             # gpu_usage()  
             # ###########################################################################
-            optimizer.zero_grad()
+            # Perform optimization step after accumulating gradients
+            if (episode % accumulation_episodes) == 0:
+                if clip_grad > 0:
+                    nn.utils.clip_grad_norm_(policy_network.parameters(), clip_grad) 
+                optimizer.step()
+                # ###########################################################################
+                # print("7. After optimizer step:", torch.cuda.memory_allocated(device))
+                # print("\tAllocated:", round(torch.cuda.memory_allocated(device)/1024**3,1), "GB")
+                # print("\tCached:", round(torch.cuda.memory_reserved(device)/1024**3,1), "GB")
+                # gpu_usage()  
+                # ###########################################################################
+                optimizer.zero_grad()
             
-        # Logging
-        if (episode % log_interval) == 0:
-            num_sat_mean = num_sat.mean().item()
-            log_prob_mean = log_prob.mean().item()
-            H_mean = H.mean().item()
-
-            # Log values to screen
-            if verbose > 0:
-                print(f'\nEpisode: {episode}, samples: {current_samples}/{num_samples}, num_sat: {num_sat_mean}')
-                print('\tpg_loss: ({} - {}) * {} + ({} * {}) = {}'.format(num_sat_mean,
-                                                                          baseline_val.item(),
-                                                                          log_prob_mean,
-                                                                          beta_entropy,
-                                                                          H_mean,
-                                                                          pg_loss.item()))
+            # Logging
+            if (episode % log_interval) == 0:
+                num_sat_mean = num_sat.mean().item()
+                log_prob_mean = log_prob.mean().item()
+                H_mean = H.mean().item()
+
+                # Log values to screen
+                if verbose > 0:
+                    print(f'\nEpisode: {episode}, samples: {current_samples}/{num_samples}, num_sat: {num_sat_mean}')
+                    print('\tpg_loss: ({} - {}) * {} + ({} * {}) = {}'.format(num_sat_mean,
+                                                                              baseline_val.item(),
+                                                                              log_prob_mean,
+                                                                              beta_entropy,
+                                                                              H_mean,
+                                                                              pg_loss.item()))
             
-            if verbose == 2:
-                if extra_logging:
-                    print(f'logits: \n{buffer.action_logits}')
-                print(f'probs: \n{buffer.action_probs}')
+                if verbose == 2:
+                    if extra_logging:
+                        print(f'logits: \n{buffer.action_logits}')
+                    print(f'probs: \n{buffer.action_probs}')
             
-            if raytune:
-                report_dict['num_sat'] = num_sat_mean
-                report_dict['loss'] = (num_sat_mean - baseline_val.item()) * log_prob_mean + (beta_entropy * H_mean)
+                if raytune:
+                    report_dict['num_sat'] = num_sat_mean
+                    report_dict['loss'] = (num_sat_mean - baseline_val.item()) * log_prob_mean + (beta_entropy * H_mean)
 
 
-            if writer is not None:
-                writer.add_scalar('num_sat', num_sat_mean, current_samples, new_style=True)
-                writer.add_scalar('baseline', baseline_val.item(), current_samples, new_style=True)
-                writer.add_scalar('log_prob', log_prob_mean, current_samples, new_style=True)
+                if writer is not None:
+                    writer.add_scalar('num_sat', num_sat_mean, current_samples, new_style=True)
+                    writer.add_scalar('baseline', baseline_val.item(), current_samples, new_style=True)
+                    writer.add_scalar('log_prob', log_prob_mean, current_samples, new_style=True)
 
-                writer.add_scalar('pg_loss', (num_sat_mean - baseline_val.item()) * log_prob_mean, current_samples, new_style=True)
-                writer.add_scalar('pg_loss_with_ent', (num_sat_mean - baseline_val.item()) * log_prob_mean + (beta_entropy * H_mean), current_samples, new_style=True)
+                    writer.add_scalar('pg_loss', (num_sat_mean - baseline_val.item()) * log_prob_mean, current_samples, new_style=True)
+                    writer.add_scalar('pg_loss_with_ent', (num_sat_mean - baseline_val.item()) * log_prob_mean + (beta_entropy * H_mean), current_samples, new_style=True)
                 
-                writer.add_scalar('entropy/beta', beta_entropy, current_samples, new_style=True)
-                writer.add_scalar('entropy/entropy', H_mean, current_samples, new_style=True)
-                writer.add_scalar('entropy/beta*entropy', beta_entropy * H_mean, current_samples, new_style=True)
-
-                if extra_logging:
-                    d_output_size = buffer.action_probs.shape[-1]
-                    if (batch_size != 1) or (d_output_size != 1):
-                        raise ValueError("batch_size and output_size must be 1 for extra logging.")
+                    writer.add_scalar('entropy/beta', beta_entropy, current_samples, new_style=True)
+                    writer.add_scalar('entropy/entropy', H_mean, current_samples, new_style=True)
+                    writer.add_scalar('entropy/beta*entropy', beta_entropy * H_mean, current_samples, new_style=True)
 
-                    for i in range(num_variables):
-                        writer.add_scalar(f'buffer/action_probs/x[{i}]', buffer.action_probs[0][i][0], current_samples, new_style=True) # batch0, var_i, p(x_i = 1
+                    if reward_cache_mb > 0:
+                        writer.add_scalar('reward_cache/hits', evaluator.hits, current_samples, new_style=True)
+                        writer.add_scalar('reward_cache/misses', evaluator.misses, current_samples, new_style=True)
+                        writer.add_scalar('reward_cache/hit_rate', evaluator.hit_rate, current_samples, new_style=True)
 
-                    #writer.add_scalars('buffer/action_probs', {f'x[{i},{0}]': buffer.action_probs[0][i][0] for i in range(num_variables)}, current_samples) # batch0, var_i, p(x_i = 1)
+                    if extra_logging:
+                        d_output_size = buffer.action_probs.shape[-1]
+                        if (batch_size != 1) or (d_output_size != 1):
+                            raise ValueError("batch_size and output_size must be 1 for extra logging.")
 
-                    #writer.add_histogram('histogram/action_logits', buffer.action_logits, current_samples)
-                    #writer.add_histogram('histogram/action_probs', buffer.action_probs, current_samples)
-                    
-                    #if policy_network.decoder.decoder_type == "GRU" or policy_network.decoder.decoder_type == "LSTM":
-                    #    if policy_network.decoder.trainable_state:
-                    #        writer.add_histogram('params/init_state', policy_network.decoder.init_state, current_samples)
+                        for i in range(num_variables):
+                            writer.add_scalar(f'buffer/action_probs/x[{i}]', buffer.action_probs[0][i][0], current_samples, new_style=True) # batch0, var_i, p(x_i = 1
 
+                        #writer.add_scalars('buffer/action_probs', {f'x[{i},{0}]': buffer.action_probs[0][i][0] for i in range(num_variables)}, current_samples) # batch0, var_i, p(x_i = 1)
 
-        # Evaluation
-        if (episode % eval_interval) == 0:
-            if verbose > 0:
-                print('-------------------------------------------------')
-                print(f'Evaluation in episode: {episode}. Num samples: {current_samples}/{num_samples}. Num of sat clauses:')
-            policy_network.eval()
-            with torch.no_grad():
-                
-                for strat in eval_strategies:
-                    if (strat < 0) or (type(strat) != int):
-                        raise ValueError(f'Values in `eval_strategy` must be 0 if greedy or an integer greater or equal than 1 if sampled, got {strat}.')
-                    #if T < 1:
-                    #    raise ValueError(f"{T} is not a valid number for temperature, try with a flot greater than or equal with 1.")
-                    buffer = run_episode(num_variables = num_variables,
-                                         policy_network = policy_network,
-                                         device = device,
-                                         vars_permutation = vars_permutation,
-                                         strategy = 'greedy' if strat == 0 else 'sampled',
-                                         batch_size = 1 if strat == 0 else strat,
-                                         logit_clipping=logit_clipping,  # (int >= 0)
-                                         logit_temp=logit_temp,  # (float >= 1)
-                                         extra_logging=False)  
+                        #writer.add_histogram('histogram/action_logits', buffer.action_logits, current_samples)
+                        #writer.add_histogram('histogram/action_probs', buffer.action_probs, current_samples)
                     
-                    # ###########################################################################
-                    # print(f"8. After eval {strat} {T}:", torch.cuda.memory_allocated(device))
-                    # print("\tAllocated:", round(torch.cuda.memory_allocated(device)/1024**3,1), "GB")
-                    # print("\tCached:", round(torch.cuda.memory_reserved(device)/1024**3,1), "GB")
-                    # gpu_usage()  
-                    # ###########################################################################
+                        #if policy_network.decoder.decoder_type == "GRU" or policy_network.decoder.decoder_type == "LSTM":
+                        #    if policy_network.decoder.trainable_state:
+                        #        writer.add_histogram('params/init_state', policy_network.decoder.init_state, current_samples)
+
+
+            # Evaluation
+            if (episode % eval_interval) == 0:
+                if verbose > 0:
+                    print('-------------------------------------------------')
+                    print(f'Evaluation in episode: {episode}. Num samples: {current_samples}/{num_samples}. Num of sat clauses:')
+                policy_network.eval()
+                with torch.no_grad():
+                
+                    for strat in eval_strategies:
+                        if (strat < 0) or (type(strat) != int):
+                            raise ValueError(f'Values in `eval_strategy` must be 0 if greedy or an integer greater or equal than 1 if sampled, got {strat}.')
+                        #if T < 1:
+                        #    raise ValueError(f"{T} is not a valid number for temperature, try with a flot greater than or equal with 1.")
+                        buffer = run_episode(num_variables = num_variables,
+                                             policy_network = policy_network,
+                                             device = device,
+                                             vars_permutation = vars_permutation,
+                                             strategy = 'greedy' if strat == 0 else 'sampled',
+                                             batch_size = 1 if strat == 0 else strat,
+                                             logit_clipping=logit_clipping,  # (int >= 0)
+                                             logit_temp=logit_temp,  # (float >= 1)
+                                             extra_logging=False)  
                     
-                    # Compute num of sat clauses
-                    num_sat = utils.num_sat_clauses_tensor(formula, buffer.action.detach()).detach()
-                    # ::num_sat:: [batch_size]
-
-                    # Log values to screen
-                    if strat == 0:
-                        number_of_sat = num_sat.item()
-                        if verbose > 0:
-                            print(f'\tGreedy: {number_of_sat}.')
-                        if raytune:
-                            report_dict[f'num_sat_eval_greedy'] = number_of_sat
-                            #report_dict[f'num_sat_greedy_{str(T)}'] = number_of_sat
-                        
-                    else:
-                        number_of_sat = num_sat.max().item()
-                        if verbose > 0:
-                            print(f'\tBest of {strat} samples: {number_of_sat}.')
-                        if raytune:
-                            report_dict[f'num_sat_eval'] = number_of_sat
-                            #report_dict[f'num_sat_sample_{str(strat)}_{str(T)}'] = number_of_sat
+                        # ###########################################################################
+                        # print(f"8. After eval {strat} {T}:", torch.cuda.memory_allocated(device))
+                        # print("\tAllocated:", round(torch.cuda.memory_allocated(device)/1024**3,1), "GB")
+                        # print("\tCached:", round(torch.cuda.memory_reserved(device)/1024**3,1), "GB")
+                        # gpu_usage()  
+                        # ###########################################################################
                     
-                    # Keep tracking the active search solution
-                    if number_of_sat > active_search['num_sat']:
-                        active_search['num_sat'] = number_of_sat
-                        active_search['episode'] = episode
-                        active_search['samples'] = current_samples
-                        active_search['strategy'] = f"{'greedy' if strat == 0 else 'sampled'}{'' if strat == 0 else '-'+str(strat)}{'-'+str(logit_temp)}"
+                        # Compute num of sat clauses
+                        num_sat = utils.num_sat_clauses_tensor(evaluator, buffer.action.detach()).detach()
+                        # ::num_sat:: [batch_size]
 
+                        # Log values to screen
                         if strat == 0:
-                            active_search['sol'] = buffer.action.detach().tolist()
+                            number_of_sat = num_sat.item()
+                            if verbose > 0:
+                                print(f'\tGreedy: {number_of_sat}.')
+                            if raytune:
+                                report_dict[f'num_sat_eval_greedy'] = number_of_sat
+                                #report_dict[f'num_sat_greedy_{str(T)}'] = number_of_sat
+                        
                         else:
-                            idx = num_sat.argmax().item()
-                            active_search['sol'] = buffer.action[idx].detach().tolist() 
+                            number_of_sat = num_sat.max().item()
+                            if verbose > 0:
+                                print(f'\tBest of {strat} samples: {number_of_sat}.')
+                            if raytune:
+                                report_dict[f'num_sat_eval'] = number_of_sat
+                                #report_dict[f'num_sat_sample_{str(strat)}_{str(T)}'] = number_of_sat
+                    
+                        # Keep tracking the active search solution
+                        if number_of_sat > active_search['num_sat']:
+                            active_search['num_sat'] = number_of_sat
+                            active_search['episode'] = episode
+                            active_search['samples'] = current_samples
+                            active_search['strategy'] = f"{'greedy' if strat == 0 else 'sampled'}{'' if strat == 0 else '-'+str(strat)}{'-'+str(logit_temp)}"
+
+                            if strat == 0:
+                                active_search['sol'] = buffer.action.detach().tolist()
+                            else:
+                                idx = num_sat.argmax().item()
+                                active_search['sol'] = buffer.action[idx].detach().tolist() 
                         
-                        #torch.save(policy_network.state_dict(), os.path.join(checkpoint_dir, "best.pt"))   
+                            #torch.save(policy_network.state_dict(), os.path.join(checkpoint_dir, "best.pt"))   
 
-                    if writer is not None:
-                        writer.add_scalar(f"eval/{'greedy' if strat == 0 else 'sampled'}{'' if strat == 0 else '-'+str(strat)}",
-                                          number_of_sat, current_samples, new_style=True)
+                        if writer is not None:
+                            writer.add_scalar(f"eval/{'greedy' if strat == 0 else 'sampled'}{'' if strat == 0 else '-'+str(strat)}",
+                                              number_of_sat, current_samples, new_style=True)
                         
-                        # if extra_logging:
-                        #     dec_output_size = policy_network.decoder.dense_out.bias.shape[0]  # decoder's output can be of size 1 or 2.
-                        #     if strat == 0:
-                        #         writer.add_scalars('eval_buffer/actions', {f'x[{i}]': buffer.action[0][i] for i in range(num_variables)}, current_samples)
-                        #         for out in range(dec_output_size):
-                        #             writer.add_scalars('eval_buffer/logits', {f'x[{i},{out}]': buffer.action_logits[0][i][out] for i in range(num_variables)}, current_samples)  # batch0, var_i, unormalized p(x_i)
-                        #             writer.add_scalars('eval_buffer/probs', {f'x[{i},{out}]': buffer.action_probs[0][i][out] for i in range(num_variables)}, current_samples) # batch0, var_i, p(x_i)
+                            # if extra_logging:
+                            #     dec_output_size = policy_network.decoder.dense_out.bias.shape[0]  # decoder's output can be of size 1 or 2.
+                            #     if strat == 0:
+                            #         writer.add_scalars('eval_buffer/actions', {f'x[{i}]': buffer.action[0][i] for i in range(num_variables)}, current_samples)
+                            #         for out in range(dec_output_size):
+                            #             writer.add_scalars('eval_buffer/logits', {f'x[{i},{out}]': buffer.action_logits[0][i][out] for i in range(num_variables)}, current_samples)  # batch0, var_i, unormalized p(x_i)
+                            #             writer.add_scalars('eval_buffer/probs', {f'x[{i},{out}]': buffer.action_probs[0][i][out] for i in range(num_variables)}, current_samples) # batch0, var_i, p(x_i)
                                 
-                        #     else:
-                        #         idx = num_sat.argmax().item()
-                        #         writer.add_scalars('eval_buffer/actions', {f'x[{i}]': buffer.action[idx][i] for i in range(num_variables)}, current_samples)
-                        #         for out in range(dec_output_size):
-                        #             writer.add_scalars('eval_buffer/logits', {f'x[{i},{out}]': buffer.action_logits[idx][i][out] for i in range(num_variables)}, current_samples)  # batch idx, var_i, unormalized p(x_i)
-                        #             writer.add_scalars('eval_buffer/probs', {f'x[{i},{out}]': buffer.action_probs[idx][i][out] for i in range(num_variables)}, current_samples) # batch idx, var_i, p(x_i)
+                            #     else:
+                            #         idx = num_sat.argmax().item()
+                            #         writer.add_scalars('eval_buffer/actions', {f'x[{i}]': buffer.action[idx][i] for i in range(num_variables)}, current_samples)
+                            #         for out in range(dec_output_size):
+                            #             writer.add_scalars('eval_buffer/logits', {f'x[{i},{out}]': buffer.action_logits[idx][i][out] for i in range(num_variables)}, current_samples)  # batch idx, var_i, unormalized p(x_i)
+                            #             writer.add_scalars('eval_buffer/probs', {f'x[{i},{out}]': buffer.action_probs[idx][i][out] for i in range(num_variables)}, current_samples) # batch idx, var_i, p(x_i)
             
-            # Saving the best solution so far
-            active_search['total_samples'] = current_samples
-            active_search['total_episodes'] = episode
-            with open(os.path.join(save_dir, "solution.json"), 'w') as f:
-                json.dump(active_search, f, indent=4)
-
-            if verbose > 0:
-                print(f"\tActive search: {active_search['num_sat']}.")
-                print('-------------------------------------------------\n')
+                # Saving the best solution so far
+                active_search['total_samples'] = current_samples
+                active_search['total_episodes'] = episode
+                with open(os.path.join(save_dir, "solution.json"), 'w') as f:
+                    json.dump(active_search, f, indent=4)
+
+                if verbose > 0:
+                    print(f"\tActive search: {active_search['num_sat']}.")
+                    print('-------------------------------------------------\n')
             
-            if writer is not None:
-                writer.add_scalar('active_search', active_search['num_sat'], current_samples, new_style=True)
+                if writer is not None:
+                    writer.add_scalar('active_search', active_search['num_sat'], current_samples, new_style=True)
             
-            # ###########################################################################
-            # print("-"*50)
-            # print(f"Max allocated", round(torch.cuda.max_memory_allocated(device)/1024**3, 1), "GB")
-            # print(f"Max reserved", round(torch.cuda.max_memory_reserved(device)/1024**3, 1), "GB")
-            # print("-"*50)
-            # torch.cuda.reset_peak_memory_stats(device=None)
-            # ###########################################################################
-            if raytune:                
-                #torch.save((policy_network.state_dict(), optimizer.state_dict()), os.path.join(checkpoint_dir, "checkpoint.pt"))
-                #checkpoint = Checkpoint.from_directory(checkpoint_dir)
-                # episode, samples, loss, num_sat, num_sat_greedy, num_sat_sample_k
-                report_dict['episode'] = episode
-                report_dict['samples'] = current_samples        
-                #session.report(report_dict, checkpoint=checkpoint)
-                session.report(report_dict)
-
-            policy_network.train()
+                # ###########################################################################
+                # print("-"*50)
+                # print(f"Max allocated", round(torch.cuda.max_memory_allocated(device)/1024**3, 1), "GB")
+                # print(f"Max reserved", round(torch.cuda.max_memory_reserved(device)/1024**3, 1), "GB")
+                # print("-"*50)
+                # torch.cuda.reset_peak_memory_stats(device=None)
+                # ###########################################################################
+                if raytune:                
+                    #torch.save((policy_network.state_dict(), optimizer.state_dict()), os.path.join(checkpoint_dir, "checkpoint.pt"))
+                    #checkpoint = Checkpoint.from_directory(checkpoint_dir)
+                    # episode, samples, loss, num_sat, num_sat_greedy, num_sat_sample_k
+                    report_dict['episode'] = episode
+                    report_dict['samples'] = current_samples        
+                    #session.report(report_dict, checkpoint=checkpoint)
+                    session.report(report_dict)
+
+                policy_network.train()
 
     
-        if (current_samples >= num_samples):
-            criteria = 'Maximum number of episodes reached'
-            break
+            if (current_samples >= num_samples):
+                criteria = 'Maximum number of episodes reached'
+                break
  
-        elif sat_stopping and (active_search['num_sat'] == len(formula)):
-            criteria = 'All clauses have been satisfied'
-            break
+            elif sat_stopping and (active_search['num_sat'] == len(formula)):
+                criteria = 'All clauses have been satisfied'
+                break
+    finally:
+        if eval_workers > 0:
+            shared_evaluator.close()
             
     if verbose > 0:
         print('-------------------------------------------------')
@@ -651,10 +677,150 @@ def train(formula,
         print("\tSol:")
         print(active_search['sol'])
         print('-------------------------------------------------\n')
-        
+
     return active_search
 
 
+def train_stream(stream,
+                 policy_network,
+                 optimizer,
+                 device,
+                 baseline,
+                 dec_var_initializer,
+                 dec_context_initializer,
+                 vars_permutation,
+                 num_instances=1000,
+                 episodes_per_instance=1,
+                 batch_size=1,
+                 logit_clipping=0,  # (int >= 0)
+                 entropy_estimator='crude',  # {'crude', 'smooth'}
+                 beta_entropy=0,
+                 clip_grad=0,  # (float >= 0)
+                 accumulation_episodes=1,
+                 log_interval=100,
+                 writer=None,  # Tensorboard writer
+                 save_dir='outputs',
+                 verbose=1):
+    """ Trains one policy across many formulas following Policy Gradient Theorem.
+
+    Instead of a single formula, the policy is trained on the instances of `stream`
+    (e.g. a `streaming.InstanceStream`), `episodes_per_instance` episodes each. All the
+    instances must have the same number of variables as the policy.
+
+    ARGUMENTS
+    ----------
+        stream: iterator of (n, m, formula) instances.
+        dec_var_initializer, dec_context_initializer: initializers of the policy, applied
+            to every instance (without node2vec embeddings).
+        vars_permutation: callable (num_variables, formula) -> permutation of the variables.
+        num_instances: int. Number of instances taken from `stream`. Default: 1000.
+        episodes_per_instance: int. Episodes of every instance. Default: 1.
+        log_interval: int. Log info every `log_interval` episodes. Default: 100.
+
+    RETURNS
+    --------
+        summary: dic. Number of instances and episodes, and the mean fraction of
+            satisfied clauses of the last `log_interval` episodes.
+    """
+    if verbose not in (0, 1, 2):
+        raise ValueError(f'Verbose must be 0, 1, or 2, got {verbose}.')
+
+    policy_network.to(device)
+    policy_network.train()
+    optimizer.zero_grad()
+
+    summary = {'instances': 0,
+               'episodes': 0,
+               'sat_ratio': None}
+    sat_ratios = []
+    episode = 0
+    for instance in tqdm(range(1, num_instances + 1), disable=verbose == 0, ascii=True):
+        num_variables, num_clauses, formula = next(stream)
+
+        # Point the policy and the rewards to the new instance.
+        policy_network.dec_vars = dec_var_initializer(None, formula, num_variables)
+        policy_network.dec_context = dec_context_initializer(None, formula, num_variables)
+        evaluator = build_evaluator(formula, num_variables)
+        permutation = vars_permutation(num_variables, formula)
+
+        for _ in range(episodes_per_instance):
+            episode += 1
+            buffer = run_episode(num_variables=num_variables,
+                                 policy_network=policy_network,
+                                 device=device,
+                                 vars_permutation=permutation,
+                                 strategy='sampled',
+                                 batch_size=batch_size,
+                                 logit_clipping=logit_clipping,
+                                 logit_temp=1,
+                                 extra_logging=False)
+
+            policy_network.eval()
+            with torch.no_grad():
+                num_sat = utils.num_sat_clauses_tensor(evaluator, buffer.action.detach()).detach()
+                # num_sat: [batch_size]
+                baseline_val = baseline(formula=evaluator,
+                                        num_variables=num_variables,
+                                        policy_network=policy_network,
+                                        device=device,
+                                        vars_permutation=permutation,
+                                        logit_clipping=logit_clipping,
+                                        num_sat=num_sat).detach()
+            policy_network.train()
+
+            # Entropy
+            if entropy_estimator == "crude":
+                H = - buffer.action_log_prob_sum
+            elif entropy_estimator == "smooth":
+                probs = buffer.action_probs
+                if probs.shape[-1] == 1:
+                    probs = torch.cat([probs, 1-probs], dim=-1)
+                H = -torch.mul(probs, torch.log(probs)).sum(-1).sum(-1)
+            else:
+                raise ValueError(f"{entropy_estimator} is not a valid entropy estimator, try with 'crude' or'smooth'.")
+            # H: [batch_size]
+
+            log_prob = buffer.action_log_prob_sum
+            pg_loss = ((num_sat.to(device) - baseline_val.to(device)) * log_prob + (beta_entropy * H)).mean()
+            loss = pg_loss / accumulation_episodes
+            loss.backward()
+
+            if (episode % accumulation_episodes) == 0:
+                if clip_grad > 0:
+                    nn.utils.clip_grad_norm_(policy_network.parameters(), clip_grad)
+                optimizer.step()
+                optimizer.zero_grad()
+
+            # Rewards are comparable across instances as fractions of satisfied clauses.
+            sat_ratios.append(num_sat.float().mean().item() / max(num_clauses, 1))
+            if (episode % log_interval) == 0:
+                summary['sat_ratio'] = float(np.mean(sat_ratios))
+                sat_ratios = []
+                if verbose > 0:
+                    print(f"\nInstance: {instance}/{num_instances}, episode: {episode}, sat_ratio: {summary['sat_ratio']}, pg_loss: {pg_loss.item()}")
+                if writer is not None:
+                    writer.add_scalar('stream/sat_ratio', summary['sat_ratio'], episode, new_style=True)
+                    writer.add_scalar('stream/pg_loss', pg_loss.item(), episode, new_style=True)
+                    writer.add_scalar('entropy/entropy', H.mean().item(), episode, new_style=True)
+
+        summary['instances'] = instance
+        summary['episodes'] = episode
+
+    if sat_ratios:
+        summary['sat_ratio'] = float(np.mean(sat_ratios))
+    torch.save(policy_network.state_dict(), os.path.join(save_dir, "policy.pt"))
+    with open(os.path.join(save_dir, "stream_summary.json"), 'w') as f:
+        json.dump(summary, f, indent=4)
+
+    if verbose > 0:
+        print('-------------------------------------------------')
+        print(f"Stream training finished after {summary['instances']} instances and {summary['episodes']} episodes.")
+        print(f"\tSat ratio: {summary['sat_ratio']}")
+        print('-------------------------------------------------\n')
+
+    return summary
+
+
 
 
 
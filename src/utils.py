@@ -18,6 +18,12 @@ from ray.air import session
 from torch_geometric.nn import Node2Vec
 from tqdm import tqdm
 import os
+from collections import OrderedDict
+
+from src.evaluators import BaseEvaluator, build_evaluator, flatten_formula
+from src.dimacs import dimacs2flat, flat2list, var_counts, fingerprint
+from src.formula_cache import load_flat, load_fingerprint, iter_flat, content_hash
+import src.shards as shards
 
 
 def control_time(start_time: int, end_time: int):
@@ -56,26 +62,26 @@ class FixedVarsPermutation:
     If importances is set to True, then the permutation is based on the number of incidences
     the variables have in the formula; when importances is False, a fixed permutation
     is generated at random.
+
+    The formula can be a list in CNF, flat (literals, offsets) arrays or an iterable of
+    (literals, offsets) blocks such as `dimacs.iter_dimacs(path)`, which are counted
+    one block at a time.
     """
     def __init__(self, num_variables, formula, importance=True):
         if importance:
-            # Initialize the incidence count of each variable to zero.
-            var_count = {}
-            for var in range(num_variables):
-                # +1 because DIMACS format starts indexing variables from 1.
-                var_count[var+1] = 0
-            
+            if isinstance(formula, list):
+                blocks = [flatten_formula(formula)]
+            elif isinstance(formula, tuple):
+                blocks = [formula]
+            else:
+                blocks = formula
+
             # Counts the number of times each variable appears in the formula.
-            for clause in formula:
-                for literal in clause:
-                    var = abs(literal)
-                    var_count[var] += 1
+            var_count = var_counts(blocks, num_variables)
             
             # Sort the variables in decreasing order based on their values, breaking ties by choosing the variable with the larges index.
-            sorted_counts = sorted(var_count.items(), key=lambda x: (x[1], x[0]), reverse=True)
-            
-            # Return the sorted variables as a list. -1 because the variables are indexed from 0 to num_variables-1 in the code.
-            self.sorted_variables = [item[0]-1 for item in sorted_counts]
+            # Variables are indexed from 0 to num_variables-1 in the code.
+            self.sorted_variables = np.lexsort((np.arange(num_variables), var_count))[::-1].tolist()
         
         else:
             # Generate a random permutation of the variables
@@ -142,7 +148,8 @@ def num_sat_clauses_tensor(formula, assignment):
     
     Arguments
     ---------
-    -formula (list): A SAT formula in CNF.
+    -formula (list or BaseEvaluator): A SAT formula in CNF or a formula
+                already compiled with `build_evaluator`.
     -assignment (tensor):: Assignment to be verified. Must be a torch tensor
                 with shape [batch_size, num_variables]; e.g.: [[0,1,1], [1,0,1]].
    
@@ -150,15 +157,36 @@ def num_sat_clauses_tensor(formula, assignment):
     -------
     -num_sat (tensor): Number of satisfied clauses with shape [batch_size].
     '''
-    if not type(assignment) == torch.tensor:
-        assert TypeError("'assignment' must be a tensor with shape [batch_size, num_variables]")
+    if isinstance(formula, BaseEvaluator):
+        evaluator = formula
+    else:
+        evaluator = build_evaluator(formula, num_variables=assignment.shape[-1])
+    return evaluator.num_sat(assignment)  # [batch_size]
 
-    batch_size = assignment.shape[0]
-    num_sat_list = []
-    for b in range(batch_size):
-        _, num_sat, _ = num_sat_clauses(formula, assignment[b])
-        num_sat_list.append(num_sat)
-    return torch.tensor(num_sat_list, dtype=float)  # [batch_size]
+
+def eval_clauses_tensor(formula, assignment):
+    '''Evaluates every clause of a CNF formula for a batch of assignments.
+    It is the batch version of the `eval_formula` list returned by num_sat_clauses.
+
+    Arguments
+    ---------
+    -formula (list or BaseEvaluator): A SAT formula in CNF or a formula
+                already compiled with `build_evaluator`.
+    -assignment (tensor): Assignment to be verified. Must be a torch tensor
+                with shape [batch_size, num_variables]; e.g.: [[0,1,1], [1,0,1]].
+
+    Returns
+    -------
+    -clause_sat (tensor): Bool tensor with shape [batch_size, num_clauses].
+    -unsat_clauses (tuple): Tensors with the indices of the unsatisfied clauses of each assignment.
+    '''
+    if isinstance(formula, BaseEvaluator):
+        evaluator = formula
+    else:
+        evaluator = build_evaluator(formula, num_variables=assignment.shape[-1])
+    clause_sat, unsat_idx, unsat_offsets = evaluator.unsat_clauses(assignment)
+    unsat_clauses = torch.split(unsat_idx, torch.diff(unsat_offsets).tolist())
+    return clause_sat, unsat_clauses
 
 
 def num_sat_clauses(formula, assignment):
@@ -192,8 +220,73 @@ def num_sat_clauses(formula, assignment):
     return is_sat, num_sat, eval_formula
 
 
+class MinisatChecker:
+    """Loads a CNF formula into a MinisatSolver once, so that any number of
+    assignments can be verified (or the formula solved) without re-adding
+    the variables and clauses each time.
+
+    Use `get_checker` to share checkers between callers.
+    """
+    def __init__(self, formula, num_variables):
+        self.formula = formula
+        self.num_variables = num_variables
+        if isinstance(formula, tuple):
+            # Flat (literals, offsets) formula.
+            formula = flat2list(*flatten_formula(formula))
+        self.num_clauses = len(formula)
+        self.solver = minisolvers.MinisatSolver()
+        for _ in range(num_variables):
+            self.solver.new_var()
+        for clause in formula:
+            self.solver.add_clause(clause)
+
+    def check(self, assignment):
+        """Returns True if the assignment (a list of 1s and 0s) satisfies the formula."""
+        a = list(np.where(np.array(assignment)==1)[0] + np.array(1))
+        return self.solver.check_complete(positive_lits=a)
+
+    def check_batch(self, assignments):
+        """Verifies every row of an array or tensor with shape [batch_size, num_variables].
+        Returns a list of bools."""
+        if torch.is_tensor(assignments):
+            assignments = assignments.detach().cpu().numpy()
+        assignments = np.asarray(assignments)
+        return [self.solver.check_complete(positive_lits=list(np.flatnonzero(row == 1) + 1))
+                for row in assignments]
+
+    def solve(self):
+        """Runs MiniSat. Returns the model (a list of 1s and 0s, None if UNSAT) and is_sat."""
+        assignment = None
+        is_sat = self.solver.solve()
+        if is_sat:
+            assignment = list(self.solver.get_model())
+        return assignment, is_sat
+
+
+# Checkers by formula identity, in least recently used order.
+_checker_cache = OrderedDict()
+CHECKER_CACHE_SIZE = 16
+
+
+def get_checker(formula, num_variables):
+    """Returns the MinisatChecker of a formula, building it only the first time.
+    Checkers are keyed by formula identity (the same list object), so a formula
+    must not be modified in place once it has been checked."""
+    key = (id(formula), num_variables)
+    checker = _checker_cache.get(key)
+    if (checker is None) or (checker.formula is not formula) or \
+            (not isinstance(formula, tuple) and checker.num_clauses != len(formula)):
+        checker = MinisatChecker(formula, num_variables)
+        _checker_cache[key] = checker
+        if len(_checker_cache) > CHECKER_CACHE_SIZE:
+            _checker_cache.popitem(last=False)
+    _checker_cache.move_to_end(key)
+    return checker
+
+
 def assignment_eval(formula, assignment):
     """Uses PyMiniSolver to quickly check if an assignment satisfies or not a CNF formula. 
+    The formula is loaded into the solver only once (see `get_checker`).
 
     Arguments
     ----------
@@ -206,18 +299,36 @@ def assignment_eval(formula, assignment):
     -sat (bool): True if assigment satisfies the formula, else False.
     """
     # TODO: Verify if the assignment includes all variables.
-    S = minisolvers.MinisatSolver()
-    for _ in range(len(assignment)):
-            S.new_var()
-    for clause in formula:
-        S.add_clause(clause)
-    a = list(np.where(np.array(assignment)==1)[0] + np.array(1))
-    return S.check_complete(positive_lits=a)
+    return get_checker(formula, len(assignment)).check(assignment)
+
+
+def _read_flat(dimacs_path, cache=True, cache_dir=None):
+    "n, m, literals and offsets of a DIMACS file or of a shard:// reference (see src/shards.py)."
+    if shards.is_shard_ref(dimacs_path):
+        return shards.load_flat(dimacs_path)
+    if cache:
+        return load_flat(dimacs_path, cache_dir)
+    return dimacs2flat(dimacs_path)
+
 
+def formula_fingerprint(dimacs_path, cache=True, cache_dir=None):
+    '''Canonical fingerprint (see `dimacs.fingerprint`) of a DIMACS file or a shard reference.
+    Derived artifacts, such as node2vec embeddings and solutions, are keyed by it instead
+    of by path, so renamed or copied instances share them and different formulas never do.'''
+    if shards.is_shard_ref(dimacs_path):
+        return shards.load_fingerprint(dimacs_path)
+    if cache:
+        return load_fingerprint(dimacs_path, cache_dir)
+    n, _, literals, offsets = dimacs2flat(dimacs_path)
+    return fingerprint(n, literals, offsets)
 
-def dimacs2list(dimacs_path):
+
+def dimacs2list(dimacs_path, cache=True, cache_dir=None):
     '''Reads a cnf file and returns the CNF formula
-    in numpy format. 
+    in list format. The file is read through its binary cache (see
+    `formula_cache.load_flat`), which is written next to the file, or in
+    `cache_dir`, the first time; set `cache` to False to always parse the text.
+    `dimacs_path` can also be a 'shard://<shard_dir>#<name>' reference.
         Args:
             dimacs_file (str): path to the DIMACS file.
         Returns:
@@ -225,65 +336,90 @@ def dimacs2list(dimacs_path):
             m (int): Number of clauses in the formula.
             formula (list): CNF formula.
     '''
-    with open(dimacs_path, 'r') as f:
-        dimacs = f.read()
-
-    formula = []
-    for line in dimacs.split('\n'):
-        line = line.split()
-        if line[0] == 'p':
-            n = int(line[2])
-            m = int(line[3])
-        elif len(line) != 0 and line[0] not in ("p","c","%"):
-            clause = []
-            for literal in line:
-                literal = int(literal)
-                if literal == 0:
-                    break
-                else:
-                    clause.append(literal)
-            formula.append(clause)
-        elif line[0] == '%':
-            break
+    n, m, literals, offsets = _read_flat(dimacs_path, cache, cache_dir)
+    formula = flat2list(literals, offsets)
     return n, m, formula
 
 
-def dimacs2graph(dimacs_path):
+def clause_edges(num_variables, literals, offsets, first_clause=0):
     """
-    Builds a graph from a dimacs file. The returned graph has the following elements:
-        - 2n+m 1-dimensional nodes {0, 1, 2, ..., 2n+m-1} representing x_{0}, x_{1}, ..., x_{n-1}, -x_{0}, -x_{1},..., -x{n-1}, c_{0}, c_{1},..., c_{m-1}.
-        - A set of edges between each literal and its negation, e.g.: the edge from x_{0} to -x_{0}.
-        - Edges between literals and clauses.
+    Returns the literal-clause edges, in both directions, of a block of clauses as a
+    [2, 2*num_literals] tensor. `first_clause` is the index of the first clause of the block.
     """
+    n = num_variables
+    literals = np.asarray(literals, dtype=np.int64)
+    clause_node = 2 * n + first_clause + np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    literal_node = np.where(literals > 0, literals - 1, -literals + n - 1)
+    edges = np.stack([np.stack([clause_node, literal_node], axis=1),
+                      np.stack([literal_node, clause_node], axis=1)], axis=1).reshape(-1, 2)
+    return torch.from_numpy(edges).t()
 
-    # Load the formula in dimacs format and convert to list 
-    n, m, formula = dimacs2list(dimacs_path = dimacs_path)
 
-    # Nodes represented by a 2n+m x 1 tensor
-    nodes = torch.tensor([[u] for u in range(2 * n + m)], dtype=torch.long)
+def formula2graph(num_variables, literals, offsets, block_size=100000, validate=False):
+    """
+    Builds the graph of `dimacs2graph` from a flat formula (see `dimacs.dimacs2flat`).
+    The edges are computed with NumPy in blocks of `block_size` clauses (see `clause_edges`).
+    Returns the number of clauses and the graph.
+    """
+    n = num_variables
 
     # Edges between literals and their negations
-    edges = []
-    for u in range(n):
-        edges.append([u, u+n])
-        edges.append([u+n, u])
+    u = np.arange(n)
+    neg_edges = torch.from_numpy(np.stack([np.stack([u, u + n], axis=1),
+                                           np.stack([u + n, u], axis=1)], axis=1).reshape(-1, 2)).t()
 
     # Edges between litarals and clauses
-    for c, clause in enumerate(formula):
-        clause_node = 2 * n + c
-        for lit in clause:
-            literal_node = lit-1 if lit > 0 else -lit + n -1
-            edges.append([clause_node, literal_node])
-            edges.append([literal_node, clause_node])
+    edges = [neg_edges]
+    m = 0
+    for block_literals, block_offsets in iter_flat(literals, offsets, block_size=block_size):
+        edges.append(clause_edges(n, block_literals, block_offsets, first_clause=m))
+        m += len(block_offsets) - 1
     
     # Edges
-    edge_index = torch.tensor(edges, dtype=torch.long)
+    edge_index = torch.cat(edges, dim=1).contiguous()
+
+    # Nodes represented by a 2n+m x 1 tensor
+    nodes = torch.arange(2 * n + m, dtype=torch.long).unsqueeze(1)
 
     graph = Data(x=nodes,
-                edge_index=edge_index.t().contiguous())
+                edge_index=edge_index)
+
+    if validate:
+        graph.validate(raise_on_error=True)
+
+    return m, graph
+
 
-    graph.validate(raise_on_error=True)
+# Graphs built by dimacs2graph, keyed by formula content, so node2vec, plots and
+# GNN encoders that load the same formula share one construction. The key is the exact
+# content hash and not the fingerprint: clause node ids depend on the clause order.
+_graph_cache = OrderedDict()
+GRAPH_CACHE_SIZE = 8
 
+
+def dimacs2graph(dimacs_path, block_size=100000, cache=True, cache_dir=None, validate=False):
+    """
+    Builds a graph from a dimacs file. The returned graph has the following elements:
+        - 2n+m 1-dimensional nodes {0, 1, 2, ..., 2n+m-1} representing x_{0}, x_{1}, ..., x_{n-1}, -x_{0}, -x_{1},..., -x{n-1}, c_{0}, c_{1},..., c_{m-1}.
+        - A set of edges between each literal and its negation, e.g.: the edge from x_{0} to -x_{0}.
+        - Edges between literals and clauses.
+    The formula is memory-mapped from its binary cache (see `formula_cache.load_flat`), or
+    read from the text when `cache` is False, and the edges are built by `formula2graph`.
+    Shard references are also accepted. Graphs are kept in memory by content hash (the
+    last GRAPH_CACHE_SIZE formulas), so the returned graph is shared and must not be
+    modified in place. Set `validate` to run `graph.validate` on new graphs.
+    """
+    n, _, literals, offsets = _read_flat(dimacs_path, cache, cache_dir)
+
+    key = (n, content_hash(literals, offsets))
+    if key in _graph_cache:
+        _graph_cache.move_to_end(key)
+        return (n, *_graph_cache[key])
+
+    m, graph = formula2graph(n, literals, offsets, block_size=block_size, validate=validate)
+    _graph_cache[key] = (m, graph)
+    if len(_graph_cache) > GRAPH_CACHE_SIZE:
+        _graph_cache.popitem(last=False)
     return n, m, graph
 
 
@@ -381,7 +517,8 @@ def node2vec(dimacs_path,
              file_name='node_emb',
              num_workers=0,
              raytune=False,
-             verbose=2):
+             verbose=2,
+             cache=None):
     """
     Computes node2vec embeddings.
     If raytune is set to True, then no node2vec embeddings are saved
@@ -390,6 +527,10 @@ def node2vec(dimacs_path,
     PARAMETERS
     ----------
         verbose: int, {0,1,2}. 0 for no verbose, 2 for max verbose.
+        cache: N2VCache. If given, the embeddings are stored in it, keyed by the
+            fingerprint of the formula and the hyperparameters (see src/n2v_cache.py),
+            instead of at save_path/file_name.pt. If save_path is None and there is no
+            cache, they are not saved.
 
     RETURNS
     ----------
@@ -403,10 +544,11 @@ def node2vec(dimacs_path,
     # Load the formula in dimacs format and convert to torch graph
     #n, m, graph = utils.dimacs2graph(dimacs_path=dimacs_path)
     n, m, graph = dimacs2graph(dimacs_path=dimacs_path)
-    graph = graph.to(device)
+    # Data.to works in place, so only a copy of the edges of the cached graph is moved.
+    edge_index = graph.edge_index.to(device)
 
     # Model definition
-    model = Node2Vec(edge_index=graph.edge_index,
+    model = Node2Vec(edge_index=edge_index,
                      embedding_dim=embedding_dim,
                      walk_length=walk_length,
                      context_size=context_size,
@@ -438,13 +580,177 @@ def node2vec(dimacs_path,
             # ::embeddings:: [seq_len=2n+m, feature_size=emb_dim]
 
         # Save embeddings
-        emb_path = os.path.join(save_path, file_name + ".pt")
-        torch.save(embeddings, emb_path)
+        if cache is not None:
+            params = {'embedding_dim': embedding_dim,
+                      'walk_length': walk_length,
+                      'context_size': context_size,
+                      'walks_per_node': walks_per_node,
+                      'p': p,
+                      'q': q,
+                      'batch_size': batch_size,
+                      'lr': lr,
+                      'num_epochs': num_epochs}
+            cache.put(formula_fingerprint(dimacs_path), params, embeddings)
+        elif save_path is not None:
+            emb_path = os.path.join(save_path, file_name + ".pt")
+            torch.save(embeddings, emb_path)
 
     return embeddings
     
 
 
+class UnionNode2Vec(Node2Vec):
+    """Node2Vec on a disjoint union of graphs. Random walks never leave their component,
+    and negative samples are drawn from the component of the start node as well, so
+    every component is trained as if it were alone.
+
+    PARAMETERS
+    ----------
+        node_offsets: Tensor. First node of every component plus the total number of
+            nodes, with shape [num_components+1].
+    """
+    def __init__(self, edge_index, node_offsets, *args, **kwargs):
+        super().__init__(edge_index, *args, num_nodes=int(node_offsets[-1]), **kwargs)
+        sizes = node_offsets[1:] - node_offsets[:-1]
+        component = torch.repeat_interleave(torch.arange(len(sizes)), sizes)
+        # First node and number of nodes of the component of every node.
+        self.register_buffer('node_start', node_offsets[:-1][component], persistent=False)
+        self.register_buffer('node_count', sizes[component], persistent=False)
+
+    def neg_sample(self, batch):
+        batch = batch.repeat(self.walks_per_node * self.num_negative_samples)
+
+        start = self.node_start.to(batch.device)[batch].view(-1, 1)
+        count = self.node_count.to(batch.device)[batch].view(-1, 1)
+        rw = start + (torch.rand((batch.size(0), self.walk_length), device=batch.device) * count).long()
+        rw = torch.minimum(rw, start + count - 1)
+        rw = torch.cat([batch.view(-1, 1), rw], dim=-1)
+
+        walks = []
+        num_walks_per_rw = 1 + self.walk_length + 1 - self.context_size
+        for j in range(num_walks_per_rw):
+            walks.append(rw[:, j:j + self.context_size])
+        return torch.cat(walks, dim=0)
+
+    def loss(self, pos_rw, neg_rw):
+        """Same loss as Node2Vec.loss, but every node is looked up once per batch. The
+        batches of a union are large and repeat nodes a lot, and the sparse gradient
+        then has one row per distinct node, which makes SparseAdam much cheaper."""
+        rw = torch.cat([pos_rw.view(-1), neg_rw.view(-1)])
+        # Distinct nodes and the position of every node among them, without sorting.
+        present = torch.zeros(self.num_nodes, dtype=torch.bool, device=rw.device)
+        present[rw] = True
+        position = torch.cumsum(present, dim=0) - 1
+        h = self.embedding(present.nonzero().view(-1))
+        # ::h:: [num_distinct_nodes, embedding_dim]
+
+        def scores(walks):
+            walks = position[walks]
+            h_start = h.index_select(0, walks[:, 0]).unsqueeze(1)
+            h_rest = h.index_select(0, walks[:, 1:].reshape(-1)).view(walks.size(0), -1, self.embedding_dim)
+            return (h_start * h_rest).sum(dim=-1).view(-1)
+
+        pos_loss = -torch.log(torch.sigmoid(scores(pos_rw)) + self.EPS).mean()
+        neg_loss = -torch.log(1 - torch.sigmoid(scores(neg_rw)) + self.EPS).mean()
+
+        return pos_loss + neg_loss
+
+
+def node2vec_batch(dimacs_paths,
+                   device,
+                   embedding_dim=64,
+                   walk_length=20,
+                   context_size=10,
+                   walks_per_node=10,
+                   p=1,
+                   q=1,
+                   batch_size=32,
+                   lr=0.01,
+                   num_epochs=100,
+                   num_workers=0,
+                   verbose=2,
+                   cache=None):
+    """
+    Computes the node2vec embeddings of many formulas with a single model.
+    The graphs of the formulas (see `dimacs2graph`) are merged into one disjoint union,
+    so one embedding table and one optimizer are trained for all of them (see
+    `UnionNode2Vec`), and the table is sliced back into the embeddings of every formula.
+    Each loader batch has `batch_size` start nodes per formula, so an epoch takes as many
+    steps as one formula alone would. Much faster than `node2vec` formula by formula
+    for many small formulas.
+
+    PARAMETERS
+    ----------
+        dimacs_paths: list of DIMACS files or shard references.
+        verbose: int, {0,1,2}. 0 for no verbose, 2 for max verbose.
+        cache: N2VCache. If given, the embeddings of every formula are stored in it with
+            the same hyperparameters as a `node2vec` call (see src/n2v_cache.py).
+
+    RETURNS
+    ----------
+        embeddings: list of Tensors. Node embeddings of every formula, with shape [2n+m, embedding_dim].
+    """
+    if (verbose == 1) or (verbose == 2):
+        print(f"\nLearning node2vec embeddings for {len(dimacs_paths)} formulas.")
+
+    # Disjoint union of the graphs
+    edges = []
+    node_offsets = [0]
+    for dimacs_path in dimacs_paths:
+        n, m, graph = dimacs2graph(dimacs_path=dimacs_path)
+        edges.append(graph.edge_index + node_offsets[-1])
+        node_offsets.append(node_offsets[-1] + 2 * n + m)
+    edge_index = torch.cat(edges, dim=1).to(device)
+    node_offsets = torch.tensor(node_offsets, dtype=torch.long)
+
+    # Model definition
+    model = UnionNode2Vec(edge_index=edge_index,
+                          node_offsets=node_offsets,
+                          embedding_dim=embedding_dim,
+                          walk_length=walk_length,
+                          context_size=context_size,
+                          walks_per_node=walks_per_node,
+                          num_negative_samples=1,
+                          p=p,
+                          q=q,
+                          sparse=True).to(device)
+
+    loader = model.loader(batch_size=batch_size * len(dimacs_paths), shuffle=True, num_workers=num_workers)
+    optimizer = torch.optim.SparseAdam(list(model.parameters()), lr=lr)
+
+    # Training
+    for epoch in range(num_epochs):
+        loss = n2v_train_epoch(model, loader, optimizer, device, progress_bar=True if verbose==2 else False)
+        if verbose == 2:
+            print(f'Epoch: {epoch+1:02d}, Loss: {loss:.4f}')
+        if (verbose == 1) and (epoch == num_epochs - 1):
+            print(f'Finish. Epoch: {epoch+1:02d}, Loss: {loss:.4f}')
+
+    # Getting node embeddings
+    with torch.no_grad():
+        model.eval()
+        union_embeddings = model(torch.arange(int(node_offsets[-1]), device=device))
+        # ::union_embeddings:: [seq_len=sum(2n+m), feature_size=emb_dim]
+    # Copies, so that saving one of them does not save the whole table.
+    embeddings = [union_embeddings[start:end].clone() for start, end in zip(node_offsets[:-1].tolist(), node_offsets[1:].tolist())]
+
+    # Save embeddings
+    if cache is not None:
+        params = {'embedding_dim': embedding_dim,
+                  'walk_length': walk_length,
+                  'context_size': context_size,
+                  'walks_per_node': walks_per_node,
+                  'p': p,
+                  'q': q,
+                  'batch_size': batch_size,
+                  'lr': lr,
+                  'num_epochs': num_epochs}
+        for dimacs_path, emb in zip(dimacs_paths, embeddings):
+            cache.put(formula_fingerprint(dimacs_path), params, emb)
+
+    return embeddings
+
+
 def node_emb2low_dim(node_embeddings, n, filename, dim=2, random_state=None):
     #TODO: Random state
 
@@ -659,27 +965,20 @@ def sampled_sol(formula, assignment):
         tensor with shape [batch_size, num_variables].
         Arguments
         ---------
-            formula (list): CNF formula to be satisfied.
+            formula (list or BaseEvaluator): CNF formula to be satisfied.
             assignment (tensor): Assignment to be verified. Must be a torch tensor
                 with shape [batch_size, num_variables]; e.g.: [[0,1,1], [1,0,1]].
         Returns
         -------
-            num_sat (int): Average number of satisfied clauses.
+            num_sat (int): Best number of satisfied clauses.
+            assignment (tensor): Best assignment, None if no clause is satisfied.
     '''
-    if not type(assignment) == torch.tensor:
-        assert TypeError("'assignment' must be a tensor with shape [batch_size, num_variables]")
+    num_sat = num_sat_clauses_tensor(formula, assignment)
+    # ::num_sat:: [batch_size]
 
-    batch_size = assignment.shape[0]
-    total_num_sat = 0
-    
-    best_num_sat = 0
-    best_assignment = None
-    for b in range(batch_size):
-        _, num_sat, _ = num_sat_clauses(formula, assignment[b])
-
-        if num_sat > best_num_sat:
-                best_num_sat = num_sat
-                best_assignment = assignment[b]
+    best_idx = int(num_sat.argmax())
+    best_num_sat = int(num_sat[best_idx])
+    best_assignment = assignment[best_idx] if best_num_sat > 0 else None
     
     return best_num_sat, best_assignment
 